@@ -0,0 +1,293 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Agent execution subsystem: decides where agent stream coroutines run
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# loop: run on the main event loop; pool: shared worker loops; thread: legacy thread + loop per stream
+AGENT_EXECUTOR_MODE = os.environ.get("AGENT_EXECUTOR_MODE", "pool")
+AGENT_EXECUTOR_WORKERS = int(os.environ.get("AGENT_EXECUTOR_WORKERS", 4))
+AGENT_EXECUTOR_TASKS_PER_WORKER = int(os.environ.get("AGENT_EXECUTOR_TASKS_PER_WORKER", 16))
+AGENT_EXECUTOR_MAX_QUEUE = int(os.environ.get("AGENT_EXECUTOR_MAX_QUEUE", 64))
+
+
+class AgentExecutorSaturated(Exception):
+    """Raised when the executor is running at capacity and its wait queue is full"""
+
+
+class AgentJob:
+    """Handle for one submitted agent coroutine"""
+
+    def __init__(self, job_id: str, coro_factory: Callable[[], Awaitable]):
+        self.job_id = job_id
+        self.coro_factory = coro_factory
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self, delay: float = 0):
+        """Cancel the job, optionally after `delay` seconds to let it wind down by itself"""
+        self.cancelled = True
+        loop, task = self._loop, self._task
+        if loop is None or task is None or self.done():
+            return
+        try:
+            if delay:
+                loop.call_soon_threadsafe(loop.call_later, delay, task.cancel)
+            else:
+                loop.call_soon_threadsafe(task.cancel)
+        except RuntimeError:
+            pass  # loop already closed
+
+
+class AgentExecutor:
+    """
+    Base executor with admission control.
+
+    At most `capacity` jobs run at once; up to `max_queue` more wait in FIFO
+    order and anything beyond that is rejected with AgentExecutorSaturated.
+    """
+    mode = ""
+
+    def __init__(self, capacity: Optional[int], max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, job_id: str, coro_factory: Callable[[], Awaitable]) -> AgentJob:
+        """Submit a coroutine factory. Thread-safe."""
+        job = AgentJob(job_id, coro_factory)
+        with self._lock:
+            if self.capacity is None or self._active < self.capacity:
+                self._active += 1
+                start = True
+            elif len(self._pending) < self.max_queue:
+                self._pending.append(job)
+                start = False
+            else:
+                self._rejected += 1
+                raise AgentExecutorSaturated(
+                    f"agent executor saturated: {self._active} running, {len(self._pending)} queued")
+            self._submitted += 1
+        if start:
+            self._launch(job)
+        else:
+            logger.info(f"Agent job {job_id} queued, queue depth {len(self._pending)}")
+        return job
+
+    def _launch(self, job: AgentJob):
+        raise NotImplementedError
+
+    async def _run(self, job: AgentJob):
+        job._loop = asyncio.get_running_loop()
+        job._task = asyncio.current_task()
+        job.started_at = time.monotonic()
+        wait = job.started_at - job.submitted_at
+        with self._lock:
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        try:
+            if not job.cancelled:
+                await job.coro_factory()
+        except asyncio.CancelledError:
+            logger.info(f"Agent job {job.job_id} cancelled")
+        except Exception as e:
+            logger.error(f"Agent job {job.job_id} failed: {e}")
+        finally:
+            job.finished_at = time.monotonic()
+            job._done.set()
+            self._on_finished(job)
+
+    def _on_finished(self, job: AgentJob):
+        next_job = None
+        with self._lock:
+            self._completed += 1
+            while self._pending:
+                candidate = self._pending.popleft()
+                if candidate.cancelled:
+                    candidate._done.set()
+                    continue
+                next_job = candidate
+                break
+            if next_job is None:
+                self._active -= 1
+        if next_job is not None:
+            self._launch(next_job)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            started = self._completed + self._active
+            return {
+                "mode": self.mode,
+                "capacity": self.capacity,
+                "active": self._active,
+                "queue_depth": len(self._pending),
+                "max_queue": self.max_queue,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "wait_avg_ms": round(self._wait_total / started * 1000, 2) if started else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 2),
+            }
+
+    def shutdown(self):
+        with self._lock:
+            pending, self._pending = list(self._pending), deque()
+        for job in pending:
+            job.cancel()
+            job._done.set()
+
+
+class LoopAgentExecutor(AgentExecutor):
+    """Runs agent coroutines as tasks on the main (serving) event loop"""
+    mode = "loop"
+
+    def __init__(self, capacity: int, max_queue: int):
+        super().__init__(capacity, max_queue)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def submit(self, job_id, coro_factory):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return super().submit(job_id, coro_factory)
+
+    def _launch(self, job):
+        asyncio.run_coroutine_threadsafe(self._run(job), self._loop)
+
+
+class _LoopWorker:
+    """A long-lived thread running its own event loop"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.active = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._serve, daemon=True, name=f"AgentWorker-{index}")
+        self.thread.start()
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        def _stop():
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.stop()
+        try:
+            self.loop.call_soon_threadsafe(_stop)
+        except RuntimeError:
+            pass
+
+
+class PoolAgentExecutor(AgentExecutor):
+    """Runs agent coroutines on a fixed set of worker threads, each with one long-lived loop"""
+    mode = "pool"
+
+    def __init__(self, workers: int, tasks_per_worker: int, max_queue: int):
+        super().__init__(workers * tasks_per_worker, max_queue)
+        self.workers = [_LoopWorker(i) for i in range(workers)]
+
+    def _launch(self, job):
+        with self._lock:
+            worker = min(self.workers, key=lambda w: w.active)
+            worker.active += 1
+
+        async def _run_on_worker():
+            try:
+                await self._run(job)
+            finally:
+                with self._lock:
+                    worker.active -= 1
+
+        asyncio.run_coroutine_threadsafe(_run_on_worker(), worker.loop)
+
+    def stats(self):
+        result = super().stats()
+        with self._lock:
+            result["workers"] = len(self.workers)
+            result["active_per_worker"] = [w.active for w in self.workers]
+        return result
+
+    def shutdown(self):
+        super().shutdown()
+        for worker in self.workers:
+            worker.stop()
+
+
+class ThreadAgentExecutor(AgentExecutor):
+    """Legacy behavior: one thread and one event loop per agent stream"""
+    mode = "thread"
+
+    def __init__(self, max_queue: int):
+        super().__init__(None, max_queue)
+
+    def _launch(self, job):
+        loop = asyncio.new_event_loop()
+
+        def _serve():
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self._run(job))
+            finally:
+                loop.close()
+                logger.info(f"Agent thread for {job.job_id} terminated")
+
+        threading.Thread(target=_serve, daemon=True, name=f"AgentStream-{job.job_id}").start()
+
+
+_executor: Optional[AgentExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_agent_executor() -> AgentExecutor:
+    """Return the process-wide executor configured by AGENT_EXECUTOR_MODE"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if AGENT_EXECUTOR_MODE == "loop":
+                _executor = LoopAgentExecutor(AGENT_EXECUTOR_WORKERS * AGENT_EXECUTOR_TASKS_PER_WORKER,
+                                              AGENT_EXECUTOR_MAX_QUEUE)
+            elif AGENT_EXECUTOR_MODE == "thread":
+                _executor = ThreadAgentExecutor(AGENT_EXECUTOR_MAX_QUEUE)
+            else:
+                _executor = PoolAgentExecutor(AGENT_EXECUTOR_WORKERS, AGENT_EXECUTOR_TASKS_PER_WORKER,
+                                              AGENT_EXECUTOR_MAX_QUEUE)
+            logger.info(f"Agent executor started: {_executor.stats()}")
+        return _executor
+
+
+def shutdown_agent_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
@@ -0,0 +1,183 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Batch chat: runs JSONL chat requests on a bounded worker pool with a resumable checkpoint
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BATCH_CHAT_CONCURRENCY = int(os.environ.get("BATCH_CHAT_CONCURRENCY", 4))
+BATCH_CHAT_MAX_CONCURRENCY = int(os.environ.get("BATCH_CHAT_MAX_CONCURRENCY", 16))
+BATCH_CHECKPOINT_DIR = os.environ.get("BATCH_CHECKPOINT_DIR", "batch_checkpoints")
+
+_BATCH_ID_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,127}")
+
+# run_item(worker_index, item) -> response dict; raising fails only that item
+RunItem = Callable[[int, Any], Awaitable[dict]]
+
+
+def valid_batch_id(batch_id: str) -> bool:
+    return bool(_BATCH_ID_RE.fullmatch(batch_id))
+
+
+def fingerprint(line: str) -> str:
+    return hashlib.sha1(line.encode("utf-8")).hexdigest()[:16]
+
+
+class BatchItem:
+    """One input line: the parsed request, or the error that prevented parsing it"""
+    __slots__ = ("index", "custom_id", "request", "error", "fingerprint")
+
+    def __init__(self, index: int, line: str, request: Any = None, error: Optional[str] = None,
+                 custom_id: Optional[str] = None):
+        self.index = index
+        self.custom_id = custom_id
+        self.request = request
+        self.error = error
+        self.fingerprint = fingerprint(line)
+
+
+def parse_jsonl(body: str, parse_request: Callable[[dict], Any]) -> List[BatchItem]:
+    """Parse a JSONL body; blank lines are skipped, invalid lines become failed items"""
+    items = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        index = len(items)
+        try:
+            obj = json.loads(line)
+            custom_id = obj.pop("custom_id", None) if isinstance(obj, dict) else None
+            items.append(BatchItem(index, line, request=parse_request(obj), custom_id=custom_id))
+        except Exception as e:
+            items.append(BatchItem(index, line, error=f"Invalid request: {e}"))
+    return items
+
+
+class BatchCheckpoint:
+    """Append-only JSONL file of finished results, keyed by item index and input fingerprint"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Dict[int, Tuple[str, str]]:
+        """index -> (fingerprint, result line) of the successful results already written"""
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record.get("status") != "ok":
+                        # failed items are retried on resume
+                        done.pop(record["index"], None)
+                        continue
+                    done[record["index"]] = (record.get("fingerprint"), line.rstrip("\n"))
+                except (ValueError, KeyError):
+                    # a line cut short by the interruption
+                    continue
+        return done
+
+    def append(self, line: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class BatchChatRunner:
+    """
+    Runs batch items on `concurrency` workers and yields JSONL result lines in
+    completion order.
+
+    Items that already succeeded in the checkpoint with the same input
+    fingerprint are replayed first instead of being run again. Each result carries its
+    worker, queue wait and run time. Cancelling the iteration (client
+    disconnect) cancels the running items; finished ones stay checkpointed.
+    """
+
+    def __init__(self, batch_id: str, items: List[BatchItem], run_item: RunItem,
+                 concurrency: int = BATCH_CHAT_CONCURRENCY, checkpoint: Optional[BatchCheckpoint] = None):
+        self.batch_id = batch_id
+        self.items = items
+        self.run_item = run_item
+        self.concurrency = max(1, min(concurrency, BATCH_CHAT_MAX_CONCURRENCY))
+        self.checkpoint = checkpoint
+        self.replayed = 0
+
+    def _result_line(self, item: BatchItem, worker: Optional[int], status: str, payload: dict,
+                     queued_ms: float, elapsed_ms: float) -> str:
+        record = {"index": item.index, "custom_id": item.custom_id, "status": status}
+        record.update(payload)
+        record["timing"] = {"worker": worker, "queued_ms": round(queued_ms, 2), "elapsed_ms": round(elapsed_ms, 2)}
+        record["fingerprint"] = item.fingerprint
+        return json.dumps(record, ensure_ascii=False)
+
+    async def _worker(self, worker: int, pending: asyncio.Queue, results: asyncio.Queue, started: float):
+        while True:
+            try:
+                item = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            begin = time.monotonic()
+            try:
+                response = await self.run_item(worker, item.request)
+                status, payload = "ok", {"response": response}
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                detail = getattr(e, "detail", None) or str(e)
+                logger.error(f"Batch {self.batch_id} item {item.index} failed: {detail}")
+                status, payload = "error", {"error": detail}
+            end = time.monotonic()
+            line = self._result_line(item, worker, status, payload, (begin - started) * 1000, (end - begin) * 1000)
+            await results.put(line)
+
+    async def run(self) -> AsyncIterator[bytes]:
+        done = self.checkpoint.load() if self.checkpoint else {}
+        pending: asyncio.Queue = asyncio.Queue()
+        results: asyncio.Queue = asyncio.Queue()
+        for item in self.items:
+            previous = done.get(item.index)
+            if previous is not None and previous[0] == item.fingerprint:
+                self.replayed += 1
+                yield previous[1].encode("utf-8") + b"\n"
+            elif item.error is not None:
+                line = self._result_line(item, None, "error", {"error": item.error}, 0.0, 0.0)
+                if self.checkpoint:
+                    self.checkpoint.append(line)
+                yield line.encode("utf-8") + b"\n"
+            else:
+                pending.put_nowait(item)
+
+        remaining = pending.qsize()
+        if remaining:
+            logger.info(f"Batch {self.batch_id}: running {remaining} items on {self.concurrency} workers, "
+                        f"{self.replayed} replayed from checkpoint")
+        started = time.monotonic()
+        workers = [asyncio.create_task(self._worker(index, pending, results, started))
+                   for index in range(min(self.concurrency, remaining))]
+        try:
+            for _ in range(remaining):
+                line = await results.get()
+                if self.checkpoint:
+                    self.checkpoint.append(line)
+                yield line.encode("utf-8") + b"\n"
+        finally:
+            for task in workers:
+                if not task.done():
+                    task.cancel()
+            for task in workers:
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
@@ -0,0 +1,86 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Accumulates agent stream events into a single non-streaming chat completion
+"""
+import time
+from typing import Any, Dict, List, Optional
+
+# Bedrock usage fields mapped to the OpenAI-style usage keys of ChatResponse
+_USAGE_FIELDS = (
+    ("inputTokens", "prompt_tokens"),
+    ("outputTokens", "completion_tokens"),
+    ("totalTokens", "total_tokens"),
+    ("cacheReadInputTokens", "cache_read_input_tokens"),
+    ("cacheWriteInputTokens", "cache_write_input_tokens"),
+)
+
+
+class ChatAggregator:
+    """
+    Consumes the events of process_query_stream and builds a chat.completion.
+
+    Text and reasoning deltas go straight into list buffers and tool calls
+    are kept as the call/result pairs of result_pairs events, so no per-delta
+    chunk dicts or SSE frames are built. Usage is summed over the metadata
+    events of every model turn of the agent loop.
+    """
+
+    def __init__(self):
+        self._text: List[str] = []
+        self._reasoning: List[str] = []
+        self.tool_results: List[Any] = []
+        self.usage: Dict[str, int] = {}
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def add(self, event: dict):
+        event_type = event["type"]
+        if event_type == "block_delta":
+            delta = event["data"]["delta"]
+            if "text" in delta:
+                self._text.append(delta["text"])
+            elif "reasoningContent" in delta and "text" in delta["reasoningContent"]:
+                self._reasoning.append(delta["reasoningContent"]["text"])
+        elif event_type == "result_pairs":
+            self.tool_results.extend(event["data"]["tool_results"])
+        elif event_type == "metadata":
+            usage = event["data"].get("usage") or {}
+            for source, target in _USAGE_FIELDS:
+                if source in usage:
+                    self.usage[target] = self.usage.get(target, 0) + int(usage[source])
+        elif event_type == "message_stop":
+            self.finish_reason = event["data"]["stopReason"]
+        elif event_type == "stopped":
+            self.finish_reason = "stop_requested"
+        elif event_type == "error":
+            data = event.get("data")
+            self.error = data.get("message", str(data)) if isinstance(data, dict) else str(data)
+            self.finish_reason = "error"
+
+    @property
+    def text(self) -> str:
+        return "".join(self._text)
+
+    def response(self, model: str, response_id: Optional[str] = None) -> Dict:
+        """The chat.completion body, in the shape of ChatResponse"""
+        message = {"role": "assistant", "content": self.text}
+        if self._reasoning:
+            message["reasoning_content"] = "".join(self._reasoning)
+        choice = {"index": 0, "message": message, "finish_reason": self.finish_reason}
+        if self.tool_results:
+            choice["message_extras"] = {"tool_use": self.tool_results}
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        usage.update(self.usage)
+        if "total_tokens" not in self.usage:
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return {
+            "id": response_id or f"chat{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [choice],
+            "usage": usage,
+        }
@@ -23,6 +23,8 @@ class ChatClient:
         self.system = None
         self.agent = None
         self.user_id = user_id
+        # Set to False for stateless clients (e.g. batch workers) that must not read or write conversation history
+        self.persist_history = True
     
     async def clear_history(self):
         """clear session message of this client"""
@@ -32,12 +34,16 @@ class ChatClient:
             await delete_user_message(self.user_id)
     
     async def save_history(self):
+        if not self.persist_history:
+            return
         if self.agent:
             self.messages = self.agent.messages
             if DDB_TABLE:
                 await save_user_message(self.user_id,self.messages)
             
     async def load_history(self):
+        if not self.persist_history:
+            return []
         if DDB_TABLE:
             return await get_user_message(self.user_id)
         else:
@@ -0,0 +1,356 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Cross-instance pub/sub bus, used to push stream cancellations to every instance
+
+CLUSTER_BUS_URL selects the backend:
+    (empty)                   in-process bus, single instance only
+    redis://host:port[/pfx]   any server speaking the Redis pub/sub protocol
+
+A minimal Redis-protocol broker is included as a local stand-in for tests
+and multi-instance development:
+    python src/cluster_bus.py --serve --port 6390
+"""
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_BUS_URL = os.environ.get("CLUSTER_BUS_URL", "")
+STREAM_CANCEL_CHANNEL = "stream_cancel"
+
+MessageCallback = Callable[[str], None]
+
+
+class ClusterBus:
+    """Publish/subscribe interface shared by all bus backends"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[MessageCallback]] = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, channel: str, callback: MessageCallback):
+        """Register a callback for channel, before or after start()"""
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def publish(self, channel: str, message: str):
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _dispatch(self, channel: str, message: str):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, []))
+        for callback in callbacks:
+            self.delivered += 1
+            try:
+                callback(message)
+            except Exception as e:
+                logger.error(f"Cluster bus callback for {channel} failed: {e}")
+
+    def stats(self) -> Dict:
+        return {"backend": type(self).__name__, "published": self.published, "delivered": self.delivered}
+
+
+class InProcessBus(ClusterBus):
+    """Delivers messages synchronously to subscribers in this process"""
+
+    def publish(self, channel: str, message: str):
+        self.published += 1
+        self._dispatch(channel, message)
+
+
+def _encode_command(*args: str) -> bytes:
+    out = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg.encode() if isinstance(arg, str) else arg
+        out.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(out)
+
+
+def _read_reply(reader):
+    """Read one RESP value from a binary file-like reader"""
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode()
+    if kind == b"-":
+        raise RuntimeError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2].decode()
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise RuntimeError(f"unexpected reply {line!r}")
+
+
+class RedisBus(ClusterBus):
+    """
+    Bus over the Redis pub/sub protocol, implemented on plain sockets.
+
+    One subscriber thread holds a SUBSCRIBE connection and reconnects with
+    backoff; publishing uses a separate lock-protected connection.
+    """
+
+    def __init__(self, host: str, port: int, prefix: str = "mcp", timeout: float = 2.0):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.timeout = timeout
+        self._pub_sock: Optional[socket.socket] = None
+        self._pub_reader = None
+        self._pub_lock = threading.Lock()
+        self._sub_sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.connected = False
+
+    def _channel(self, channel: str) -> str:
+        return f"{self.prefix}:{channel}" if self.prefix else channel
+
+    def subscribe(self, channel: str, callback: MessageCallback):
+        with self._lock:
+            new = channel not in self._subscribers
+            self._subscribers.setdefault(channel, []).append(callback)
+            if new and self._sub_sock is not None:
+                # a connection that is already subscribed only learns of new channels this way;
+                # if it fails, the reconnect subscribes to every channel
+                try:
+                    self._sub_sock.sendall(_encode_command("SUBSCRIBE", self._channel(channel)))
+                except OSError as e:
+                    logger.warning(f"Cluster bus subscribe to {channel} failed: {e}")
+
+    def _connect(self, timeout: Optional[float]) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        return sock
+
+    def publish(self, channel: str, message: str):
+        with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    if self._pub_sock is None:
+                        self._pub_sock = self._connect(self.timeout)
+                        self._pub_reader = self._pub_sock.makefile("rb")
+                    self._pub_sock.sendall(_encode_command("PUBLISH", self._channel(channel), message))
+                    _read_reply(self._pub_reader)
+                    self.published += 1
+                    return
+                except (OSError, ConnectionError) as e:
+                    self._close_publisher()
+                    if attempt:
+                        logger.error(f"Cluster bus publish to {channel} failed: {e}")
+                        raise
+
+    def _close_publisher(self):
+        if self._pub_sock is not None:
+            try:
+                self._pub_sock.close()
+            except OSError:
+                pass
+        self._pub_sock = None
+        self._pub_reader = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._listen, daemon=True, name="ClusterBus")
+            self._thread.start()
+
+    def _listen(self):
+        backoff = 0.5
+        while not self._closed:
+            try:
+                sock = self._connect(None)
+                reader = sock.makefile("rb")
+                # under the lock, so a channel subscribed meanwhile is either in this list or sent by subscribe()
+                with self._lock:
+                    channels = [self._channel(c) for c in self._subscribers]
+                    if channels:
+                        sock.sendall(_encode_command("SUBSCRIBE", *channels))
+                    self._sub_sock = sock
+                self.connected = True
+                backoff = 0.5
+                logger.info(f"Cluster bus subscribed to {channels} on {self.host}:{self.port}")
+                strip = len(self.prefix) + 1 if self.prefix else 0
+                while not self._closed:
+                    reply = _read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == "message":
+                        self._dispatch(reply[1][strip:], reply[2])
+            except Exception as e:
+                if self._closed:
+                    break
+                logger.warning(f"Cluster bus connection lost: {e}, retrying in {backoff}s")
+            finally:
+                self.connected = False
+                with self._lock:
+                    self._sub_sock = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    def close(self):
+        self._closed = True
+        sock = self._sub_sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+        with self._pub_lock:
+            self._close_publisher()
+
+    def stats(self):
+        result = super().stats()
+        result["connected"] = self.connected
+        return result
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    """Serves one client connection of MiniRedisBroker"""
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                command = _read_reply(self.rfile)
+                if not isinstance(command, list) or not command:
+                    continue
+                name = command[0].upper()
+                if name == "SUBSCRIBE":
+                    for index, channel in enumerate(command[1:], start=1):
+                        broker.add(channel, self)
+                        self.send(reply=["subscribe", channel, index])
+                elif name == "PUBLISH":
+                    count = broker.publish(command[1], command[2])
+                    self.send(f":{count}\r\n".encode())
+                elif name == "PING":
+                    self.send(b"+PONG\r\n")
+                else:
+                    self.send(f"-ERR unknown command '{command[0]}'\r\n".encode())
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker.remove(self)
+
+    def send(self, data: bytes = b"", reply: Optional[list] = None):
+        if reply is not None:
+            parts = [f"*{len(reply)}\r\n".encode()]
+            for item in reply:
+                if isinstance(item, int):
+                    parts.append(f":{item}\r\n".encode())
+                else:
+                    encoded = item.encode()
+                    parts.append(f"${len(encoded)}\r\n".encode() + encoded + b"\r\n")
+            data = b"".join(parts)
+        with self.server.broker.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class MiniRedisBroker:
+    """Threaded broker implementing SUBSCRIBE/PUBLISH/PING of the Redis protocol"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6390):
+        self.channels: Dict[str, set] = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), _BrokerHandler)
+        self.server.daemon_threads = True
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+
+    def add(self, channel, handler):
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(handler)
+
+    def remove(self, handler):
+        with self.lock:
+            for handlers in self.channels.values():
+                handlers.discard(handler)
+
+    def publish(self, channel, message) -> int:
+        with self.lock:
+            handlers = list(self.channels.get(channel, ()))
+        for handler in handlers:
+            try:
+                handler.send(reply=["message", channel, message])
+            except OSError:
+                self.remove(handler)
+        return len(handlers)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True, name="MiniRedisBroker").start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_cluster_bus(url: str = "") -> ClusterBus:
+    if not url:
+        return InProcessBus()
+    parsed = urlparse(url)
+    if parsed.scheme != "redis":
+        raise ValueError(f"Unsupported cluster bus url: {url}")
+    prefix = parsed.path.strip("/") or "mcp"
+    return RedisBus(parsed.hostname or "127.0.0.1", parsed.port or 6379, prefix=prefix)
+
+
+_bus: Optional[ClusterBus] = None
+_bus_lock = threading.Lock()
+
+
+def get_cluster_bus() -> ClusterBus:
+    """Return the process-wide bus configured by CLUSTER_BUS_URL"""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = create_cluster_bus(CLUSTER_BUS_URL)
+            logger.info(f"Cluster bus backend: {type(_bus).__name__}")
+        return _bus
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', action='store_true', help="run the local Redis-protocol stand-in broker")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    if args.serve:
+        logging.basicConfig(level=logging.INFO)
+        broker = MiniRedisBroker(args.host, args.port)
+        logger.info(f"Mini broker listening on {args.host}:{broker.port}")
+        broker.serve_forever()
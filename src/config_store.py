@@ -0,0 +1,247 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+In-process TTL cache for user session records and MCP server configs, and a
+write-behind buffer that coalesces config changes into one write per user
+
+Entries carry version stamps: invalidating a user bumps its version, and a
+DynamoDB read started before the bump is not stored, so a slow read can not
+put a stale config back after a change. Changes made on another instance
+arrive as CONFIG_INVALIDATE_CHANNEL messages on the cluster bus.
+"""
+import os
+import time
+import uuid
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 30))
+CONFIG_CACHE_TTL = float(os.environ.get("CONFIG_CACHE_TTL", 30))
+CONFIG_INVALIDATE_CHANNEL = "config_invalidate"
+# Changes to one user's configs within this window are persisted with a single write
+CONFIG_WRITE_DEBOUNCE = float(os.environ.get("CONFIG_WRITE_DEBOUNCE", 0.5))
+# Delay before retrying a write that failed
+CONFIG_WRITE_RETRY = float(os.environ.get("CONFIG_WRITE_RETRY", 5))
+
+# Tags this instance's invalidation messages so it skips its own echoes from the bus
+INSTANCE_ID = uuid.uuid4().hex[:12]
+
+_MISS = object()
+# Staged value of a field that is to be removed
+DELETED = object()
+
+# persist(key, changes) writes {field: value or DELETED} for one key, raising on failure
+Persist = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
+class VersionedTTLCache:
+    """key -> value entries expiring after `ttl` seconds, each stamped with the key's version"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[Any, int, float]] = {}
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_puts = 0
+
+    def version(self, key: str) -> int:
+        """Current version of key; read it before loading the value to be put"""
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, version, expires = entry
+                if expires > time.monotonic() and version == self._versions.get(key, 0):
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: str, value: Any, version: Optional[int] = None) -> bool:
+        """Store value unless key was invalidated after `version` was read"""
+        if self.ttl <= 0:
+            return False
+        with self._lock:
+            current = self._versions.get(key, 0)
+            if version is not None and version != current:
+                self.stale_puts += 1
+                return False
+            self._entries[key] = (value, current, time.monotonic() + self.ttl)
+            return True
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "stale_puts": self.stale_puts, "ttl_seconds": self.ttl}
+
+
+class ConfigStore:
+    """Session and server config caches of this instance"""
+
+    def __init__(self, session_ttl: float = SESSION_CACHE_TTL, config_ttl: float = CONFIG_CACHE_TTL):
+        self.sessions = VersionedTTLCache(session_ttl)
+        self.configs = VersionedTTLCache(config_ttl)
+        self.remote_invalidations = 0
+
+    def get_session(self, user_id: str) -> Any:
+        return self.sessions.get(user_id, _MISS)
+
+    def get_configs(self, user_id: str) -> Any:
+        return self.configs.get(user_id, _MISS)
+
+    @staticmethod
+    def is_miss(value: Any) -> bool:
+        return value is _MISS
+
+    def invalidate_user(self, user_id: str):
+        self.sessions.invalidate(user_id)
+        self.configs.invalidate(user_id)
+
+    def invalidation_message(self, user_id: str) -> str:
+        return f"{INSTANCE_ID}:{user_id}"
+
+    def on_invalidate_message(self, message: str):
+        """Cluster bus callback for CONFIG_INVALIDATE_CHANNEL"""
+        instance_id, _, user_id = message.partition(":")
+        if instance_id == INSTANCE_ID or not user_id:
+            return
+        self.remote_invalidations += 1
+        self.invalidate_user(user_id)
+
+    def stats(self) -> Dict:
+        return {"sessions": self.sessions.stats(), "configs": self.configs.stats(),
+                "remote_invalidations": self.remote_invalidations}
+
+
+class WriteBehindBuffer:
+    """
+    Dirty fields per key, persisted by one `persist` call per key after a debounce.
+
+    Changes staged while a write is pending are merged into it, and callers
+    report saves of unchanged values through `unchanged`; both count as
+    avoided writes. A failed write keeps its changes, unless newer ones
+    replaced them, and is retried after CONFIG_WRITE_RETRY seconds.
+    """
+
+    def __init__(self, persist: Persist, debounce: float = CONFIG_WRITE_DEBOUNCE,
+                 retry: float = CONFIG_WRITE_RETRY):
+        self._persist = persist
+        self.debounce = debounce
+        self.retry = retry
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        # changes being written, still applied by overlay until the write is done
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # one lock per key, so a slow write of one user does not hold up the others;
+        # a lock is dropped once no flush of its key holds or waits for it
+        self._flush_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.staged = 0
+        self.writes = 0
+        self.avoided_writes = 0
+        self.failed_writes = 0
+
+    def unchanged(self):
+        """Record a save that matched the known value and needs no write"""
+        self.avoided_writes += 1
+
+    async def stage(self, key: str, field: str, value: Any):
+        changes = self._dirty.setdefault(key, {})
+        if changes:
+            # merged into the write already pending for this key
+            self.avoided_writes += 1
+        changes[field] = value
+        self.staged += 1
+        if self.debounce <= 0:
+            await self.flush(key)
+        elif key not in self._timers:
+            self._schedule(key, self.debounce)
+
+    def _schedule(self, key: str, delay: float):
+        self._timers[key] = asyncio.get_running_loop().call_later(delay, self._flush_later, key)
+
+    def _flush_later(self, key: str):
+        task = asyncio.get_running_loop().create_task(self.flush(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pending(self, key: str) -> Dict[str, Any]:
+        return dict(self._dirty.get(key, {}))
+
+    def overlay(self, key: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """data as it will be once the pending changes of key are written"""
+        layers = [changes for changes in (self._inflight.get(key), self._dirty.get(key)) if changes]
+        if not layers:
+            return data
+        data = dict(data)
+        for changes in layers:
+            for field, value in changes.items():
+                if value is DELETED:
+                    data.pop(field, None)
+                else:
+                    data[field] = value
+        return data
+
+    async def flush(self, key: Optional[str] = None):
+        """Write the pending changes of key, or of every key"""
+        keys = [key] if key is not None else list(self._dirty)
+        for key in keys:
+            lock = self._flush_locks.get(key)
+            if lock is None:
+                lock = self._flush_locks[key] = asyncio.Lock()
+            async with lock:
+                timer = self._timers.pop(key, None)
+                if timer is not None:
+                    timer.cancel()
+                changes = self._dirty.pop(key, None)
+                if not changes:
+                    continue
+                self._inflight[key] = changes
+                try:
+                    await self._persist(key, changes)
+                    self.writes += 1
+                except Exception as e:
+                    self.failed_writes += 1
+                    logger.error(f"Writing {len(changes)} config changes of {key} failed: {e}")
+                    changes.update(self._dirty.get(key, {}))
+                    self._dirty[key] = changes
+                    if key not in self._timers and self.retry > 0:
+                        self._schedule(key, self.retry)
+                finally:
+                    self._inflight.pop(key, None)
+
+    def stats(self) -> Dict:
+        return {"staged": self.staged, "writes": self.writes, "avoided_writes": self.avoided_writes,
+                "failed_writes": self.failed_writes, "dirty_keys": len(self._dirty),
+                "debounce_seconds": self.debounce}
+
+
+_store: Optional[ConfigStore] = None
+_store_lock = threading.Lock()
+
+
+def get_config_store() -> ConfigStore:
+    """Return the process-wide config store"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ConfigStore()
+        return _store
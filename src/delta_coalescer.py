@@ -0,0 +1,83 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Coalesces consecutive streaming deltas into fewer SSE frames
+"""
+import os
+import time
+from typing import List, Optional, Tuple
+
+# Server default coalescing window in milliseconds; 0 disables coalescing
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", 0))
+# Flush early once this many bytes are pending
+SSE_COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", 2048))
+
+
+class DeltaCoalescer:
+    """
+    Buffers deltas of one kind (content, reasoning_content, toolinput_content)
+    until the window expires, the byte budget is reached or the kind changes.
+
+    `add` returns the frames that must be sent now, in order: the pending
+    data of another kind, then the new delta's buffer if it is over budget or
+    due. The caller flushes pending data before every non-delta event so
+    message_stop, tool results and errors are never held back.
+    """
+
+    def __init__(self, window_ms: float, max_bytes: int = SSE_COALESCE_BYTES):
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        self._kind: Optional[str] = None
+        self._parts: List[str] = []
+        self._size = 0
+        self._since = 0.0
+        self.deltas_in = 0
+        self.frames_out = 0
+
+    @classmethod
+    def from_params(cls, extra_params: Optional[dict]) -> Optional["DeltaCoalescer"]:
+        """Build a coalescer from request extra_params, falling back to the server default"""
+        extra_params = extra_params or {}
+        window_ms = float(extra_params.get("coalesce_ms", SSE_COALESCE_MS) or 0)
+        if window_ms <= 0:
+            return None
+        max_bytes = int(extra_params.get("coalesce_bytes", SSE_COALESCE_BYTES) or SSE_COALESCE_BYTES)
+        return cls(window_ms, max_bytes)
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def add(self, kind: str, text: str) -> List[Tuple[str, str]]:
+        self.deltas_in += 1
+        ready = []
+        if self._parts and kind != self._kind:
+            ready.append(self.flush())
+        if not self._parts:
+            self._kind = kind
+            self._since = time.monotonic()
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.max_bytes or self.due():
+            ready.append(self.flush())
+        return ready
+
+    def due(self) -> bool:
+        return bool(self._parts) and time.monotonic() - self._since >= self.window
+
+    def remaining(self) -> float:
+        """Seconds until the pending data is due"""
+        return max(0.0, self.window - (time.monotonic() - self._since))
+
+    def flush(self) -> Optional[Tuple[str, str]]:
+        """Return the pending (kind, text) and reset, or None when nothing is pending"""
+        if not self._parts:
+            return None
+        frame = (self._kind, "".join(self._parts))
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self.frames_out += 1
+        return frame
@@ -0,0 +1,281 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Incremental JSON tokenizer for tool-use input streamed in fragments
+"""
+import re
+from typing import Any, List, Optional
+
+# What the tokenizer expects next outside of a token
+_VALUE = 0           # any value
+_VALUE_OR_END = 1    # first array element or ']'
+_KEY_OR_END = 2      # first object key or '}'
+_KEY = 3             # object key after ','
+_COLON = 4
+_COMMA_OR_END = 5
+_DONE = 6
+
+# Token being read
+_NONE = 0
+_STRING = 1
+_NUMBER = 2
+_LITERAL = 3
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_CHARS = frozenset("0123456789+-.eE")
+_NUMBER_RE = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?\Z")
+_LITERALS = {"true": True, "false": False, "null": None}
+_STRING_SPECIAL = re.compile(r'["\\\x00-\x1f]')
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_HEX = frozenset("0123456789abcdefABCDEF")
+
+
+class JSONStreamError(ValueError):
+    """Malformed JSON detected at `position` (offset into the whole input)"""
+
+    def __init__(self, message: str, position: int):
+        super().__init__(f"{message} at position {position}")
+        self.position = position
+
+
+class IncrementalJSONParser:
+    """
+    Tokenizes one JSON document fed in arbitrary fragments.
+
+    The parse state is a container stack plus the token in progress, so each
+    `feed` costs time proportional to the fragment only; string contents are
+    scanned with a regex rather than character by character.
+
+    `feed` returns the partial updates found in the fragment:
+        {"path": [...], "text": "..."}   decoded text appended to a string value
+        {"path": [...], "value": v}      a number, true, false or null value
+    Paths are lists of object keys and array indexes. Malformed input raises
+    JSONStreamError as soon as the offending character is seen; the error is
+    also kept in `error` and every later `feed` raises it again.
+    """
+
+    def __init__(self):
+        # frames: [is_object, key or index]
+        self._stack: List[list] = []
+        self._expect = _VALUE
+        self._token = _NONE
+        self._token_parts: List[str] = []
+        self._is_key = False
+        # inside a string: None, '\\' after a backslash, or the hex digits of a \u escape
+        self._escape: Optional[str] = None
+        self._high_surrogate: Optional[int] = None
+        self._offset = 0
+        self._updates: List[dict] = []
+        # update of the string value being read, extended in place within one feed
+        self._text_update: Optional[dict] = None
+        self.error: Optional[JSONStreamError] = None
+
+    @property
+    def complete(self) -> bool:
+        """True once a whole JSON value has been read"""
+        return self._expect == _DONE or (self._token in (_NUMBER, _LITERAL) and not self._stack
+                                         and self._token_valid())
+
+    def _token_valid(self) -> bool:
+        text = "".join(self._token_parts)
+        if self._token == _NUMBER:
+            return bool(_NUMBER_RE.match(text))
+        return text in _LITERALS
+
+    def _fail(self, message: str, index: int):
+        self.error = JSONStreamError(message, self._offset + index)
+        raise self.error
+
+    def _path(self) -> list:
+        return [frame[1] for frame in self._stack]
+
+    def feed(self, chunk: str) -> List[dict]:
+        if self.error is not None:
+            raise self.error
+        self._updates = []
+        self._text_update = None
+        index, size = 0, len(chunk)
+        while index < size:
+            if self._token == _STRING:
+                index = self._scan_string(chunk, index)
+                continue
+            char = chunk[index]
+            if self._token == _NUMBER:
+                if char in _NUMBER_CHARS:
+                    self._token_parts.append(char)
+                    index += 1
+                    continue
+                self._end_number(index)
+            elif self._token == _LITERAL:
+                if char.isalpha():
+                    self._token_parts.append(char)
+                    text = "".join(self._token_parts)
+                    if not any(literal.startswith(text) for literal in _LITERALS):
+                        self._fail(f"invalid literal {text!r}", index)
+                    if text in _LITERALS:
+                        self._token = _NONE
+                        self._token_parts = []
+                        self._emit_value(_LITERALS[text])
+                    index += 1
+                    continue
+                self._fail(f"invalid literal {''.join(self._token_parts)!r}", index)
+            self._structural(char, index)
+            index += 1
+        self._offset += size
+        return self._updates
+
+    def _structural(self, char: str, index: int):
+        if char in _WHITESPACE:
+            return
+        expect = self._expect
+        if expect == _DONE:
+            self._fail(f"unexpected {char!r} after the end of the document", index)
+        if expect in (_VALUE, _VALUE_OR_END):
+            if char == "]" and expect == _VALUE_OR_END:
+                self._close_container()
+            else:
+                self._start_value(char, index)
+        elif expect in (_KEY_OR_END, _KEY):
+            if char == '"':
+                self._token = _STRING
+                self._is_key = True
+                self._token_parts = []
+            elif char == "}" and expect == _KEY_OR_END:
+                self._close_container()
+            else:
+                self._fail(f"expected an object key, got {char!r}", index)
+        elif expect == _COLON:
+            if char != ":":
+                self._fail(f"expected ':', got {char!r}", index)
+            self._expect = _VALUE
+        elif expect == _COMMA_OR_END:
+            is_object = self._stack[-1][0]
+            if char == ",":
+                if is_object:
+                    self._expect = _KEY
+                else:
+                    self._stack[-1][1] += 1
+                    self._expect = _VALUE
+            elif char == ("}" if is_object else "]"):
+                self._close_container()
+            else:
+                self._fail(f"expected ',' or {'}' if is_object else ']'}, got {char!r}", index)
+
+    def _start_value(self, char: str, index: int):
+        if char == "{":
+            self._stack.append([True, None])
+            self._expect = _KEY_OR_END
+        elif char == "[":
+            self._stack.append([False, 0])
+            self._expect = _VALUE_OR_END
+        elif char == '"':
+            self._token = _STRING
+            self._is_key = False
+            # an empty string still produces an update
+            self._text_update = {"path": self._path(), "text": ""}
+            self._updates.append(self._text_update)
+        elif char == "-" or char.isdigit():
+            self._token = _NUMBER
+            self._token_parts = [char]
+        elif char in "tfn":
+            self._token = _LITERAL
+            self._token_parts = [char]
+        else:
+            self._fail(f"unexpected {char!r}, expected a value", index)
+
+    def _close_container(self):
+        self._stack.pop()
+        self._value_done()
+
+    def _value_done(self):
+        self._expect = _COMMA_OR_END if self._stack else _DONE
+
+    def _emit_value(self, value: Any):
+        self._updates.append({"path": self._path(), "value": value})
+        self._value_done()
+
+    def _end_number(self, index: int):
+        text = "".join(self._token_parts)
+        if not _NUMBER_RE.match(text):
+            self._fail(f"invalid number {text!r}", index)
+        self._token = _NONE
+        self._token_parts = []
+        self._emit_value(float(text) if any(c in text for c in ".eE") else int(text))
+
+    def _emit_text(self, text: str):
+        if not text:
+            return
+        if self._is_key:
+            self._token_parts.append(text)
+            return
+        if self._text_update is None:
+            self._text_update = {"path": self._path(), "text": text}
+            self._updates.append(self._text_update)
+        else:
+            self._text_update["text"] += text
+
+    def _scan_string(self, chunk: str, index: int) -> int:
+        """Consume string content from index, returning the index after what was consumed"""
+        if self._escape is not None:
+            return self._scan_escape(chunk, index)
+        match = _STRING_SPECIAL.search(chunk, index)
+        end = match.start() if match else len(chunk)
+        if end > index:
+            if self._high_surrogate is not None:
+                self._fail("unpaired surrogate in string", index)
+            self._emit_text(chunk[index:end])
+        if match is None:
+            return end
+        char = chunk[end]
+        if char == '"':
+            if self._high_surrogate is not None:
+                self._fail("unpaired surrogate in string", end)
+            self._token = _NONE
+            if self._is_key:
+                self._stack[-1][1] = "".join(self._token_parts)
+                self._token_parts = []
+                self._is_key = False
+                self._expect = _COLON
+            else:
+                self._text_update = None
+                self._value_done()
+            return end + 1
+        if char == "\\":
+            self._escape = ""
+            return end + 1
+        self._fail("control character in string", end)
+
+    def _scan_escape(self, chunk: str, index: int) -> int:
+        char = chunk[index]
+        if self._escape == "":
+            if char == "u":
+                self._escape = "u"
+                return index + 1
+            if char not in _ESCAPES:
+                self._fail(f"invalid escape '\\{char}'", index)
+            if self._high_surrogate is not None:
+                self._fail("unpaired surrogate in string", index)
+            self._escape = None
+            self._emit_text(_ESCAPES[char])
+            return index + 1
+        if char not in _HEX:
+            self._fail(f"invalid unicode escape digit {char!r}", index)
+        self._escape += char
+        if len(self._escape) < 5:
+            return index + 1
+        code = int(self._escape[1:], 16)
+        self._escape = None
+        if self._high_surrogate is not None:
+            if not 0xDC00 <= code <= 0xDFFF:
+                self._fail("unpaired surrogate in string", index)
+            code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+        elif 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+            return index + 1
+        elif 0xDC00 <= code <= 0xDFFF:
+            self._fail("unpaired surrogate in string", index)
+        self._emit_text(chr(code))
+        return index + 1
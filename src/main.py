@@ -15,6 +15,8 @@ import base64
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Literal, AsyncGenerator, Union
 import uuid
+import copy
+import hashlib
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Security
@@ -26,19 +28,40 @@ from utils import  (get_global_server_configs,
                     load_user_mcp_configs,
                     session_lock,
                     DDB_TABLE,
-                    save_user_server_config)
+                    save_user_server_config,
+                    flush_user_server_configs,
+                    config_writer)
 from security import validate_mcp_server_config, SecurityValidationError
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Security
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from mcp_client_strands import StrandsMCPClient
+from mcp_client_strands import StrandsMCPClient, get_mcp_server_pool
 from strands_agent_client_stream import StrandsAgentClientStream
 from fastapi import APIRouter
 from utils import is_endpoint_sse,save_stream_id,get_stream_id,active_streams,delete_stream_id,delete_user_session,get_user_session,save_user_session
 from data_types import *
 from health import router as health_router
+from agent_executor import get_agent_executor, shutdown_agent_executor
+from stream_watcher import get_stream_watcher
+from cluster_bus import get_cluster_bus, STREAM_CANCEL_CHANNEL
+from config_store import get_config_store, CONFIG_INVALIDATE_CHANNEL
+from session_expiry import SessionExpiry
+from session_memory import SessionMemory, get_content_store
+from session_ownership import (get_session_ownership, SESSION_ROUTING, OWNER_HEADER, OWNER_URL_HEADER,
+                               ROUTED_HEADER, ROUTING_MODES, CLUSTER_INSTANCE_ID)
+from session_snapshot import SessionSnapshot, session_entry, SESSION_PREWARM_COUNT
+import aiohttp
+from delta_coalescer import DeltaCoalescer
+from sse_encoder import ChunkEncoder, DONE_FRAME, HEARTBEAT_FRAME
+from stream_fanin import StreamFanIn
+from chat_aggregator import ChatAggregator
+from batch_chat import (BatchChatRunner, BatchCheckpoint, parse_jsonl, valid_batch_id,
+                        BATCH_CHAT_CONCURRENCY, BATCH_CHECKPOINT_DIR)
+from stream_metrics import StreamTimeline, get_stream_metrics
+from stream_replay import (get_replay_registry, ReplayGap, SUBSCRIBER_POLICIES,
+                           STREAM_SUBSCRIBER_POLICY, STREAM_SUBSCRIBER_MAX_LAG)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -59,6 +82,11 @@ user_sessions = {}
 
 MAX_TURNS = int(os.environ.get("MAX_TURNS",200))
 INACTIVE_TIME = int(os.environ.get("INACTIVE_TIME",60*24))  #mins
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL",10))  #seconds of idle before a heartbeat
+MCP_STARTUP_CONCURRENCY = max(1, int(os.environ.get("MCP_STARTUP_CONCURRENCY",4)))  #servers of one user started at once
+MCP_STARTUP_TIMEOUT = float(os.environ.get("MCP_STARTUP_TIMEOUT",30))  #seconds before a starting server is marked degraded
+MCP_STARTUP_RETRY_SECONDS = float(os.environ.get("MCP_STARTUP_RETRY_SECONDS",60))  #seconds before a failed server is retried
+MCP_STARTUP_DEADLINE = float(os.environ.get("MCP_STARTUP_DEADLINE",300))  #seconds before a degraded server is marked failed
 API_KEY = os.environ.get("API_KEY")
 
 security = HTTPBearer()
@@ -82,11 +110,15 @@ class UserSession:
             raise ValueError("Please go for MCP on Bedrock Version")
 
         self.mcp_clients = {}  # 用户特定的MCP客户端
+        # server_id -> 启动状态(queued/starting/ready/degraded/failed)、耗时和错误
+        self.server_status = {}
+        self.closed = False
         self.last_active = datetime.now()
         self.session_id = str(uuid.uuid4())
 
     async def cleanup(self):
         """清理用户会话资源"""
+        self.closed = True
         cleanup_tasks = []
         client_ids = list(self.mcp_clients.keys())
         for client_id in client_ids:
@@ -106,8 +138,89 @@ async def get_api_key(auth: HTTPAuthorizationCredentials = Security(security)):
     raise HTTPException(status_code=403, detail="Could not validate credentials")
 
             
+async def _connect_user_server(session: UserSession, server_id: str, config: dict, status: dict, shared: bool = False):
+    """连接一个MCP服务器，成功后加入会话并记录启动耗时；超过期限后才就绪的也会加入会话"""
+    started = time.monotonic()
+    try:
+        # 创建并连接MCP服务器
+        if shared:
+            # 全局服务器由共享池启动一次，各会话只持有租约
+            mcp_client = await get_mcp_server_pool().acquire(server_id, config, holder=session.user_id)
+        elif session.client_type == 'strands':
+            mcp_client = StrandsMCPClient(name=f"{session.user_id}_{server_id}")
+        else:
+            raise ValueError("only support client_type strands")
+        if not shared:
+            server_url = config.get('url',"")
+            
+            await mcp_client.connect_to_server(
+                server_id=server_id,
+                command=config.get('command'),
+                server_url=server_url,
+                http_type= "sse" if is_endpoint_sse(server_url) else "streamable_http" ,
+                token=config.get('token', None),
+                server_script_args=config.get("args", []),
+                server_script_envs=config.get("env", {})
+            )
+    except Exception as e:
+        startup_ms = (time.monotonic() - started) * 1000
+        status.update(status="failed", error=str(e), startup_ms=round(startup_ms, 2), finished=time.monotonic())
+        get_stream_metrics().observe("mcp_startup_failed_ms", server_id, startup_ms)
+        logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {e}")
+        return
+    
+    startup_ms = (time.monotonic() - started) * 1000
+    get_stream_metrics().observe("mcp_startup_ms", server_id, startup_ms)
+    if session.closed or server_id in session.mcp_clients:
+        # 会话在服务器启动期间已被清理，或该服务器已通过add_mcp_server加入
+        await mcp_client.cleanup()
+        return
+    status.update(status="ready", startup_ms=round(startup_ms, 2), finished=time.monotonic())
+    status.pop("error", None)
+    # 添加到用户的客户端列表
+    session.mcp_clients[server_id] = mcp_client
+    logger.info(f"User Id {session.user_id} initialize server {server_id} in {startup_ms:.0f} ms")
+    if shared:
+        # 共享的全局服务器不属于用户，不写入用户配置
+        return
+    # 配置未变化时不会写入，变化会合并后延迟写入
+    await save_user_server_config(session.user_id, server_id, config)
+
+async def _connect_user_server_until_deadline(session: UserSession, server_id: str, config: dict, status: dict,
+                                              shared: bool = False):
+    """启动超过MCP_STARTUP_DEADLINE秒的服务器被取消并标记为失败，之后可以重试"""
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(_connect_user_server(session, server_id, config, status, shared), MCP_STARTUP_DEADLINE)
+    except asyncio.TimeoutError:
+        if status["status"] == "ready":
+            return
+        startup_ms = (time.monotonic() - started) * 1000
+        status.update(status="failed", error=f"not ready after {MCP_STARTUP_DEADLINE}s",
+                      startup_ms=round(startup_ms, 2), finished=time.monotonic())
+        get_stream_metrics().observe("mcp_startup_failed_ms", server_id, startup_ms)
+        logger.error(f"User Id {session.user_id} server {server_id} not ready after {MCP_STARTUP_DEADLINE}s, marked failed")
+
+# 启动中的服务器任务，超时降级后在后台继续运行，保留引用以免被回收
+_server_starts = set()
+
+async def _start_user_server(session: UserSession, server_id: str, config: dict, semaphore: asyncio.Semaphore,
+                             shared: bool = False):
+    """在并发限制内启动一个MCP服务器，最多等待MCP_STARTUP_TIMEOUT秒"""
+    status = session.server_status[server_id]
+    async with semaphore:
+        status.update(status="starting", started_at=time.time())
+        connect = asyncio.create_task(_connect_user_server_until_deadline(session, server_id, config, status, shared))
+        _server_starts.add(connect)
+        connect.add_done_callback(_server_starts.discard)
+        done, _ = await asyncio.wait({connect}, timeout=MCP_STARTUP_TIMEOUT)
+    if not done:
+        # 超时的服务器在后台继续启动，在此之前不提供工具，也不再占用并发名额
+        status["status"] = "degraded"
+        logger.warning(f"User Id {session.user_id} server {server_id} not ready after {MCP_STARTUP_TIMEOUT}s, marked degraded")
+
 async def initialize_user_servers(session: UserSession):
-    """初始化用户特有的MCP服务器"""
+    """并发初始化用户特有的MCP服务器，失败或超时的服务器标记为降级，不阻塞会话"""
     user_id = session.user_id
     
     # 获取用户服务器配置（现在是异步方法）
@@ -118,37 +231,28 @@ async def initialize_user_servers(session: UserSession):
     server_configs = {**server_configs, **global_server_configs}
     
     logger.info(f"server_configs:{server_configs}")
-    # 初始化服务器连接
+    now = time.monotonic()
+    to_start = []
     for server_id, config in server_configs.items():
         if server_id in session.mcp_clients:  # 跳过已存在的服务器
-            logger.info(f"skip {server_id} initialization ")
             continue
-            
-        try:
-            # 创建并连接MCP服务器
-            if session.client_type == 'strands':
-                mcp_client = StrandsMCPClient(name=f"{session.user_id}_{server_id}")
-            else:
-                raise ValueError("only support client_type strands")
-            server_url = config.get('url',"")
-            
-            await mcp_client.connect_to_server(
-                server_id=server_id,
-                command=config.get('command'),
-                server_url=server_url,
-                http_type= "sse" if is_endpoint_sse(server_url) else "streamable_http" ,
-                token=config.get('token', None),
-                server_script_args=config.get("args", []),
-                server_script_envs=config.get("env", {})
-            )
-            
-            # 添加到用户的客户端列表
-            session.mcp_clients[server_id] = mcp_client
-            await save_user_server_config(user_id, server_id, config)
-            logger.info(f"User Id {session.user_id} initialize server {server_id}")
-            
-        except Exception as e:
-            logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {e}")
+        status = session.server_status.get(server_id)
+        if status and status["status"] in ("queued", "starting", "degraded"):
+            # 其他请求正在启动该服务器
+            continue
+        if status and status["status"] == "failed" and now - status["finished"] < MCP_STARTUP_RETRY_SECONDS:
+            continue
+        session.server_status[server_id] = {"status": "queued"}
+        # 无状态的全局服务器在所有会话间共享，用户自己的服务器保持隔离
+        shared = server_id in global_server_configs and get_mcp_server_pool().shareable(config)
+        to_start.append((server_id, config, shared))
+    
+    if not to_start:
+        return
+    # 初始化服务器连接，总耗时约为最慢的服务器而不是所有服务器之和
+    semaphore = asyncio.Semaphore(MCP_STARTUP_CONCURRENCY)
+    await asyncio.gather(*(_start_user_server(session, server_id, config, semaphore, shared)
+                           for server_id, config, shared in to_start))
     # 保存配置        
     # await save_user_mcp_configs()
 
@@ -186,36 +290,79 @@ async def get_or_create_user_session(
     # 更新最后活跃时间
     user_sessions[user_id].last_active = datetime.now()
     session = user_sessions[user_id]
+    with session_lock:
+        session_expiry.track(user_id)
     
     # 从ddb中取出配置，重新初始化，如果已经存在则跳过。
     await initialize_user_servers(session)
     return session
 
-async def cleanup_inactive_sessions():
-    """定期清理不活跃的用户会话"""
-    while True:
-        await asyncio.sleep(10)  # 每10s检查一次
-        current_time = datetime.now()
-        inactive_users = []
-        
-        # 找出不活跃的用户
-        with session_lock:
-            for user_id, session in user_sessions.items():
-                if (current_time - session.last_active) > timedelta(minutes=INACTIVE_TIME):
-                    inactive_users.append(user_id)
-        
-        for user_id in inactive_users:
-            with session_lock:
-                if user_id in user_sessions:
-                    session = user_sessions.pop(user_id)
-                    await delete_user_session(user_id)
-                    try:
-                        await session.cleanup()
-                    except Exception as e:
-                        logger.error(f"清理用户 {user_id} 会话失败: {e}")
-        
-        if inactive_users:
-            logger.info(f"已清理 {len(inactive_users)} 个不活跃用户会话")
+async def _remove_user_session(user_id: str, session: UserSession, reason: str):
+    """清理已移出本地会话表的会话；因不活跃过期的会话同时删除全局记录"""
+    try:
+        if reason == "inactive":
+            await delete_user_session(user_id)
+        await session.cleanup()
+    except Exception as e:
+        logger.error(f"清理用户 {user_id} 会话失败: {e}")
+
+# 按文本、二进制和工具结果统计每个会话的估算内存，超出预算时先把较早消息中的图片和文档转存到本地
+session_memory = SessionMemory(user_sessions, get_content_store())
+# 按last_active的最小堆调度会话过期，并限制本地会话数和估算内存，超出时先淘汰最久未活跃的会话
+session_expiry = SessionExpiry(user_sessions, _remove_user_session, inactive_seconds=INACTIVE_TIME * 60,
+                               estimate=session_memory.estimate)
+_memory_checks = set()
+
+def check_session_memory(user_id: str):
+    """请求结束后在后台检查会话内存预算"""
+    task = asyncio.get_running_loop().create_task(session_memory.enforce(session_expiry, user_id))
+    _memory_checks.add(task)
+    task.add_done_callback(_memory_checks.discard)
+# 关闭时写入本地会话快照，启动时按快照预热最近活跃的会话
+session_snapshot = SessionSnapshot(CLUSTER_INSTANCE_ID)
+
+async def _prewarm_user_session(entry: dict) -> bool:
+    """按快照条目重建一个用户会话并启动其MCP服务器；用户已有会话或全局会话已删除时跳过"""
+    user_id = entry["user_id"]
+    if DDB_TABLE and not await get_user_session(user_id):
+        return False
+    with session_lock:
+        if user_id in user_sessions:
+            return False
+        session = UserSession(user_id)
+        # 保留快照中的活跃时间，过期时间不因重启而延长
+        session.last_active = datetime.fromtimestamp(entry["last_active"])
+        messages = entry.get("history", {}).get("messages")
+        if messages:
+            session.chat_client.messages = messages
+        user_sessions[user_id] = session
+        session_expiry.track(user_id, keep=False)
+    await initialize_user_servers(session)
+    return True
+
+async def prewarm_user_sessions():
+    """后台预热快照中最近活跃的会话，路由开启时只预热归属本实例的用户"""
+    if SESSION_PREWARM_COUNT <= 0:
+        return
+    routed = SESSION_ROUTING in ("hint", "proxy")
+    entries = await asyncio.to_thread(session_snapshot.load, routed)
+    accept = get_session_ownership().is_local if routed else (lambda user_id: True)
+    limit = SESSION_PREWARM_COUNT
+    if session_expiry.max_sessions > 0:
+        limit = min(limit, session_expiry.max_sessions)
+    entries = SessionSnapshot.select(entries, session_expiry.inactive_seconds, limit, accept)
+    await session_snapshot.prewarm(entries, _prewarm_user_session)
+
+def write_session_snapshot():
+    """写入本地会话快照，须在清理会话之前调用"""
+    history_key = lambda session: f"{session.user_id}_messages" if DDB_TABLE else None
+    with session_lock:
+        entries = [session_entry(session, history_key(session)) for session in user_sessions.values()]
+    try:
+        session_snapshot.write(entries)
+        logger.info(f"已写入 {len(entries)} 个会话的快照: {session_snapshot.path}")
+    except Exception as e:
+        logger.error(f"写入会话快照失败: {e}")
 
 
 
@@ -232,11 +379,28 @@ async def lifespan(app: FastAPI):
     
 async def startup_event():
     """服务器启动时执行的任务"""
-    # 启动会话清理任务
-    asyncio.create_task(cleanup_inactive_sessions())
+    # 启动会话过期调度任务
+    asyncio.create_task(session_expiry.run())
+    # 定期删除长期未使用的转存内容
+    asyncio.create_task(session_memory.run())
+    # 订阅跨实例的停止流消息，收到后立即唤醒本地对应的流
+    bus = get_cluster_bus()
+    bus.subscribe(STREAM_CANCEL_CHANNEL, lambda stream_id: get_stream_watcher().cancel([stream_id]))
+    # 其他实例修改了用户MCP配置时，丢弃本地的会话和配置缓存
+    bus.subscribe(CONFIG_INVALIDATE_CHANNEL, get_config_store().on_invalidate_message)
+    bus.start()
+    # 加入会话所属实例的一致性哈希环并定期发送心跳
+    if SESSION_ROUTING in ("hint", "proxy"):
+        ownership = get_session_ownership()
+        await ownership.refresh()
+        asyncio.create_task(ownership.run())
+    # 在后台预热上次关闭时的活跃会话，不阻塞启动
+    asyncio.create_task(prewarm_user_sessions())
 
 async def shutdown_event():
     """服务器关闭时执行的任务"""
+    # 清理前记录会话快照，供重启后预热
+    write_session_snapshot()
     # 清理所有会话
     cleanup_tasks = []
     with session_lock:
@@ -246,6 +410,17 @@ async def shutdown_event():
     if cleanup_tasks:
         await asyncio.gather(*cleanup_tasks)
         logger.info(f"已清理所有 {len(cleanup_tasks)} 个用户会话")
+    # 停止共享的全局MCP服务器
+    await get_mcp_server_pool().close()
+    # 写入尚未保存的用户MCP配置
+    await flush_user_server_configs()
+    # 离开会话所属实例的哈希环，其用户由其余实例接管
+    if SESSION_ROUTING in ("hint", "proxy"):
+        await get_session_ownership().close()
+    # 停止agent执行器的工作线程和流取消检测线程
+    shutdown_agent_executor()
+    get_stream_watcher().stop()
+    get_cluster_bus().close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -278,11 +453,55 @@ app.add_middleware(
         "Authorization",
         "X-User-ID",
         "X-Stream-ID",
+        "Last-Event-ID",
         "Cache-Control"
     ],  # Only allow specific headers
+    expose_headers=[OWNER_HEADER, OWNER_URL_HEADER, "X-Stream-ID"],
     max_age=600,  # Cache preflight requests for 10 minutes
 )
 
+def _request_user_id(request: Request) -> Optional[str]:
+    """与get_or_create_user_session相同的用户ID：X-User-ID头，否则为Bearer凭证"""
+    user_id = request.headers.get("X-User-ID")
+    if user_id:
+        return user_id
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    return credentials if scheme.lower() == "bearer" and credentials else None
+
+async def route_to_session_owner(request: Request, call_next):
+    """把用户请求交给一致性哈希环上的所属实例，使其MCP服务器和agent保持在同一节点"""
+    path = request.url.path
+    if (not path.startswith("/v1/") or path.startswith("/v1/metrics/")
+            or request.headers.get(ROUTED_HEADER) or request.method == "OPTIONS"):
+        return await call_next(request)
+    user_id = _request_user_id(request)
+    if not user_id:
+        return await call_next(request)
+    ownership = get_session_ownership()
+    owner_id, owner_url = ownership.owner(user_id)
+    if owner_id != ownership.instance_id and owner_url:
+        if SESSION_ROUTING == "proxy":
+            try:
+                return await ownership.proxy(request, owner_url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 所属实例不可达时在本地处理，成员表刷新后会重新分配
+                ownership.proxy_failures += 1
+                logger.warning(f"转发用户 {user_id} 的请求到 {owner_id} 失败，本地处理: {e}")
+        response = await call_next(request)
+        ownership.hinted += 1
+        response.headers[OWNER_HEADER] = owner_id
+        response.headers[OWNER_URL_HEADER] = owner_url
+        return response
+    response = await call_next(request)
+    response.headers[OWNER_HEADER] = owner_id
+    return response
+
+if SESSION_ROUTING in ("hint", "proxy"):
+    # 只在开启路由时注册中间件，避免默认配置下给流式响应增加一层转发
+    app.middleware("http")(route_to_session_owner)
+elif SESSION_ROUTING not in ROUTING_MODES:
+    logger.warning(f"Unknown SESSION_ROUTING {SESSION_ROUTING}, session routing disabled")
+
 # 配置单独的路由组，确保停止路由不受streaming路由的并发限制影响
 stop_router = APIRouter()
 list_router = APIRouter()
@@ -327,6 +546,23 @@ async def list_mcp_server(
         "server_id": sid, 
         "server_name": name} for sid, name in server_list.items()]})
 
+@list_router.get("/v1/list/mcp_server_status")
+async def list_mcp_server_status(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """用户MCP服务器的启动状态和启动耗时，降级或失败的服务器不提供工具"""
+    session = await get_or_create_user_session(request, auth)
+    servers = []
+    for server_id, status in list(session.server_status.items()):
+        servers.append({
+            "server_id": server_id,
+            "status": "ready" if server_id in session.mcp_clients else status["status"],
+            "startup_ms": status.get("startup_ms"),
+            "error": status.get("error"),
+        })
+    return JSONResponse(content={"servers": servers})
+
 # 将stop_router包含在主应用中, 注意这个顺序必须在接口定义之后
 app.include_router(list_router)
 
@@ -401,6 +637,11 @@ async def stop_stream(
             logger.info(f"Removed {stream_id} from remote record")
         except Exception as e:
             logger.error(f"Error removing stream from active_streams: {e}")
+        # 通知所有实例立即停止该流，轮询检测作为兜底
+        try:
+            await asyncio.to_thread(get_cluster_bus().publish, STREAM_CANCEL_CHANNEL, stream_id)
+        except Exception as e:
+            logger.error(f"Error publishing stop for stream {stream_id}: {e}")
         return JSONResponse(
             content={"errno": 0, "msg": "Stream stopping initiated"},
             # 添加特殊的响应头，使浏览器不缓存此响应
@@ -461,6 +702,116 @@ async def stop_stream(
 app.include_router(stop_router)
 app.include_router(health_router)
 
+# 运行指标路由
+metrics_router = APIRouter()
+
+@metrics_router.get("/v1/metrics/agent_executor")
+async def agent_executor_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """Agent执行器的队列深度、等待时间和活跃worker指标"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_agent_executor().stats())
+
+@metrics_router.get("/v1/metrics/stream_watcher")
+async def stream_watcher_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """共享流取消检测器的指标"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_stream_watcher().stats())
+
+@metrics_router.get("/v1/metrics/session_ownership")
+async def session_ownership_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """会话所属实例的哈希环成员，以及提示和转发的请求数"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_session_ownership().stats())
+
+@metrics_router.get("/v1/metrics/sessions")
+async def session_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """本地会话数、估算内存、下一次过期时间、过期和淘汰次数以及快照预热情况"""
+    await get_api_key(auth)
+    return JSONResponse(content={**session_expiry.stats(), "snapshot": session_snapshot.stats()})
+
+@metrics_router.get("/v1/metrics/session_memory")
+async def session_memory_metrics(
+    top: int = 20,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """估算内存最大的top个会话按文本、二进制、工具结果等分类的字节数，以及转存和预算淘汰情况"""
+    await get_api_key(auth)
+    return JSONResponse(content={**session_memory.usage(top), **session_memory.stats(),
+                                 "global_budget": session_expiry.max_bytes})
+
+@metrics_router.get("/v1/metrics/mcp_pool")
+async def mcp_pool_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """共享全局MCP服务器的副本数、租约数、调用次数和并发限制情况"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_mcp_server_pool().stats())
+
+@metrics_router.get("/v1/metrics/config_cache")
+async def config_cache_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """本地会话和MCP配置缓存的命中率和失效次数，以及配置写回的合并和跳过次数"""
+    await get_api_key(auth)
+    return JSONResponse(content={**get_config_store().stats(), "writes": config_writer.stats()})
+
+@metrics_router.get("/v1/metrics/cluster_bus")
+async def cluster_bus_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """跨实例消息总线的指标"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_cluster_bus().stats())
+
+@metrics_router.get("/v1/metrics/stream_replay")
+async def stream_replay_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """可续传流的缓冲区指标"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_replay_registry().stats())
+
+@metrics_router.get("/v1/metrics/streams")
+async def stream_buffer_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """每个活跃流的通道缓冲区（事件数、估算字节数、溢出策略）和重放缓冲区字节数"""
+    await get_api_key(auth)
+    registry = get_replay_registry()
+    streams = []
+    for user_id, session in list(user_sessions.items()):
+        for stream_id, channel_stats in session.chat_client.stream_stats().items():
+            replay = registry.get(stream_id)
+            streams.append({
+                "stream_id": stream_id,
+                "user_id": user_id,
+                "channel": channel_stats,
+                "replay_buffered_bytes": replay.buffered_bytes if replay else 0,
+            })
+    return JSONResponse(content={
+        "streams": streams,
+        "channel_buffered_bytes": sum(stream["channel"]["buffered_bytes"] for stream in streams),
+        "replay_buffered_bytes": registry.stats()["buffered_bytes"],
+    })
+
+@metrics_router.get("/v1/metrics/latency")
+async def latency_metrics(
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """按模型统计的首token时间、token间隔、总耗时，以及按MCP服务器统计的工具耗时直方图"""
+    await get_api_key(auth)
+    return JSONResponse(content=get_stream_metrics().snapshot())
+
+app.include_router(metrics_router)
+
 @app.post("/v1/add/mcp_server")
 async def add_mcp_server(
     request: Request,
@@ -653,34 +1004,8 @@ async def remove_mcp_server(
         ).model_dump())
 
 
-async def stream_chat_response(data: ChatCompletionRequest, session: UserSession, stream_id: str = None) -> AsyncGenerator[str, None]:
-    """为特定用户生成流式聊天响应"""
-    
-    # 注册流
-    if stream_id:
-        try:
-            # 先在ChatClientStream中注册流，然后再添加到active_streams
-            await save_stream_id(stream_id=stream_id,user_id=session.user_id)
-            # logger.info(f"Stream {stream_id} registered for user {session.user_id}")
-            logger.info(f"active_streams:{active_streams}")
-        except Exception as e:
-            logger.error(f"Error registering stream {stream_id}: {e}")
-    
-    # 心跳任务控制
-    heartbeat_task = None
-    heartbeat_stop_event = asyncio.Event()
-    
-    async def heartbeat_sender():
-        """独立的心跳发送任务"""
-        try:
-            while not heartbeat_stop_event.is_set():
-                await asyncio.sleep(10)  # 每10秒发送一次心跳，减少频率
-                if not heartbeat_stop_event.is_set():
-                    logger.info("sse heartbeat")  # 改为debug级别，减少日志噪音
-                    yield ": heartbeat\n\n"
-        except asyncio.CancelledError:
-            pass
-    
+def _convert_request_messages(data: ChatCompletionRequest):
+    """把OpenAI格式的请求消息转换为Bedrock格式，返回 (messages, system)"""
     # Process messages with possible structured content
     messages = []
     for file_idx, msg in enumerate(data.messages):
@@ -786,11 +1111,36 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
     # bedrock's first turn cannot be assistant
     if messages and messages[0]['role'] == 'assistant':
         messages = messages[1:]
+    return messages, system
+
+
+async def stream_chat_response(data: ChatCompletionRequest, session: UserSession, stream_id: str = None,
+                               heartbeat_interval: Optional[float] = SSE_HEARTBEAT_INTERVAL,
+                               timeline: Optional[StreamTimeline] = None) -> AsyncGenerator[bytes, None]:
+    """为特定用户生成流式聊天响应"""
+    # 各阶段耗时记录，客户端通过 extra_params.include_timings 在最后一个chunk中获取汇总
+    timeline = timeline or StreamTimeline(data.model)
+    include_timings = bool(data.extra_params.get("include_timings"))
+    
+    # 注册流
+    if stream_id:
+        try:
+            # 先在ChatClientStream中注册流，然后再添加到active_streams
+            await save_stream_id(stream_id=stream_id,user_id=session.user_id)
+            # logger.info(f"Stream {stream_id} registered for user {session.user_id}")
+            logger.info(f"active_streams:{active_streams}")
+        except Exception as e:
+            logger.error(f"Error registering stream {stream_id}: {e}")
+    
+    # 可选的delta合并：在时间窗口或字节预算内把连续的delta合并为一帧
+    coalescer = DeltaCoalescer.from_params(data.extra_params)
+
+    # 每个流只序列化一次固定的chunk信封
+    encoder = ChunkEncoder(data.model)
+    
+    messages, system = _convert_request_messages(data)
     
     try:
-        current_content = ""
-        thinking_start = False
-        thinking_text_index = 0
         tooluse_start = False
 
         
@@ -808,154 +1158,133 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
             keep_session=data.keep_session,
             stream_id=stream_id,
             use_mem=data.use_mem,
-            use_swarm=data.extra_params.get("use_swarm",False)
-
+            use_swarm=data.extra_params.get("use_swarm",False),
+            timeline=timeline
         )
         
-        # 创建心跳生成器
-        heartbeat_gen = heartbeat_sender()
+        # 响应流汇入单个队列，心跳由定时器驱动：连续10秒没有事件时才发送
+        fanin = StreamFanIn(heartbeat_interval=heartbeat_interval, heartbeat_item=HEARTBEAT_FRAME)
+        fanin.add_source(response_stream)
+        coalesce_tick_scheduled = False
         
-        # 使用合并流来处理响应和心跳
-        async for item in _merge_streams(response_stream, heartbeat_gen):
+        async for item in fanin:
+            if item is _COALESCE_TICK:
+                coalesce_tick_scheduled = False
+                if coalescer.due():
+                    yield encoder.delta(*coalescer.flush())
+                elif coalescer.pending:
+                    fanin.call_later(coalescer.remaining(), _COALESCE_TICK)
+                    coalesce_tick_scheduled = True
+                continue
+
             if isinstance(item, dict):  # 来自 process_query_stream 的响应
                 response = item
+                if coalescer:
+                    delta = _coalescible_delta(response)
+                    if delta:
+                        if delta[0] == "toolinput_content":
+                            tooluse_start = True
+                        for ready in coalescer.add(*delta):
+                            yield encoder.delta(*ready)
+                        if coalescer.pending and not coalesce_tick_scheduled:
+                            # 只在有缓冲数据时安排一次刷新，空闲时没有定时唤醒
+                            fanin.call_later(coalescer.remaining(), _COALESCE_TICK)
+                            coalesce_tick_scheduled = True
+                        continue
+                    if coalescer.pending:
+                        # 其他事件（message_stop、工具结果、错误）之前先刷新，不延迟它们
+                        yield encoder.delta(*coalescer.flush())
                 # logger.info(f"{response}")
-                event_data = {
-                    "id": f"chat{time.time_ns()}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": data.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": None
-                    }]
-                }
+                delta = None
+                finish_reason = None
+                message_extras = None
                 
                 # 处理不同的事件类型
                 if response["type"] == "message_start":
-                    event_data["choices"][0]["delta"] = {"role": "assistant"}
+                    delta = {"role": "assistant"}
                     
                 elif response["type"] == "block_start":
                     block_start = response["data"]
                     if "toolUse" in block_start.get("start", {}):
-                        # text = f"<tool_name>{block_start["start"]["toolUse"]["name"]}</tool_name>"
-                        # event_data["choices"][0]["delta"] = {"content": text }
-                        event_data["choices"][0]["message_extras"] = {
+                        message_extras = {
                             "tool_name": block_start["start"]["toolUse"]["name"]
                         }
                     
                 elif response["type"] == "block_delta":
-                    if "text" in response["data"]["delta"]:
-                        text = ""
-                        # if thinking_text_index >= 1 and thinking_start:    
-                        #     thinking_start = False
-                        #     text = "</thinking>"
-                        text += response["data"]["delta"]["text"]
-                        current_content += text
-                        event_data["choices"][0]["delta"] = {"content": text}
-                        thinking_text_index = 0
+                    block_delta = response["data"]["delta"]
+                    if "text" in block_delta:
+                        # 文本token走快速路径
+                        yield encoder.delta("content", block_delta["text"])
+                        continue
                         
-                    if "toolUse" in response["data"]["delta"]:
-                        # text = ""
+                    if "toolUse" in block_delta:
                         if not tooluse_start:    
                             tooluse_start = True
-                        event_data["choices"][0]["delta"] = {"toolinput_content": response["data"]["delta"]["toolUse"]['input']}
+                        delta = {"toolinput_content": block_delta["toolUse"]['input']}
+                        if response["data"].get("toolinput_partial"):
+                            # 增量解析出的部分工具参数
+                            delta["toolinput_partial"] = response["data"]["toolinput_partial"]
                         
-                    if "reasoningContent" in response["data"]["delta"]:
-                        if 'text' in response["data"]["delta"]["reasoningContent"]:
-                            event_data["choices"][0]["delta"] = {"reasoning_content": response["data"]["delta"]["reasoningContent"]["text"]}
+                    if "reasoningContent" in block_delta:
+                        if 'text' in block_delta["reasoningContent"]:
+                            delta = {"reasoning_content": block_delta["reasoningContent"]["text"]}
                             
 
                 elif response["type"] == "block_stop":
                     if tooluse_start:
                         tooluse_start = False
-                        event_data["choices"][0]["delta"] = {"toolinput_content": "<END>"}
+                        delta = {"toolinput_content": "<END>"}
                         
                 elif response["type"] in [ "message_stop" ,"result_pairs"]:
-                    event_data["choices"][0]["finish_reason"] = response["data"]["stopReason"]
+                    finish_reason = response["data"]["stopReason"]
                     if response["data"].get("tool_results"):
-                        event_data["choices"][0]["message_extras"] = {
+                        message_extras = {
                             "tool_use": json.dumps(response["data"]["tool_results"],ensure_ascii=False)
                         }
 
                 elif response["type"] == "error":
-                    # 停止心跳任务
-                    heartbeat_stop_event.set()
-                    event_data["choices"][0]["finish_reason"] = "error"
-                    event_data["choices"][0]["delta"] = {
-                        "content": f"Error: {response['data']}"
-                    }
                      # 抛出异常
                     raise Exception(response['data'])
 
                 # 发送事件
-                yield f"data: {json.dumps(event_data)}\n\n"
+                yield encoder.chunk(delta, finish_reason, message_extras)
                     
                 # 手动停止流式响应
                 if response["type"] == "stopped":
-                    # 立即停止心跳任务
-                    heartbeat_stop_event.set()
-                    event_data = {
-                        "id": f"stop{time.time_ns()}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": data.model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {},
-                            "finish_reason": "stop_requested"
-                        }]
-                    }
-                    yield f"data: {json.dumps(event_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield encoder.chunk(finish_reason="stop_requested")
+                    if include_timings:
+                        yield encoder.extra(timings=timeline.final_summary())
+                    yield DONE_FRAME
                     break
                 
                 # 发送结束标记
                 if response["type"] == "message_stop" and response["data"]["stopReason"] in ['end_turn','max_tokens']:
-                    # 停止心跳任务
-                    heartbeat_stop_event.set()
                     if response["data"]["stopReason"] == 'max_tokens':
-                        event_data = {
-                            "id": f"stop{time.time_ns()}",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": data.model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content":"<max output token reached>"},
-                                "finish_reason": "max_tokens"
-                            }]
-                        }
-                        yield f"data: {json.dumps(event_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                        yield encoder.chunk({"content":"<max output token reached>"}, "max_tokens")
+                    if include_timings:
+                        yield encoder.extra(timings=timeline.final_summary())
+                    yield DONE_FRAME
                     break
                     
-            elif isinstance(item, str):  # 来自心跳的消息
+            elif isinstance(item, bytes):  # 来自心跳的消息
+                logger.info("sse heartbeat")
                 yield item
+
+        if coalescer and coalescer.pending:
+            yield encoder.delta(*coalescer.flush())
             
 
     except Exception as e:
         logger.error(f"Stream error for user {session.user_id}: {e}",exc_info=True)
         error_message = f"Stream processing error: {type(e).__name__} - {str(e)}"
 
-        error_data = {
-            "id": f"error{time.time_ns()}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": data.model,
-            "choices": [{
-                "index": 0,
-                "delta": {"content": f"Error: {error_message}"},
-                "finish_reason": "error"
-            }]
-        }
-        yield f"data: {json.dumps(error_data)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield encoder.chunk({"content": f"Error: {error_message}"}, "error")
+        if include_timings:
+            yield encoder.extra(timings=timeline.final_summary())
+        yield DONE_FRAME
         
     finally:
-        # 停止心跳任务
-        heartbeat_stop_event.set()
+        timeline.finish()
         # 清除活跃流列表中的请求
         try:
             if stream_id:
@@ -965,94 +1294,72 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                 logger.info(f"Stream {stream_id} unregistered")
         except Exception as e:
             logger.error(f"Error cleaning up stream {stream_id}: {e}")
+        check_session_memory(session.user_id)
 
 
-async def _merge_streams(*streams):
-    """合并多个异步生成器流"""
-    import asyncio
-    from collections import deque
-    
-    # 创建队列来存储每个流的状态
-    stream_tasks = []
-    for stream in streams:
-        stream_iter = aiter(stream)
-        task = asyncio.create_task(anext(stream_iter, StopAsyncIteration))
-        stream_tasks.append((task, stream_iter))
-    
+_COALESCE_TICK = object()
+
+def _coalescible_delta(response: dict):
+    """返回可合并的 (delta字段名, 文本)，不可合并时返回None"""
+    if response["type"] != "block_delta":
+        return None
+    delta = response["data"]["delta"]
+    if "text" in delta:
+        return "content", delta["text"]
+    if "toolUse" in delta:
+        if response["data"].get("toolinput_partial"):
+            return None
+        return "toolinput_content", delta["toolUse"]["input"]
+    if "reasoningContent" in delta and "text" in delta["reasoningContent"]:
+        return "reasoning_content", delta["reasoningContent"]["text"]
+    return None
+
+async def complete_chat_response(data: ChatCompletionRequest, session: UserSession, stream_id: str,
+                                 timeline: Optional[StreamTimeline] = None) -> dict:
+    """非流式响应：运行同样的agent流程，直接累积文本、思考内容和工具调用，不做SSE分帧和心跳"""
+    timeline = timeline or StreamTimeline(data.model)
     try:
-        while stream_tasks:
-            # 等待任何一个流产生结果，使用较短的超时时间以便更快响应停止信号
-            done, pending = await asyncio.wait(
-                [task for task, _ in stream_tasks],
-                return_when=asyncio.FIRST_COMPLETED,
-                timeout=0.1  # 添加超时以便更快响应停止信号
-            )
-            
-            # 处理完成的任务
-            new_stream_tasks = []
-            main_stream_ended = False
-            
-            for task, stream_iter in stream_tasks:
-                if task in done:
-                    try:
-                        result = await task
-                        if result is not StopAsyncIteration:
-                            yield result
-                            # 检查是否是主要流（agent stream）的真正结束信号
-                            # 只有在明确的结束条件下才停止所有流
-                            if isinstance(result, dict):
-                                result_type = result.get("type")
-                                if result_type == "stopped":
-                                    main_stream_ended = True
-                                elif result_type == "message_stop":
-                                    stop_reason = result.get("data", {}).get("stopReason")
-                                    if stop_reason in ['end_turn', 'max_tokens']:
-                                        main_stream_ended = True
-                                elif result_type == "error":
-                                    main_stream_ended = True
-                            # 创建新任务来获取下一个值
-                            new_task = asyncio.create_task(anext(stream_iter, StopAsyncIteration))
-                            new_stream_tasks.append((new_task, stream_iter))
-                        # 如果结果是 StopAsyncIteration，该流已结束，不重新添加
-                    except StopAsyncIteration:
-                        # 流已结束
-                        pass
-                    except Exception as e:
-                        logger.error(f"Error in merged stream task: {e}")
-                        # 取消所有正在运行和新添加的任务
-                        for t, _ in stream_tasks:
-                            if not t.done():
-                                t.cancel()
-                        for t, _ in new_stream_tasks:
-                            if not t.done():
-                                t.cancel()
-                        # 把异常继续向外抛出
-                        raise
-            
-                else:
-                    # 任务仍在运行
-                    new_stream_tasks.append((task, stream_iter))
-                    
-            stream_tasks = new_stream_tasks
-            
-            # 如果主要流已结束，立即退出循环
-            if main_stream_ended:
-                logger.info("Main stream ended, stopping all streams")
-                break
-            
+        await save_stream_id(stream_id=stream_id, user_id=session.user_id)
     except Exception as e:
-        logger.error(f"Error in _merge_streams: {e}")
-        # 把异常继续向外抛出
-        raise
+        logger.error(f"Error registering stream {stream_id}: {e}")
+
+    messages, system = _convert_request_messages(data)
+    aggregator = ChatAggregator()
+    try:
+        async for event in session.chat_client.process_query_stream(
+            model_id=data.model,
+            max_tokens=data.max_tokens,
+            temperature=data.temperature,
+            messages=messages,
+            system=system,
+            max_turns=MAX_TURNS,
+            mcp_clients=session.mcp_clients,
+            mcp_server_ids=data.mcp_server_ids,
+            extra_params=data.extra_params,
+            keep_session=data.keep_session,
+            stream_id=stream_id,
+            use_mem=data.use_mem,
+            use_swarm=data.extra_params.get("use_swarm",False),
+            timeline=timeline
+        ):
+            aggregator.add(event)
     finally:
-        # 清理所有剩余的任务
-        for task, _ in stream_tasks:
-            if not task.done():
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
+        timeline.finish()
+        try:
+            session.chat_client.unregister_stream(stream_id)
+            await delete_stream_id(stream_id)
+        except Exception as e:
+            logger.error(f"Error cleaning up stream {stream_id}: {e}")
+        check_session_memory(session.user_id)
+
+    if aggregator.error is not None:
+        logger.error(f"Chat error for user {session.user_id}: {aggregator.error}")
+        raise HTTPException(status_code=500, detail=f"Chat processing error: {aggregator.error}")
+    result = ChatResponse(**aggregator.response(data.model)).model_dump()
+    if data.extra_params.get("include_timings"):
+        result["timings"] = timeline.summary()
+    return result
+
 
 @app.post("/v1/chat/completions")
 async def chat_completions(
@@ -1061,8 +1368,10 @@ async def chat_completions(
     background_tasks: BackgroundTasks,
     auth: HTTPAuthorizationCredentials = Security(security)
 ):
+    timeline = StreamTimeline(data.model)
     # 获取用户会话
     session = await get_or_create_user_session(request, auth)
+    timeline.mark("session_ready")
     # 记录会话活动
     session.last_active = datetime.now()
 
@@ -1085,14 +1394,135 @@ async def chat_completions(
     if data.stream:
         # 为流式请求生成唯一ID
         stream_id = f"stream_{session.user_id}_{time.time_ns()}"
+        # 响应在后台任务中生成并写入可重放的缓冲区，连接断开后可通过 /v1/chat/stream/{stream_id} 续传
+        # 心跳由每个订阅者自己发送，不写入缓冲区
+        registry = get_replay_registry()
+        buffer = registry.start(stream_id, session.user_id,
+                                stream_chat_response(data, session, stream_id, heartbeat_interval=None,
+                                                     timeline=timeline))
         return StreamingResponse(
-            stream_chat_response(data, session, stream_id),
+            registry.attach(buffer, 0, SSE_HEARTBEAT_INTERVAL, HEARTBEAT_FRAME),
             media_type="text/event-stream",
             headers={"X-Stream-ID": stream_id}  # 添加流ID到响应头，便于前端跟踪
         )
     else:
-        logger.error(f"Only support stream")
-        raise HTTPException(status_code=500, detail="Only support stream")
+        # 非流式请求，适合批处理和服务间调用
+        stream_id = f"stream_{session.user_id}_{time.time_ns()}"
+        result = await complete_chat_response(data, session, stream_id, timeline=timeline)
+        return JSONResponse(content=result, headers={"X-Stream-ID": stream_id})
+
+
+@app.get("/v1/chat/stream/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """
+    断线重连或附加订阅：从Last-Event-ID之后的事件继续推送，先重放缓冲区再跟随实时输出。
+    同一个流可以有多个订阅者（多个标签页、监控视图），各自独立的游标，共享同一个agent输出。
+    查询参数 policy=disconnect|skip 和 max_lag 控制订阅者落后太多时的处理方式。
+    """
+    await get_api_key(auth)
+    user_id = request.headers.get("X-User-ID", auth.credentials)
+    registry = get_replay_registry()
+    buffer = registry.get(stream_id)
+    if buffer is None or buffer.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Stream not found or already expired")
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.query_params.get("last_event_id") or "0"
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid Last-Event-ID: {last_event_id}")
+    policy = request.query_params.get("policy", STREAM_SUBSCRIBER_POLICY)
+    if policy not in SUBSCRIBER_POLICIES:
+        raise HTTPException(status_code=400, detail=f"policy must be one of {SUBSCRIBER_POLICIES}")
+    try:
+        max_lag = int(request.query_params.get("max_lag", STREAM_SUBSCRIBER_MAX_LAG))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="max_lag must be an integer")
+    try:
+        buffer.frames_after(last_event_id)
+    except ReplayGap as e:
+        # 请求的事件已经被环形缓冲区淘汰，客户端需要重新发起对话
+        raise HTTPException(status_code=410, detail=str(e))
+
+    return StreamingResponse(
+        registry.attach(buffer, last_event_id, SSE_HEARTBEAT_INTERVAL, HEARTBEAT_FRAME,
+                        policy=policy, max_lag=max_lag),
+        media_type="text/event-stream",
+        headers={"X-Stream-ID": stream_id}
+    )
+
+
+@app.get("/v1/chat/streams")
+async def list_chat_streams(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """列出当前用户在本实例上可附加的流，以及每个流的订阅者游标"""
+    await get_api_key(auth)
+    user_id = request.headers.get("X-User-ID", auth.credentials)
+    return JSONResponse(content={"streams": get_replay_registry().list_streams(user_id)})
+
+
+@app.post("/v1/batch/chat")
+async def batch_chat(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """
+    批量对话：请求体为JSONL，每行一个ChatCompletionRequest（可带custom_id）。
+    在有界的worker池中运行，按完成顺序以JSONL流式返回结果和耗时；
+    结果写入本地checkpoint，使用相同的batch_id重新提交即可续跑。
+    """
+    session = await get_or_create_user_session(request, auth)
+    batch_id = request.query_params.get("batch_id") or request.headers.get("X-Batch-ID") or uuid.uuid4().hex
+    if not valid_batch_id(batch_id):
+        raise HTTPException(status_code=400, detail="batch_id may only contain letters, digits, '_', '-' and '.'")
+    try:
+        concurrency = int(request.query_params.get("concurrency", BATCH_CHAT_CONCURRENCY))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="concurrency must be an integer")
+
+    body = (await request.body()).decode("utf-8")
+    items = parse_jsonl(body, lambda obj: ChatCompletionRequest(**{**obj, "stream": False}))
+    if not items:
+        raise HTTPException(status_code=400, detail="Empty batch")
+
+    # 每个worker一个独立的chat client：不读写会话历史，共享用户会话的MCP客户端和模型客户端缓存
+    model_cache = {}
+    workers: Dict[int, UserSession] = {}
+
+    def worker_session(worker: int) -> UserSession:
+        if worker not in workers:
+            worker_session = copy.copy(session)
+            worker_session.chat_client = StrandsAgentClientStream(
+                user_id=session.user_id,
+                model_provider=os.environ.get('STRANDS_MODEL_PROVIDER', 'bedrock'),
+                api_key=os.environ.get('OPENAI_API_KEY'),
+                api_base=os.environ.get('OPENAI_BASE_URL')
+            )
+            worker_session.chat_client.persist_history = False
+            worker_session.chat_client.model_cache = model_cache
+            workers[worker] = worker_session
+        return workers[worker]
+
+    async def run_item(worker: int, data: ChatCompletionRequest) -> dict:
+        session.last_active = datetime.now()
+        stream_id = f"stream_{session.user_id}_{time.time_ns()}"
+        return await complete_chat_response(data, worker_session(worker), stream_id)
+
+    os.makedirs(BATCH_CHECKPOINT_DIR, exist_ok=True)
+    user_key = hashlib.sha1(session.user_id.encode("utf-8")).hexdigest()[:12]
+    checkpoint = BatchCheckpoint(os.path.join(BATCH_CHECKPOINT_DIR, f"{user_key}_{batch_id}.jsonl"))
+    runner = BatchChatRunner(batch_id, items, run_item, concurrency=concurrency, checkpoint=checkpoint)
+    return StreamingResponse(
+        runner.run(),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-ID": batch_id}
+    )
 
 
 def generate_self_signed_cert(cert_dir='certificates'):
@@ -1130,11 +1560,56 @@ def generate_self_signed_cert(cert_dir='certificates'):
         logger.error("未找到OpenSSL。请安装OpenSSL以生成证书。")
         return None, None
 
-if __name__ == '__main__':
+def load_mcp_conf(path):
+    """加载全局MCP服务器和模型配置"""
+    if not path:
+        return
+    with open(path, 'r') as f:
+        conf = json.load(f)
+        # 加载全局MCP服务器配置
+        for server_id, server_conf in conf.get('mcpServers', {}).items():
+            if server_conf.get('status') == 0:
+                continue
+            shared_mcp_server_list[server_id] = server_conf.get('description', server_id)
+            save_global_server_config(server_id, server_conf)
+
+        # 加载模型配置
+        for model_conf in conf.get('models', []):
+            llm_model_list[model_conf['model_id']] = model_conf['model_name']
+
+
+def serve(config_kwargs, sockets=None):
+    """运行uvicorn直到退出；sockets为None时按host和port自行监听"""
     import uvicorn
+    loop = asyncio.new_event_loop()
+    try:
+        config = uvicorn.Config(app=app, loop=loop, **config_kwargs)
+        server = uvicorn.Server(config)
+        loop.run_until_complete(server.serve(sockets=sockets))
+    finally:
+        # 确保退出时清理资源并保存用户配置
+        cleanup_tasks = []
+        for user_id, session in user_sessions.items():
+            cleanup_tasks.append(session.cleanup())
+        
+        if cleanup_tasks:
+            loop.run_until_complete(asyncio.gather(*cleanup_tasks))
+        loop.close()
+
+
+def run_worker(index, sockets, config_kwargs, mcp_conf):
+    """多进程模式下worker进程的入口，在supervisor传入的公共socket和私有socket上提供服务"""
+    logger.info(f"Worker {index} (pid {os.getpid()}) 启动")
+    load_mcp_conf(mcp_conf)
+    serve(config_kwargs, sockets)
+
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='127.0.0.1')
     parser.add_argument('--port', type=int, default=7002)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)),
+                       help="worker进程数，大于1时多个进程共享同一监听端口，按user_id分配会话")
     parser.add_argument('--mcp-conf', default='', help="the mcp servers json config file")
     parser.add_argument('--user-conf', default='conf/user_mcp_configs.json',
                        help="用户MCP服务器配置文件路径")
@@ -1147,66 +1622,47 @@ if __name__ == '__main__':
     # 设置用户配置文件路径环境变量
     os.environ['USER_MCP_CONFIG_FILE'] = args.user_conf
     
-    try:
-        loop = asyncio.new_event_loop()
-
-        if args.mcp_conf:
-            with open(args.mcp_conf, 'r') as f:
-                conf = json.load(f)
-                # 加载全局MCP服务器配置
-                for server_id, server_conf in conf.get('mcpServers', {}).items():
-                    if server_conf.get('status') == 0:
-                        continue
-                    shared_mcp_server_list[server_id] = server_conf.get('description', server_id)
-                    save_global_server_config(server_id, server_conf)
-
-                # 加载模型配置
-                for model_conf in conf.get('models', []):
-                    llm_model_list[model_conf['model_id']] = model_conf['model_name']
-        
-        # 配置HTTPS
-        ssl_keyfile = None
-        ssl_certfile = None
-        
-        if args.https:
-            if args.ssl_keyfile and args.ssl_certfile:
-                ssl_keyfile = args.ssl_keyfile
-                ssl_certfile = args.ssl_certfile
-                logger.info(f"使用指定的SSL证书: {ssl_certfile} 和密钥: {ssl_keyfile}")
-            else:
-                ssl_keyfile, ssl_certfile = generate_self_signed_cert(args.cert_dir)
-                if not ssl_keyfile or not ssl_certfile:
-                    logger.warning("无法生成SSL证书，将使用HTTP而非HTTPS")
-        
-        # 配置uvicorn
-        config_kwargs = {
-            "app": app,
-            "host": args.host,
-            "port": args.port,
-            "loop": loop,
-            "timeout_keep_alive": 3600,  # 设置为1小时或更长
-            "limit_concurrency": 100,  # 限制并发连接数
-            "limit_max_requests": 1000,  # 限制最大请求数
-            "timeout_graceful_shutdown": 30  # 优雅关闭超时
-        }
-        
-        # 如果启用HTTPS且有有效证书，添加SSL配置
-        if args.https and ssl_keyfile and ssl_certfile:
-            config_kwargs["ssl_keyfile"] = ssl_keyfile
-            config_kwargs["ssl_certfile"] = ssl_certfile
-            logger.info(f"启用HTTPS，服务器将在 https://{args.host}:{args.port} 上运行")
+    # 配置HTTPS
+    ssl_keyfile = None
+    ssl_certfile = None
+    
+    if args.https:
+        if args.ssl_keyfile and args.ssl_certfile:
+            ssl_keyfile = args.ssl_keyfile
+            ssl_certfile = args.ssl_certfile
+            logger.info(f"使用指定的SSL证书: {ssl_certfile} 和密钥: {ssl_keyfile}")
         else:
-            logger.info(f"使用HTTP，服务器将在 http://{args.host}:{args.port} 上运行")
-        
-        config = uvicorn.Config(**config_kwargs)
-        server = uvicorn.Server(config)
-        loop.run_until_complete(server.serve())
-    finally:
-        # 确保退出时清理资源并保存用户配置
-        cleanup_tasks = []
-        for user_id, session in user_sessions.items():
-            cleanup_tasks.append(session.cleanup())
-        
-        if cleanup_tasks:
-            loop.run_until_complete(asyncio.gather(*cleanup_tasks))
-        loop.close()
+            ssl_keyfile, ssl_certfile = generate_self_signed_cert(args.cert_dir)
+            if not ssl_keyfile or not ssl_certfile:
+                logger.warning("无法生成SSL证书，将使用HTTP而非HTTPS")
+    
+    # 配置uvicorn
+    config_kwargs = {
+        "host": args.host,
+        "port": args.port,
+        "timeout_keep_alive": 3600,  # 设置为1小时或更长
+        "limit_concurrency": 100,  # 限制并发连接数
+        "limit_max_requests": 1000,  # 限制最大请求数
+        "timeout_graceful_shutdown": 30  # 优雅关闭超时
+    }
+    
+    # 如果启用HTTPS且有有效证书，添加SSL配置
+    use_https = bool(args.https and ssl_keyfile and ssl_certfile)
+    if use_https:
+        config_kwargs["ssl_keyfile"] = ssl_keyfile
+        config_kwargs["ssl_certfile"] = ssl_certfile
+        logger.info(f"启用HTTPS，服务器将在 https://{args.host}:{args.port} 上运行")
+    else:
+        logger.info(f"使用HTTP，服务器将在 http://{args.host}:{args.port} 上运行")
+    
+    if args.workers > 1:
+        # 多进程模式：worker进程重新导入本模块，各自加载配置；worker异常退出或
+        # 达到limit_max_requests后由supervisor重启
+        from worker_pool import WorkerPool
+        pool = WorkerPool(run_worker, args.workers, args.host, args.port,
+                          scheme="https" if use_https else "http",
+                          args=(config_kwargs, args.mcp_conf))
+        pool.run()
+    else:
+        load_mcp_conf(args.mcp_conf)
+        serve(config_kwargs)
@@ -8,15 +8,20 @@ This module provides MCP server management specifically for Strands agents.
 """
 import os
 import json
+import time
+import hashlib
 import logging
 import asyncio
-from typing import Dict, List, Optional, Any
+import threading
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Any, Tuple
 from mcp import StdioServerParameters, stdio_client
 from mcp.client.sse import sse_client
 from mcp.client.streamable_http import streamablehttp_client
 from strands.tools.mcp import MCPClient
 from strands.types.tools import AgentTool
 from dotenv import load_dotenv
+from utils import is_endpoint_sse
 
 load_dotenv()  # load environment variables from .env
 
@@ -26,6 +31,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Global servers are started once per process and shared by all sessions, unless their config has "shared": false
+MCP_SHARE_GLOBAL_SERVERS = os.environ.get("MCP_SHARE_GLOBAL_SERVERS", "true").lower() != "false"
+# Processes per shared server, overridable with "replicas" in its config
+MCP_SHARED_REPLICAS = max(1, int(os.environ.get("MCP_SHARED_REPLICAS", 1)))
+# Tool calls in flight per shared server across all sessions, overridable with "max_concurrency"
+MCP_SHARED_MAX_CONCURRENCY = max(1, int(os.environ.get("MCP_SHARED_MAX_CONCURRENCY", 8)))
+
 class StrandsMCPClient:
     """
     MCP Client manager for Strands Agents SDK
@@ -37,6 +49,9 @@ class StrandsMCPClient:
     - Converting tools to Strands format
     """
     
+    # True for handles on a server of the shared pool
+    shared = False
+
     def __init__(self, name: str = "strands_mcp_client"):
         """Initialize the Strands MCP client manager"""
         self.name = name
@@ -133,8 +148,17 @@ class StrandsMCPClient:
             # Store active client
             self.active_clients[server_id] = mcp_client
             
-            # start server
-            mcp_client.start()
+            # start server; MCPClient.start blocks until the server is initialized,
+            # so run it on a thread to let several servers start concurrently
+            start = asyncio.ensure_future(asyncio.to_thread(mcp_client.start))
+            try:
+                await asyncio.shield(start)
+            except asyncio.CancelledError:
+                # the start thread can not be interrupted, stop the client once it returns
+                self.active_clients.pop(server_id, None)
+                self.servers.pop(server_id, None)
+                start.add_done_callback(lambda task: self._stop_abandoned(server_id, mcp_client, task))
+                raise
             
             logger.info(f"Connected to MCP server: {server_id}")
             
@@ -142,6 +166,14 @@ class StrandsMCPClient:
             logger.error(f"Failed to connect to MCP server {server_id}: {e}")
             raise
     
+    @staticmethod
+    def _stop_abandoned(server_id: str, mcp_client: MCPClient, start: asyncio.Future):
+        """Stop a client whose connect was cancelled while it was starting"""
+        if start.cancelled() or start.exception() is not None:
+            return
+        logger.info(f"Stopping MCP server {server_id} that finished starting after its connect was cancelled")
+        asyncio.get_running_loop().run_in_executor(None, mcp_client.stop, None, None, None)
+    
     async def disconnect_from_server(self, server_id: str):
         """
         Disconnect from an MCP server
@@ -285,6 +317,316 @@ class StrandsMCPClient:
         """
         return list(self.active_clients.keys())
 
+    async def connect_with_config(self, server_id: str, config: Dict[str, Any]):
+        """Connect to a server described by a user or global MCP server config"""
+        server_url = config.get('url', "")
+        await self.connect_to_server(
+            server_id=server_id,
+            command=config.get('command'),
+            server_url=server_url,
+            http_type="sse" if is_endpoint_sse(server_url) else "streamable_http",
+            token=config.get('token', None),
+            server_script_args=config.get("args", []),
+            server_script_envs=config.get("env", {})
+        )
+
+
+class CrossLoopLimiter:
+    """
+    Async semaphore usable from several event loops at once.
+
+    Agents run on the executor threads, each with its own loop, so an
+    asyncio.Semaphore can not bound calls across them. Waiters are woken
+    in FIFO order on their own loop; a slot granted to a waiter that was
+    cancelled meanwhile is passed on.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._lock = threading.Lock()
+        self.waited = 0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+            self.waited += 1
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            if waiter[1].done() and not waiter[1].cancelled():
+                # granted just before the cancellation landed
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    # the slot moves to the waiter, _active is unchanged
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    # its loop is closed
+                    continue
+            self._active -= 1
+
+    def _grant(self, future: asyncio.Future):
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"limit": self.limit, "active": self._active, "waiting": len(self._waiters), "waited": self.waited}
+
+
+class _SharedTool(AgentTool):
+    """Tool of a shared server; each call goes to the least busy replica within the server's limit"""
+
+    def __init__(self, server: "SharedMCPServer", tool: AgentTool):
+        super().__init__()
+        self._server = server
+        self._tool = tool
+
+    @property
+    def tool_name(self) -> str:
+        return self._tool.tool_name
+
+    @property
+    def tool_spec(self):
+        return self._tool.tool_spec
+
+    @property
+    def tool_type(self) -> str:
+        return self._tool.tool_type
+
+    async def stream(self, tool_use, invocation_state, **kwargs):
+        async for event in self._server.call(self.tool_name, tool_use, invocation_state, **kwargs):
+            yield event
+
+
+class SharedMCPServer:
+    """
+    `replicas` processes of one global server, shared by every session.
+
+    Calls from all sessions are multiplexed over the replicas' MCP sessions,
+    which already run concurrent requests, with at most `max_concurrency`
+    in flight in total.
+    """
+
+    def __init__(self, server_id: str, config: Dict[str, Any], key: str, replicas: int, max_concurrency: int):
+        self.server_id = server_id
+        self.config = config
+        self.key = key
+        self.replicas = replicas
+        self.limiter = CrossLoopLimiter(max_concurrency)
+        self.clients: List[StrandsMCPClient] = []
+        self.tools: List[AgentTool] = []
+        self._replica_tools: List[Dict[str, AgentTool]] = []
+        self._inflight: List[int] = []
+        self._lock = threading.Lock()
+        self.leases = 0
+        self.retired = False
+        self.calls = 0
+        self.errors = 0
+        self.started_at: Optional[float] = None
+
+    async def start(self):
+        clients = [StrandsMCPClient(name=f"shared_{self.server_id}_{index}") for index in range(self.replicas)]
+        results = await asyncio.gather(*(client.connect_with_config(self.server_id, self.config)
+                                         for client in clients), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await asyncio.gather(*(client.cleanup() for client in clients), return_exceptions=True)
+            raise errors[0]
+        self._replica_tools = [{tool.tool_name: tool for tool in await asyncio.to_thread(client.get_tools, self.server_id)}
+                               for client in clients]
+        self.clients = clients
+        self._inflight = [0] * len(clients)
+        # replicas may list different tools, e.g. while a server is upgraded; calls only go to replicas having the tool
+        tools: Dict[str, AgentTool] = {}
+        for replica_tools in self._replica_tools:
+            for name, tool in replica_tools.items():
+                tools.setdefault(name, tool)
+        self.tools = [_SharedTool(self, tool) for tool in tools.values()]
+        self.started_at = time.time()
+        logger.info(f"Started shared MCP server {self.server_id}: {len(clients)} replicas, "
+                    f"{len(self.tools)} tools, {self.limiter.limit} concurrent calls")
+
+    def _alive(self, index: int) -> bool:
+        mcp_client = self.clients[index].active_clients.get(self.server_id)
+        is_active = getattr(mcp_client, "_is_session_active", None)
+        return mcp_client is not None and (is_active is None or is_active())
+
+    def _pick(self, tool_name: str) -> int:
+        with self._lock:
+            having = [index for index in range(len(self.clients)) if tool_name in self._replica_tools[index]]
+            alive = [index for index in having if self._alive(index)] or having
+            index = min(alive, key=lambda i: self._inflight[i])
+            self._inflight[index] += 1
+            return index
+
+    async def call(self, tool_name: str, tool_use, invocation_state, **kwargs) -> AsyncIterator[Any]:
+        async with self.limiter:
+            index = self._pick(tool_name)
+            try:
+                async for event in self._replica_tools[index][tool_name].stream(tool_use, invocation_state, **kwargs):
+                    if isinstance(event, dict) and event.get("status") == "error":
+                        self.errors += 1
+                    yield event
+                self.calls += 1
+            finally:
+                with self._lock:
+                    self._inflight[index] -= 1
+
+    async def stop(self):
+        await asyncio.gather(*(client.cleanup() for client in self.clients), return_exceptions=True)
+        self.clients = []
+        logger.info(f"Stopped shared MCP server {self.server_id}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            inflight = list(self._inflight)
+        return {"replicas": len(self.clients), "leases": self.leases, "tools": len(self.tools),
+                "calls": self.calls, "errors": self.errors, "inflight": inflight, "retired": self.retired,
+                "limiter": self.limiter.stats(), "started_at": self.started_at}
+
+
+class SharedMCPClient(StrandsMCPClient):
+    """A session's lease on a shared server; cleanup releases the lease instead of stopping the server"""
+
+    shared = True
+
+    def __init__(self, pool: "MCPServerPool", server: SharedMCPServer, name: str):
+        super().__init__(name=name)
+        self._pool = pool
+        self._server = server
+        self.servers[server.server_id] = {'url': server.config.get('url', ''), 'command': server.config.get('command', ''),
+                                          'args': server.config.get('args', []), 'shared': True}
+        self.active_clients[server.server_id] = server
+
+    async def connect_to_server(self, server_id: str, *args, **kwargs):
+        raise RuntimeError(f"{self.name} is a handle on the shared server {self._server.server_id}")
+
+    def get_tools(self, server_id: str) -> List[AgentTool]:
+        if server_id not in self.active_clients:
+            logger.error(f"Server {server_id} not active")
+            return []
+        return list(self._server.tools)
+
+    async def disconnect_from_server(self, server_id: str):
+        if self.active_clients.pop(server_id, None) is not None:
+            self.servers.pop(server_id, None)
+            await self._pool.release(self._server)
+
+
+class MCPServerPool:
+    """Shared servers by server id; a changed config starts a new server and retires the old one"""
+
+    def __init__(self, replicas: int = MCP_SHARED_REPLICAS, max_concurrency: int = MCP_SHARED_MAX_CONCURRENCY):
+        self.replicas = replicas
+        self.max_concurrency = max_concurrency
+        self._servers: Dict[str, SharedMCPServer] = {}
+        self._starting: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._retired: List[SharedMCPServer] = []
+        self.start_failures = 0
+
+    @staticmethod
+    def shareable(config: Dict[str, Any]) -> bool:
+        return MCP_SHARE_GLOBAL_SERVERS and config.get("shared", True) is not False
+
+    @staticmethod
+    def _key(config: Dict[str, Any]) -> str:
+        return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def _start(self, server_id: str, config: Dict[str, Any], key: str) -> SharedMCPServer:
+        server = SharedMCPServer(server_id, config, key, max(1, int(config.get("replicas", self.replicas))),
+                                 max(1, int(config.get("max_concurrency", self.max_concurrency))))
+        try:
+            await server.start()
+        except Exception:
+            self.start_failures += 1
+            raise
+        finally:
+            self._starting.pop((server_id, key), None)
+        previous = self._servers.get(server_id)
+        self._servers[server_id] = server
+        if previous is not None:
+            await self._retire(previous)
+        return server
+
+    async def _retire(self, server: SharedMCPServer):
+        server.retired = True
+        if server.leases <= 0:
+            await server.stop()
+        else:
+            # stopped when its last session lets go
+            self._retired.append(server)
+
+    async def acquire(self, server_id: str, config: Dict[str, Any], holder: str) -> SharedMCPClient:
+        """Lease on the shared server for config, starting it on first use"""
+        key = self._key(config)
+        server = self._servers.get(server_id)
+        if server is None or server.key != key:
+            task = self._starting.get((server_id, key))
+            if task is None:
+                task = asyncio.ensure_future(self._start(server_id, config, key))
+                self._starting[(server_id, key)] = task
+            # a caller giving up does not cancel the start other sessions wait for
+            server = await asyncio.shield(task)
+        server.leases += 1
+        return SharedMCPClient(self, server, name=f"{holder}_{server_id}_shared")
+
+    async def release(self, server: SharedMCPServer):
+        server.leases -= 1
+        if server.retired and server.leases <= 0 and server in self._retired:
+            self._retired.remove(server)
+            await server.stop()
+
+    async def close(self):
+        servers = list(self._servers.values()) + self._retired
+        self._servers.clear()
+        self._retired.clear()
+        await asyncio.gather(*(server.stop() for server in servers), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"share_global_servers": MCP_SHARE_GLOBAL_SERVERS, "start_failures": self.start_failures,
+                "starting": sorted(server_id for server_id, _ in self._starting),
+                "servers": {server_id: server.stats() for server_id, server in self._servers.items()},
+                "retired": [server.stats() for server in self._retired]}
+
+
+_pool: Optional[MCPServerPool] = None
+
+
+def get_mcp_server_pool() -> MCPServerPool:
+    """Return the process-wide pool of shared MCP servers"""
+    global _pool
+    if _pool is None:
+        _pool = MCPServerPool()
+    return _pool
+
+
 # Utility functions for compatibility with existing code
 async def create_strands_mcp_client(name: str = "strands_mcp") -> StrandsMCPClient:
     """
@@ -3,6 +3,7 @@ Deep Research Swarm Team
 A specialized multi-agent system for comprehensive research tasks using Strands Agents framework.
 """
 
+import os
 import logging
 from strands import Agent
 from strands.multiagent import Swarm
@@ -16,6 +17,106 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
 )
 
+# Events a consumer may fall behind before the swarm nodes pause
+SWARM_STREAM_MAX_EVENTS = int(os.environ.get("SWARM_STREAM_MAX_EVENTS", 256))
+
+_SWARM_DONE = object()
+
+
+class _SwarmEventQueue:
+    """
+    Event queue shared by the nodes of one swarm stream.
+    
+    Agent callbacks are synchronous, so `put` never blocks; backpressure is
+    applied by `wait_for_room`, which the nodes await between model chunks.
+    """
+    
+    def __init__(self, max_events: int):
+        self.max_events = max(1, max_events)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._room = asyncio.Event()
+        self._room.set()
+    
+    def put(self, event):
+        self._queue.put_nowait(event)
+        if self._queue.qsize() >= self.max_events:
+            self._room.clear()
+    
+    async def get(self):
+        event = await self._queue.get()
+        if self._queue.qsize() < self.max_events:
+            self._room.set()
+        return event
+    
+    async def wait_for_room(self):
+        while self._queue.qsize() >= self.max_events:
+            self._room.clear()
+            await self._room.wait()
+
+
+class _PacedModel:
+    """Model proxy whose stream waits for room in the swarm event queue before each chunk"""
+    
+    def __init__(self, model, events: _SwarmEventQueue):
+        self._model = model
+        self._events = events
+    
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+    
+    async def stream(self, *args, **kwargs):
+        async for chunk in self._model.stream(*args, **kwargs):
+            await self._events.wait_for_room()
+            yield chunk
+
+
+def _node_callback(node_id: str, events: _SwarmEventQueue):
+    """Callback handler translating one node's agent events into typed stream events"""
+    def emit(event):
+        event["node_id"] = node_id
+        events.put(event)
+    
+    def stream_callback(**kwargs):
+        if 'message' in kwargs:
+            message = kwargs['message']
+            if message.get('role') == 'user' and message.get('content'):
+                content = message['content']
+                for content_block in content:
+                    if 'toolResult' in content_block:
+                        toolUseId = content_block['toolResult']['toolUseId']
+                        emit({"type": "toolResult", "toolUseId":toolUseId,"data": content_block['toolResult']})
+                
+        elif 'event' in kwargs:
+            event = kwargs['event']
+            # Handle message start
+            if "messageStart" in event:
+                emit({"type": "message_start", "data": event["messageStart"]})
+                
+            # Handle content block start
+            if "contentBlockStart" in event:
+                emit({"type": "block_start", "data": event["contentBlockStart"]})
+
+            # Handle content block delta
+            if "contentBlockDelta" in event:
+                emit({"type": "block_delta", "data": event["contentBlockDelta"]})
+
+            # Handle content block stop
+            if "contentBlockStop" in event:
+                emit({"type": "block_stop", "data": event["contentBlockStop"]})
+
+            # Handle message stop
+            if "messageStop" in event:
+                # need to ignore the end turn flog for the agent, unless the final result is done
+                if not event["messageStop"].get("stopReason") == "end_turn":
+                    emit({"type": "message_stop", "data": event["messageStop"]})
+
+            # Handle metadata
+            if "metadata" in event:
+                emit({"type": "metadata", "data": event["metadata"]})
+    
+    return stream_callback
+
+
 class DeepResearchSwarm:
     """
     A specialized swarm for conducting deep research across multiple domains.
@@ -219,12 +320,18 @@ class DeepResearchSwarm:
         """
         Stream research results as they become available.
         
+        Events of all swarm nodes are merged into one bounded queue and tagged
+        with the `node_id` of the agent that produced them. When the consumer
+        falls `SWARM_STREAM_MAX_EVENTS` events behind, the nodes pause between
+        model chunks until it catches up. Closing the generator cancels the
+        running swarm, and the cancellation propagates into the active node.
+        
         Args:
             prompt: Research topic/question as string or list of ContentBlocks
             **kwargs: Additional parameters like research_depth, specific_focus
         
         Yields:
-            Dict: Streaming events with type and data
+            Dict: Streaming events with type, data and node_id
         """
         # Extract parameters from kwargs
         research_depth = kwargs.get("research_depth", "comprehensive")
@@ -243,79 +350,57 @@ class DeepResearchSwarm:
         else:
             topic = str(prompt)
         
-        
-        stream_queue = kwargs.get("stream_queue", None)
-                
-        def emit(event):
-            if stream_queue:
-                stream_queue.put(event)
-            else:
-                logger.info(event)
-            
-        def stream_callback(**kwargs):
-            if 'message' in kwargs:
-                message = kwargs['message']
-                if message.get('role') == 'user' and message.get('content'):
-                    content = message['content']
-                    for content_block in content:
-                        if 'toolResult' in content_block:
-                            toolUseId = content_block['toolResult']['toolUseId']
-                            emit({"type": "toolResult", "toolUseId":toolUseId,"data": content_block['toolResult']})
-                    
-            elif 'event' in kwargs:
-                event = kwargs['event']
-                # logger.info(event)
-                # Handle message start
-                if "messageStart" in event:
-                    emit({"type": "message_start", "data": event["messageStart"]})
-                    
-                # Handle content block start
-                if "contentBlockStart" in event:
-                    block_start = event["contentBlockStart"]
-                    emit({"type": "block_start", "data": block_start})              
-
-                # Handle content block delta
-                if "contentBlockDelta" in event:
-                    delta = event["contentBlockDelta"]
-                    emit({"type": "block_delta", "data": delta})  
-
-                # Handle content block stop
-                if "contentBlockStop" in event:
-                    emit({"type": "block_stop", "data": event["contentBlockStop"]})   
-
-                # Handle message stop
-                if "messageStop" in event:
-                    # need to ignore the end turn flog for the agent, unless the final result is done
-                    if not event["messageStop"].get("stopReason") == "end_turn":
-                        emit({"type": "message_stop", "data": event["messageStop"]})     
-
-                # Handle metadata
-                if "metadata" in event:
-                    emit({"type": "metadata", "data": event["metadata"]})
-        
-        for agent in list(self.agents.values()):
-            agent.callback_handler =  stream_callback         
-        
+        events = _SwarmEventQueue(kwargs.get("max_buffered_events") or SWARM_STREAM_MAX_EVENTS)
+        
+        # Route every node's callbacks into the shared queue and pace its model stream by the consumer
+        originals = {}
+        for node_id, agent in self.agents.items():
+            originals[node_id] = (agent.callback_handler, agent.model)
+            agent.callback_handler = _node_callback(node_id, events)
+            agent.model = _PacedModel(agent.model, events)
+        
+        async def run_research():
+            try:
+                result = await self.research(
+                    topic=topic,
+                    research_depth=research_depth,
+                    specific_focus=specific_focus
+                )
+                logger.info(f"Swarm Research completed with: {result.status}")
+                events.put({"type": "message_stop", "data": {"stopReason": "end_turn"}})
+            except asyncio.CancelledError:
+                logger.info("Swarm Research cancelled")
+                raise
+            except Exception as e:
+                logger.error(f"Error during streaming research: {e}")
+                events.put({
+                    "type": "error",
+                    "data": {
+                        "message": f"An error occurred during swarm execution:{str(e)}"
+                    }
+                })
+            finally:
+                events.put(_SWARM_DONE)
+        
+        task = asyncio.create_task(run_research())
         try:
-            # Execute the research
-            result = await self.research(
-                topic=topic,
-                research_depth=research_depth,
-                specific_focus=specific_focus
-            )
-            logger.info(f"Swarm Research completed with: {result.status}")
-            emit({"type": "message_stop", "data": {"stopReason":"end_turn"}})  
-                
-        except Exception as e:
-            logger.error(f"Error during streaming research: {e}")
-            yield {
-                "type": "error",
-                "data": {
-                    "message": f"An error occurred during swarm execution:{str(e)}"
-                }
-            }
+            while True:
+                event = await events.get()
+                if event is _SWARM_DONE:
+                    break
+                yield event
+        finally:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            for node_id, (callback_handler, model) in originals.items():
+                agent = self.agents[node_id]
+                agent.callback_handler = callback_handler
+                agent.model = model
         
-    
     async def research(self, topic, research_depth="comprehensive", specific_focus=None):
         """
         Conduct deep research on a given topic.
@@ -0,0 +1,215 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Expiry and eviction of local user sessions, scheduled on a min-heap of last_active
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 0 disables the cap
+MAX_USER_SESSIONS = int(os.environ.get("MAX_USER_SESSIONS", 1000))
+MAX_SESSION_BYTES = int(os.environ.get("MAX_SESSION_BYTES", 4 * 1024 ** 3))
+# Charged per connected MCP client with its own server process, standing in for its memory; shared servers are free
+SESSION_MCP_CLIENT_BYTES = int(os.environ.get("SESSION_MCP_CLIENT_BYTES", 32 * 1024 ** 2))
+
+# evict(user_id, session, reason) removes nothing itself; the session is already out of the table
+Evict = Callable[[str, Any, str], Awaitable[None]]
+
+
+def estimate_messages_bytes(value: Any) -> int:
+    """Rough size of a message history: string and byte lengths plus a fixed cost per container"""
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return 64 + sum(estimate_messages_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(estimate_messages_bytes(item) for item in value)
+    return 16
+
+
+def own_mcp_clients(session: Any) -> int:
+    """MCP clients of a session with their own server process, not leases on shared servers"""
+    return sum(1 for client in session.mcp_clients.values() if not getattr(client, "shared", False))
+
+
+def estimate_session_bytes(session: Any) -> int:
+    client = session.chat_client
+    # the live agent holds the current history, the client only the last saved one
+    messages = getattr(getattr(client, "agent", None), "messages", None) or getattr(client, "messages", None)
+    return estimate_messages_bytes(messages or []) + own_mcp_clients(session) * SESSION_MCP_CLIENT_BYTES
+
+
+class SessionExpiry:
+    """
+    Expires sessions idle for `inactive_seconds` and keeps the table within
+    `max_sessions` and `max_bytes`.
+
+    Entries of the heap are (last_active timestamp, seq, user_id). Touching a
+    session pushes a new entry and leaves the old one stale; stale entries are
+    dropped or re-pushed when they reach the top, so code that only assigns
+    `session.last_active` still gets the right expiry. The coldest session is
+    always at the top, which makes the same heap the LRU order for eviction.
+    The scheduler task sleeps until the top entry is due.
+
+    Sessions with live streams are never evicted for the caps.
+    """
+
+    def __init__(self, sessions: Dict[str, Any], evict: Evict, inactive_seconds: float,
+                 max_sessions: int = MAX_USER_SESSIONS, max_bytes: int = MAX_SESSION_BYTES,
+                 estimate: Callable[[Any], int] = estimate_session_bytes):
+        self.sessions = sessions
+        self._evict = evict
+        self.inactive_seconds = inactive_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._estimate = estimate
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._bytes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._tasks = set()
+        self.expired = 0
+        self.evicted = 0
+
+    def track(self, user_id: str, keep: bool = True):
+        """Record a new or touched session, refresh its size estimate and enforce the caps"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            return
+        entry = (session.last_active.timestamp(), next(self._seq), user_id)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry and self._wake is not None:
+            self._wake.set()
+        self._measure(user_id, session)
+        if len(self._heap) > 4 * len(self.sessions) + 64:
+            self._compact()
+        self._enforce_caps(user_id if keep else None)
+
+    def refresh(self, user_id: str):
+        """Re-estimate the size of a session whose content changed, without touching it"""
+        session = self.sessions.get(user_id)
+        if session is not None:
+            self._measure(user_id, session)
+
+    def _measure(self, user_id: str, session: Any):
+        try:
+            size = self._estimate(session)
+        except Exception as e:
+            logger.warning(f"Estimating session size of {user_id} failed: {e}")
+            size = self._bytes.get(user_id, 0)
+        self.total_bytes += size - self._bytes.get(user_id, 0)
+        self._bytes[user_id] = size
+
+    def evict(self, user_id: str, reason: str):
+        """Remove a session now; its heap entries become stale"""
+        if user_id in self.sessions:
+            self._remove(user_id, reason)
+
+    def _compact(self):
+        self._heap = [(session.last_active.timestamp(), next(self._seq), user_id)
+                      for user_id, session in self.sessions.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_valid(self) -> Optional[Tuple[float, str]]:
+        """Pop the entry of the least recently active session, fixing up stale entries"""
+        while self._heap:
+            timestamp, _, user_id = heapq.heappop(self._heap)
+            session = self.sessions.get(user_id)
+            if session is None:
+                continue
+            actual = session.last_active.timestamp()
+            if actual != timestamp:
+                if actual > timestamp:
+                    # touched without track(); the newer entry may not be in the heap
+                    heapq.heappush(self._heap, (actual, next(self._seq), user_id))
+                continue
+            return timestamp, user_id
+        return None
+
+    def _over_caps(self) -> bool:
+        return ((self.max_sessions > 0 and len(self.sessions) > self.max_sessions)
+                or (self.max_bytes > 0 and self.total_bytes > self.max_bytes))
+
+    def _enforce_caps(self, keep: Optional[str]):
+        skipped = []
+        while self._over_caps():
+            entry = self._pop_valid()
+            if entry is None:
+                break
+            timestamp, user_id = entry
+            session = self.sessions[user_id]
+            if user_id == keep or getattr(session.chat_client, "stream_queues", None):
+                skipped.append((timestamp, next(self._seq), user_id))
+                continue
+            reason = "session_cap" if self.max_sessions > 0 and len(self.sessions) > self.max_sessions else "byte_cap"
+            self._remove(user_id, reason)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+
+    def _remove(self, user_id: str, reason: str):
+        session = self.sessions.pop(user_id)
+        self.total_bytes -= self._bytes.pop(user_id, 0)
+        if reason == "inactive":
+            self.expired += 1
+        else:
+            self.evicted += 1
+        logger.info(f"Removing session of {user_id}: {reason}")
+        # clean up in the background so the caller is not held up by MCP server shutdown
+        task = asyncio.get_running_loop().create_task(self._evict(user_id, session, reason))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _expire_due(self):
+        deadline = time.time() - self.inactive_seconds
+        while self._heap and self._heap[0][0] <= deadline:
+            entry = self._pop_valid()
+            if entry is None:
+                break
+            timestamp, user_id = entry
+            if timestamp > deadline:
+                heapq.heappush(self._heap, (timestamp, next(self._seq), user_id))
+                break
+            self._remove(user_id, "inactive")
+
+    def _next_delay(self) -> Optional[float]:
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] + self.inactive_seconds - time.time())
+
+    async def run(self):
+        """Scheduler task: expires each session when it falls due"""
+        self._wake = asyncio.Event()
+        self._compact()
+        while True:
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._next_delay())
+            except asyncio.TimeoutError:
+                pass
+            try:
+                self._expire_due()
+            except Exception as e:
+                logger.error(f"Session expiry failed: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self.sessions),
+            "estimated_bytes": self.total_bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "heap_entries": len(self._heap),
+            "next_expiry_seconds": self._next_delay(),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "pending_cleanups": len(self._tasks),
+        }
@@ -0,0 +1,362 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Memory accounting of user sessions and spilling of binary content to a local content store
+
+Histories are measured by content kind: text (including reasoning), binary
+(image, document and video bytes) and tool results, with tool use inputs and
+structure under other. When a session exceeds SESSION_MEMORY_BUDGET, or all
+sessions together exceed the global byte cap of SessionExpiry, the binary
+payloads of older messages are moved to a content-addressed directory and
+replaced by {"spilled": {"key", "size"}} in a copy of the history, which
+becomes the session's saved history; the session's agent, which holds the
+original, is dropped. Before a history is handed to a new agent,
+rehydrate_messages reads the payloads back into copies, so the model sees
+the same conversation. Sessions still over budget after spilling are evicted.
+"""
+import os
+import copy
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from session_expiry import SessionExpiry, estimate_messages_bytes, own_mcp_clients, SESSION_MCP_CLIENT_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Per-session estimate above which older binary content is spilled and, failing that, the session evicted; 0 = off
+SESSION_MEMORY_BUDGET = int(os.environ.get("SESSION_MEMORY_BUDGET", 256 * 1024 ** 2))
+CONTENT_STORE_DIR = os.environ.get("CONTENT_STORE_DIR", "content_store")
+# Spilled content not read or written for this long is deleted
+CONTENT_STORE_MAX_AGE = float(os.environ.get("CONTENT_STORE_MAX_AGE", 7 * 24 * 3600))
+# Binary content of the most recent messages always stays in memory
+SPILL_KEEP_MESSAGES = int(os.environ.get("SPILL_KEEP_MESSAGES", 4))
+SPILL_MIN_BYTES = int(os.environ.get("SPILL_MIN_BYTES", 64 * 1024))
+
+BINARY_BLOCKS = ("image", "document", "video")
+CATEGORIES = ("text", "binary", "tool_result", "other")
+
+
+def _measure_block(block: Any, usage: Dict[str, int]):
+    if not isinstance(block, dict):
+        usage["other"] += estimate_messages_bytes(block)
+        return
+    for kind, value in block.items():
+        if kind == "text" and isinstance(value, str):
+            usage["text"] += len(value)
+        elif kind == "reasoningContent":
+            usage["text"] += estimate_messages_bytes(value)
+        elif kind in BINARY_BLOCKS and isinstance(value, dict):
+            source = value.get("source") or {}
+            data = source.get("bytes")
+            if isinstance(data, (bytes, bytearray)):
+                usage["binary"] += len(data)
+            elif "spilled" in source:
+                usage["spilled"] += int(source["spilled"].get("size", 0))
+            usage["other"] += 64
+        elif kind == "toolResult" and isinstance(value, dict) and isinstance(value.get("content"), list):
+            # images and documents returned by tools count as binary
+            nested = dict.fromkeys(CATEGORIES + ("spilled",), 0)
+            for item in value["content"]:
+                _measure_block(item, nested)
+            usage["binary"] += nested.pop("binary")
+            usage["spilled"] += nested.pop("spilled")
+            usage["tool_result"] += 64 + sum(nested.values())
+        elif kind == "toolResult":
+            usage["tool_result"] += estimate_messages_bytes(value)
+        else:
+            usage["other"] += estimate_messages_bytes(value)
+
+
+def measure_messages(messages: Any) -> Dict[str, int]:
+    """Estimated bytes of a message history by category, plus `spilled` bytes held in the content store"""
+    usage = dict.fromkeys(CATEGORIES + ("spilled",), 0)
+    for message in messages or []:
+        usage["other"] += 64
+        content = message.get("content") if isinstance(message, dict) else message
+        if isinstance(content, list):
+            for block in content:
+                _measure_block(block, usage)
+        elif isinstance(content, str):
+            usage["text"] += len(content)
+        else:
+            usage["other"] += estimate_messages_bytes(content)
+    return usage
+
+
+def session_messages(session: Any) -> List[dict]:
+    client = session.chat_client
+    # the live agent holds the current history, the client only the last saved one
+    return getattr(getattr(client, "agent", None), "messages", None) or getattr(client, "messages", None) or []
+
+
+def measure_session(session: Any) -> Dict[str, int]:
+    usage = measure_messages(session_messages(session))
+    usage["mcp_clients"] = own_mcp_clients(session) * SESSION_MCP_CLIENT_BYTES
+    usage["total"] = sum(usage[category] for category in CATEGORIES) + usage["mcp_clients"]
+    return usage
+
+
+def _binary_sources(messages: List[dict]):
+    """(block kind, source dict) of every binary block, including those inside tool results"""
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else None
+        if not isinstance(content, list):
+            continue
+        stack = list(content)
+        while stack:
+            block = stack.pop()
+            if not isinstance(block, dict):
+                continue
+            for kind in BINARY_BLOCKS:
+                value = block.get(kind)
+                if isinstance(value, dict) and isinstance(value.get("source"), dict):
+                    yield kind, value["source"]
+            tool_result = block.get("toolResult")
+            if isinstance(tool_result, dict) and isinstance(tool_result.get("content"), list):
+                stack.extend(tool_result["content"])
+
+
+class ContentStore:
+    """Content-addressed files, one per distinct payload, shared by the processes using the directory"""
+
+    def __init__(self, directory: str = CONTENT_STORE_DIR):
+        self.directory = directory
+        self.writes = 0
+        self.bytes_written = 0
+        self.reads = 0
+        self.misses = 0
+        self.pruned = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        path = self._path(key)
+        if os.path.exists(path):
+            # still referenced; keeps it from being pruned
+            os.utime(path)
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.writes += 1
+        self.bytes_written += len(data)
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.reads += 1
+        return data
+
+    def prune(self, max_age: float = CONTENT_STORE_MAX_AGE) -> int:
+        """Delete payloads not used for max_age seconds"""
+        cutoff = time.time() - max_age
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        self.pruned += removed
+        return removed
+
+    def stats(self) -> Dict:
+        return {"directory": self.directory, "writes": self.writes, "bytes_written": self.bytes_written,
+                "reads": self.reads, "misses": self.misses, "pruned": self.pruned}
+
+
+def rehydrate_messages(messages: List[dict], store: ContentStore) -> List[dict]:
+    """
+    Copy of messages for a new agent, with spilled payloads read back.
+
+    Every message holding binary content is copied down to the source dicts,
+    so spilling the stored history later never changes what an agent holds.
+    A payload missing from the store is replaced by a text note.
+    """
+    result = []
+    for message in messages:
+        if not any(True for _ in _binary_sources([message])):
+            result.append(message)
+            continue
+        result.append(dict(message, content=[_rehydrate_block(block, store) for block in message["content"]]))
+    return result
+
+
+def _rehydrate_block(block: Any, store: ContentStore) -> Any:
+    if not isinstance(block, dict):
+        return block
+    block = dict(block)
+    for kind in BINARY_BLOCKS:
+        value = block.get(kind)
+        if not (isinstance(value, dict) and isinstance(value.get("source"), dict)):
+            continue
+        source = dict(value["source"])
+        spilled = source.pop("spilled", None)
+        if spilled is not None:
+            data = store.get(spilled["key"])
+            if data is None:
+                logger.warning(f"Spilled {kind} {spilled['key']} not found in content store")
+                return {"text": f"[{kind} no longer available]"}
+            source["bytes"] = data
+        block[kind] = dict(value, source=source)
+    tool_result = block.get("toolResult")
+    if isinstance(tool_result, dict) and isinstance(tool_result.get("content"), list):
+        block["toolResult"] = dict(tool_result, content=[_rehydrate_block(item, store)
+                                                         for item in tool_result["content"]])
+    return block
+
+
+class SessionMemory:
+    """
+    Per-session usage by category and the budgets on it.
+
+    `estimate` is the SessionExpiry size estimate, so the global byte cap is
+    enforced on the same numbers. `enforce` runs after each chat request.
+    """
+
+    def __init__(self, sessions: Dict[str, Any], store: ContentStore, budget: int = SESSION_MEMORY_BUDGET,
+                 keep_messages: int = SPILL_KEEP_MESSAGES, min_bytes: int = SPILL_MIN_BYTES):
+        self.sessions = sessions
+        self.store = store
+        self.budget = budget
+        self.keep_messages = keep_messages
+        self.min_bytes = min_bytes
+        self._usage: Dict[str, Dict[str, int]] = {}
+        self.spills = 0
+        self.spilled_bytes = 0
+        self.budget_evictions = 0
+
+    def estimate(self, session: Any) -> int:
+        usage = measure_session(session)
+        self._usage[session.user_id] = usage
+        return usage["total"]
+
+    @staticmethod
+    def _busy(session: Any) -> bool:
+        return bool(getattr(session.chat_client, "stream_queues", None))
+
+    def _spill_candidates(self, messages: List[dict]) -> List[Tuple[dict, bytes]]:
+        if self.keep_messages > 0:
+            messages = messages[:-self.keep_messages]
+        return [(source, source["bytes"]) for _, source in _binary_sources(messages)
+                if isinstance(source.get("bytes"), (bytes, bytearray)) and len(source["bytes"]) >= self.min_bytes]
+
+    async def spill(self, user_id: str, session: Any) -> int:
+        """
+        Move binary payloads of older messages to the content store; returns the bytes freed.
+
+        The live agent reuses its own messages on the next request, so the
+        payloads are replaced in a copy of the history. The copy becomes the
+        client's saved history and the agent is dropped, to be rebuilt from
+        the rehydrated copy.
+        """
+        if self._busy(session):
+            return 0
+        current = session_messages(session)
+        if not self._spill_candidates(current):
+            return 0
+        # containers only, the payload bytes are shared with the original until it is released
+        history = copy.deepcopy(current)
+        length = len(current)
+        candidates = self._spill_candidates(history)
+        keys = await asyncio.to_thread(lambda: [self.store.put(data) for _, data in candidates])
+        if (self._busy(session) or self.sessions.get(user_id) is not session
+                or session_messages(session) is not current or len(current) != length):
+            # a request ran meanwhile and changed the history; the files stay for next time
+            return 0
+        freed = 0
+        for (source, data), key in zip(candidates, keys):
+            if source.get("bytes") is data:
+                del source["bytes"]
+                source["spilled"] = {"key": key, "size": len(data)}
+                freed += len(data)
+        if freed:
+            client = session.chat_client
+            client.messages = history
+            client.agent = None
+            self.spills += 1
+            self.spilled_bytes += freed
+            logger.info(f"Spilled {freed} bytes of binary content of {user_id} to the content store")
+        return freed
+
+    async def enforce(self, expiry: SessionExpiry, user_id: str):
+        """Spill, then evict, until the session and all sessions are within their budgets"""
+        for gone in [uid for uid in self._usage if uid not in self.sessions]:
+            del self._usage[gone]
+        session = self.sessions.get(user_id)
+        if session is None:
+            return
+        if self.budget > 0 and self.estimate(session) > self.budget:
+            await self.spill(user_id, session)
+        if expiry.max_bytes > 0 and expiry.total_bytes > expiry.max_bytes:
+            # spill the sessions holding the most binary content before evicting any
+            binary = {uid: usage["binary"] for uid, usage in self._usage.items() if usage["binary"]}
+            for other in sorted(binary, key=binary.get, reverse=True):
+                if expiry.total_bytes <= expiry.max_bytes:
+                    break
+                other_session = self.sessions.get(other)
+                if other_session is not None and await self.spill(other, other_session):
+                    expiry.refresh(other)
+        if self.sessions.get(user_id) is not session:
+            return
+        # re-measures the session and evicts the least recently active ones beyond the global cap
+        expiry.track(user_id, keep=False)
+        usage = self._usage.get(user_id)
+        if (self.budget > 0 and usage and usage["total"] > self.budget and not self._busy(session)
+                and self.sessions.get(user_id) is session):
+            self.budget_evictions += 1
+            expiry.evict(user_id, "session_budget")
+
+    async def run(self, interval: float = 3600):
+        """Background task pruning the content store"""
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.store.prune)
+                if removed:
+                    logger.info(f"Pruned {removed} unused payloads from the content store")
+            except Exception as e:
+                logger.error(f"Pruning content store failed: {e}")
+            await asyncio.sleep(interval)
+
+    def usage(self, top: int = 20) -> Dict:
+        """Usage of the `top` largest sessions and the totals by category"""
+        usage = {user_id: self._usage[user_id] for user_id in list(self._usage) if user_id in self.sessions}
+        totals = dict.fromkeys(CATEGORIES + ("spilled", "mcp_clients", "total"), 0)
+        for entry in usage.values():
+            for category in totals:
+                totals[category] += entry.get(category, 0)
+        largest = sorted(usage.items(), key=lambda item: item[1]["total"], reverse=True)[:max(0, top)]
+        return {"totals": totals, "sessions": [dict(entry, user_id=user_id) for user_id, entry in largest]}
+
+    def stats(self) -> Dict:
+        return {"session_budget": self.budget, "spills": self.spills, "spilled_bytes": self.spilled_bytes,
+                "budget_evictions": self.budget_evictions, "content_store": self.store.stats()}
+
+
+_store: Optional[ContentStore] = None
+
+
+def get_content_store() -> ContentStore:
+    """Return the process-wide content store"""
+    global _store
+    if _store is None:
+        _store = ContentStore()
+    return _store
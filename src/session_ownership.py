@@ -0,0 +1,249 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Consistent-hash ownership of user sessions across instances
+
+Each user_id maps to one owning instance on a hash ring built from the
+membership list, so the user's warm MCP servers and agent stay on one node.
+SESSION_ROUTING selects what a non-owner does with a request:
+    off     serve it locally (default)
+    hint    serve it locally and return the owner in X-Session-Owner/-URL
+    proxy   forward it to the owner, serving locally only if the owner is unreachable
+
+Membership comes from CLUSTER_MEMBERS_TABLE, a DynamoDB table keyed on
+instanceId where every instance writes a heartbeat, or else from
+CLUSTER_MEMBERS_FILE, a JSON object {instance_id: url} re-read when it changes.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import hashlib
+import logging
+from bisect import bisect
+from typing import Dict, List, Optional, Tuple
+import boto3
+import aiohttp
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+SESSION_ROUTING = os.environ.get("SESSION_ROUTING", "off")
+CLUSTER_INSTANCE_ID = os.environ.get("CLUSTER_INSTANCE_ID") or socket.gethostname()
+CLUSTER_INSTANCE_URL = os.environ.get("CLUSTER_INSTANCE_URL", "")
+CLUSTER_MEMBERS_FILE = os.environ.get("CLUSTER_MEMBERS_FILE", "")
+CLUSTER_MEMBERS_TABLE = os.environ.get("CLUSTER_MEMBERS_TABLE", "")
+CLUSTER_HEARTBEAT_INTERVAL = float(os.environ.get("CLUSTER_HEARTBEAT_INTERVAL", 10))
+CLUSTER_MEMBER_TIMEOUT = float(os.environ.get("CLUSTER_MEMBER_TIMEOUT", 30))
+HASH_RING_VNODES = int(os.environ.get("HASH_RING_VNODES", 64))
+SESSION_PROXY_TIMEOUT = float(os.environ.get("SESSION_PROXY_TIMEOUT", 3600))
+# Off for owners with self-signed certificates, e.g. local worker processes serving HTTPS
+SESSION_PROXY_VERIFY_SSL = os.environ.get("SESSION_PROXY_VERIFY_SSL", "true").lower() != "false"
+
+ROUTING_MODES = ("off", "hint", "proxy")
+OWNER_HEADER = "X-Session-Owner"
+OWNER_URL_HEADER = "X-Session-Owner-URL"
+# Set on proxied requests so the receiving instance never forwards them again
+ROUTED_HEADER = "X-Session-Routed-By"
+
+# Hop-by-hop headers and headers the proxy recomputes; the response body is forwarded
+# still encoded, so its content-encoding is passed on with it
+_SKIP_REQUEST_HEADERS = frozenset(("host", "content-length", "connection", "keep-alive", "transfer-encoding",
+                                   "upgrade", "te", "trailer", "proxy-authorization", "proxy-connection"))
+_SKIP_RESPONSE_HEADERS = frozenset(("content-length", "connection", "keep-alive", "transfer-encoding",
+                                    "trailer", "upgrade"))
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring with `vnodes` points per member"""
+
+    def __init__(self, members: Dict[str, str], vnodes: int = HASH_RING_VNODES):
+        self.members = dict(members)
+        points = sorted((_hash(f"{member}#{index}"), member)
+                        for member in self.members for index in range(vnodes))
+        self._hashes: List[int] = [point for point, _ in points]
+        self._owners: List[str] = [member for _, member in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._hashes:
+            return None
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class StaticFileMembership:
+    """Members listed in a JSON file, re-read when its mtime changes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime: Optional[float] = None
+        self._members: Dict[str, str] = {}
+
+    async def heartbeat(self, instance_id: str, url: str):
+        pass
+
+    async def leave(self, instance_id: str):
+        pass
+
+    async def load(self) -> Dict[str, str]:
+        if not self.path:
+            return {}
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime != self._mtime:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._members = {str(k): str(v) for k, v in json.load(f).items()}
+                self._mtime = mtime
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"Reading cluster members from {self.path} failed: {e}")
+        return self._members
+
+
+class DynamoDBMembership:
+    """Members that wrote a heartbeat to the table within CLUSTER_MEMBER_TIMEOUT"""
+
+    def __init__(self, table_name: str, member_timeout: float = CLUSTER_MEMBER_TIMEOUT):
+        region = os.environ.get('AWS_REGION', 'us-east-1')
+        self.table = boto3.resource('dynamodb', region_name=region).Table(table_name)
+        self.member_timeout = member_timeout
+
+    async def heartbeat(self, instance_id: str, url: str):
+        now = int(time.time())
+        await asyncio.to_thread(self.table.put_item, Item={
+            "instanceId": instance_id,
+            "url": url,
+            "heartbeat": now,
+            # lets a DynamoDB TTL on expiresAt remove members that died without leaving
+            "expiresAt": now + int(self.member_timeout * 10),
+        })
+
+    async def leave(self, instance_id: str):
+        await asyncio.to_thread(self.table.delete_item, Key={"instanceId": instance_id})
+
+    async def load(self) -> Dict[str, str]:
+        def scan() -> List[dict]:
+            items, kwargs = [], {"ProjectionExpression": "instanceId, #u, heartbeat",
+                                 "ExpressionAttributeNames": {"#u": "url"}}
+            while True:
+                response = self.table.scan(**kwargs)
+                items.extend(response.get("Items", []))
+                if "LastEvaluatedKey" not in response:
+                    return items
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        cutoff = time.time() - self.member_timeout
+        return {item["instanceId"]: item.get("url", "") for item in await asyncio.to_thread(scan)
+                if float(item.get("heartbeat", 0)) >= cutoff}
+
+
+class SessionOwnership:
+    """Maps user ids to owning instances and forwards requests to them"""
+
+    def __init__(self, membership, instance_id: str = CLUSTER_INSTANCE_ID,
+                 instance_url: str = CLUSTER_INSTANCE_URL, vnodes: int = HASH_RING_VNODES):
+        self.membership = membership
+        self.instance_id = instance_id
+        self.instance_url = instance_url
+        self.vnodes = vnodes
+        self.ring = HashRing({instance_id: instance_url}, vnodes)
+        self._http = None
+        self.proxied = 0
+        self.proxy_failures = 0
+        self.hinted = 0
+        self.ring_changes = 0
+
+    async def refresh(self):
+        """Write this instance's heartbeat and rebuild the ring if membership changed"""
+        try:
+            await self.membership.heartbeat(self.instance_id, self.instance_url)
+            members = dict(await self.membership.load())
+        except Exception as e:
+            logger.warning(f"Refreshing cluster membership failed: {e}")
+            return
+        # this instance is always a member, even before its first heartbeat is visible
+        members[self.instance_id] = self.instance_url
+        if members != self.ring.members:
+            logger.info(f"Session ownership ring changed: {sorted(members)}")
+            self.ring = HashRing(members, self.vnodes)
+            self.ring_changes += 1
+
+    async def run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(CLUSTER_HEARTBEAT_INTERVAL)
+
+    async def close(self):
+        try:
+            await self.membership.leave(self.instance_id)
+        except Exception as e:
+            logger.warning(f"Leaving cluster membership failed: {e}")
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def owner(self, user_id: str) -> Tuple[str, str]:
+        """(instance_id, url) of the owner of user_id"""
+        instance_id = self.ring.owner(user_id) or self.instance_id
+        return instance_id, self.ring.members.get(instance_id, "")
+
+    def is_local(self, user_id: str) -> bool:
+        return self.owner(user_id)[0] == self.instance_id
+
+    async def proxy(self, request, owner_url: str):
+        """Forward a Starlette request to the owner and stream its response back"""
+        if self._http is None:
+            self._http = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=SESSION_PROXY_TIMEOUT, sock_connect=5),
+                connector=None if SESSION_PROXY_VERIFY_SSL else aiohttp.TCPConnector(ssl=False),
+                auto_decompress=False)
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in _SKIP_REQUEST_HEADERS}
+        headers[ROUTED_HEADER] = self.instance_id
+        url = owner_url.rstrip("/") + request.url.path
+        if request.url.query:
+            url += "?" + request.url.query
+        upstream = await self._http.request(request.method, url, headers=headers, data=await request.body(),
+                                            allow_redirects=False)
+        self.proxied += 1
+
+        async def body():
+            try:
+                async for chunk in upstream.content.iter_any():
+                    yield chunk
+            finally:
+                upstream.release()
+
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in _SKIP_RESPONSE_HEADERS}
+        return StreamingResponse(body(), status_code=upstream.status, headers=response_headers)
+
+    def stats(self) -> Dict:
+        return {
+            "routing": SESSION_ROUTING,
+            "instance_id": self.instance_id,
+            "members": self.ring.members,
+            "ring_changes": self.ring_changes,
+            "hinted": self.hinted,
+            "proxied": self.proxied,
+            "proxy_failures": self.proxy_failures,
+        }
+
+
+_ownership: Optional[SessionOwnership] = None
+
+
+def get_session_ownership() -> SessionOwnership:
+    """Return the process-wide session ownership, with membership from the configured source"""
+    global _ownership
+    if _ownership is None:
+        if CLUSTER_MEMBERS_TABLE:
+            membership = DynamoDBMembership(CLUSTER_MEMBERS_TABLE)
+        else:
+            membership = StaticFileMembership(CLUSTER_MEMBERS_FILE)
+        _ownership = SessionOwnership(membership)
+    return _ownership
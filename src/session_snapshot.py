@@ -0,0 +1,155 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Snapshot of live user sessions written on shutdown, used to pre-warm them on the next start
+
+An entry holds the user id, last_active, the ids of the user's connected MCP
+servers and a reference to the conversation history. Server configs are
+referenced by id and re-read from the config store when warming, so tokens
+in them are not written to the snapshot and changes made while the instance
+was down are honored. The history reference is the DynamoDB key when
+DynamoDB is configured; otherwise the history only exists in memory and is
+stored inline.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SESSION_SNAPSHOT_DIR = os.environ.get("SESSION_SNAPSHOT_DIR", "session_snapshots")
+# Most recently active sessions warmed on startup, 0 disables pre-warming
+SESSION_PREWARM_COUNT = int(os.environ.get("SESSION_PREWARM_COUNT", 50))
+SESSION_PREWARM_CONCURRENCY = max(1, int(os.environ.get("SESSION_PREWARM_CONCURRENCY", 4)))
+
+SNAPSHOT_VERSION = 1
+
+# warm(entry) -> True if a session was created from the entry
+Warm = Callable[[dict], Awaitable[bool]]
+
+
+def session_entry(session: Any, history_key: Optional[str]) -> dict:
+    """Snapshot entry of a UserSession; history_key None stores the history inline"""
+    entry = {
+        "user_id": session.user_id,
+        "last_active": session.last_active.timestamp(),
+        "servers": sorted(session.mcp_clients),
+    }
+    if history_key is not None:
+        entry["history"] = {"ddb_key": history_key}
+    else:
+        client = session.chat_client
+        messages = getattr(client, "messages", None) if getattr(client, "persist_history", True) else None
+        if messages:
+            try:
+                json.dumps(messages)
+                entry["history"] = {"messages": messages}
+            except (TypeError, ValueError):
+                # binary content such as images; the history starts empty as after any restart
+                logger.warning(f"History of {session.user_id} is not JSON serializable, not stored in snapshot")
+    return entry
+
+
+class SessionSnapshot:
+    """One JSON snapshot file per instance in `directory`"""
+
+    def __init__(self, instance_id: str, directory: str = SESSION_SNAPSHOT_DIR):
+        self.instance_id = instance_id
+        self.directory = directory
+        self.written = 0
+        self.loaded = 0
+        self.warmed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.warm_seconds: Optional[float] = None
+
+    @property
+    def path(self) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", self.instance_id)
+        return os.path.join(self.directory, f"sessions_{name}.json")
+
+    def write(self, entries: List[dict]) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "instance_id": self.instance_id, "written_at": time.time(),
+                       "sessions": entries}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.written = len(entries)
+        return self.written
+
+    def load(self, include_peers: bool = False) -> List[dict]:
+        """
+        Entries of this instance's snapshot, or of every snapshot in the
+        directory when sessions are routed by ownership and users may have
+        moved between instances; the newest entry of each user wins.
+        """
+        if include_peers:
+            try:
+                paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                         if name.startswith("sessions_") and name.endswith(".json")]
+            except FileNotFoundError:
+                paths = []
+        else:
+            paths = [self.path]
+        latest: Dict[str, dict] = {}
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as e:
+                logger.warning(f"Reading session snapshot {path} failed: {e}")
+                continue
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                continue
+            for entry in snapshot.get("sessions", []):
+                previous = latest.get(entry.get("user_id"))
+                if entry.get("user_id") and (previous is None or entry["last_active"] > previous["last_active"]):
+                    latest[entry["user_id"]] = entry
+        self.loaded = len(latest)
+        return list(latest.values())
+
+    @staticmethod
+    def select(entries: List[dict], max_age: float, limit: int = SESSION_PREWARM_COUNT,
+               accept: Callable[[str], bool] = lambda user_id: True) -> List[dict]:
+        """The `limit` most recently active entries not older than max_age seconds"""
+        cutoff = time.time() - max_age
+        entries = [entry for entry in entries if entry["last_active"] >= cutoff and accept(entry["user_id"])]
+        entries.sort(key=lambda entry: entry["last_active"], reverse=True)
+        return entries[:max(0, limit)]
+
+    async def prewarm(self, entries: List[dict], warm: Warm, concurrency: int = SESSION_PREWARM_CONCURRENCY):
+        """Warm entries, most recent first, at most `concurrency` at a time"""
+        if not entries:
+            return
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(entry: dict):
+            async with semaphore:
+                try:
+                    if await warm(entry):
+                        self.warmed += 1
+                    else:
+                        self.skipped += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f"Pre-warming session of {entry['user_id']} failed: {e}")
+
+        logger.info(f"Pre-warming {len(entries)} sessions, {concurrency} at a time")
+        await asyncio.gather(*(run(entry) for entry in entries))
+        self.warm_seconds = round(time.monotonic() - started, 3)
+        logger.info(f"Pre-warmed {self.warmed} sessions in {self.warm_seconds}s "
+                    f"({self.skipped} skipped, {self.failed} failed)")
+
+    def stats(self) -> Dict:
+        return {"path": self.path, "written": self.written, "loaded": self.loaded, "warmed": self.warmed,
+                "skipped": self.skipped, "failed": self.failed, "warm_seconds": self.warm_seconds}
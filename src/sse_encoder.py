@@ -0,0 +1,78 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Fast encoder for OpenAI-style chat.completion.chunk SSE frames
+"""
+import json
+import time
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+else:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+DONE_FRAME = b"data: [DONE]\n\n"
+HEARTBEAT_FRAME = b": heartbeat\n\n"
+
+_FINISH_NONE = b',"finish_reason":null}]}\n\n'
+_CLOSE = b"}]}\n\n"
+
+
+class ChunkEncoder:
+    """
+    Encodes chunks of one stream.
+
+    The envelope (id, object, created, model and the opening of choices[0])
+    is constant for a stream, so it is serialized once and only the delta,
+    finish_reason and message_extras are encoded per frame.
+    """
+
+    def __init__(self, model: str, chunk_id: Optional[str] = None, created: Optional[int] = None):
+        self.model = model
+        self.chunk_id = chunk_id or f"chat{time.time_ns()}"
+        self.created = created or int(time.time())
+        self._envelope = (b'{"id":' + dumps(self.chunk_id)
+                          + b',"object":"chat.completion.chunk","created":' + str(self.created).encode()
+                          + b',"model":' + dumps(model))
+        self._prefix = b"data: " + self._envelope + b',"choices":[{"index":0,"delta":'
+        self._delta_prefixes = {}
+
+    def delta(self, key: str, value: Any) -> bytes:
+        """Frame with a single-key delta and no finish_reason, the per-token hot path"""
+        prefix = self._delta_prefixes.get(key)
+        if prefix is None:
+            prefix = self._delta_prefixes[key] = self._prefix + b"{" + dumps(key) + b":"
+        return prefix + dumps(value) + b"}" + _FINISH_NONE
+
+    def chunk(self, delta: Optional[dict] = None, finish_reason: Optional[str] = None,
+              message_extras: Optional[dict] = None) -> bytes:
+        """General frame"""
+        parts = [self._prefix, dumps(delta) if delta else b"{}"]
+        if message_extras is None and finish_reason is None:
+            parts.append(_FINISH_NONE)
+        else:
+            parts.append(b',"finish_reason":')
+            parts.append(dumps(finish_reason))
+            if message_extras is not None:
+                parts.append(b',"message_extras":')
+                parts.append(dumps(message_extras))
+            parts.append(_CLOSE)
+        return b"".join(parts)
+
+    def extra(self, **fields: Any) -> bytes:
+        """Frame with an empty delta plus extra top-level fields (e.g. usage)"""
+        body = b"".join(b"," + dumps(key) + b":" + dumps(value) for key, value in fields.items())
+        return (b"data: " + self._envelope + body
+                + b',"choices":[{"index":0,"delta":{},"finish_reason":null}]}\n\n')
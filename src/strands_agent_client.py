@@ -63,9 +63,21 @@ class StrandsAgentClient(ChatClient):
         # Initialize agent
         self.agent = None
         self.mcp_tools = {}  # Store MCP tools for reuse
+        self.tool_servers = {}  # Tool name -> MCP server id, for per-server latency metrics
+        self.model_cache = None  # Optional dict shared by clients that reuse model clients (batch workers)
         
     def _get_model(self, model_id, thinking, thinking_budget, max_tokens=1024, temperature=0.7):
-        """Get the appropriate model based on provider"""
+        """Get the appropriate model based on provider, reusing it from model_cache when one is set"""
+        if self.model_cache is None:
+            return self._create_model(model_id, thinking, thinking_budget, max_tokens, temperature)
+        key = (self.model_provider, model_id, thinking, thinking_budget, max_tokens, temperature)
+        model = self.model_cache.get(key)
+        if model is None:
+            model = self.model_cache[key] = self._create_model(model_id, thinking, thinking_budget, max_tokens, temperature)
+        return model
+
+    def _create_model(self, model_id, thinking, thinking_budget, max_tokens=1024, temperature=0.7):
+        """Create the model client for the configured provider"""
         if self.model_provider == 'openai':
             return OpenAIModel(
                 client_args={
@@ -218,6 +230,8 @@ class StrandsAgentClient(ChatClient):
                     # Get tools from Strands MCP client
                     strands_tools = mcp_client.get_tools(server_id)
                     tools.extend(strands_tools)
+                    for strands_tool in strands_tools:
+                        self.tool_servers[strands_tool.tool_name] = server_id
                     logger.info(f"Added {len(strands_tools)} Strands tools from server: {server_id}")
                 else:
                     # Fallback to original method for compatibility
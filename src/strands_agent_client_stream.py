@@ -12,13 +12,19 @@ import logging
 import json
 import time
 import threading
+from contextlib import aclosing
 from typing import Dict, AsyncGenerator, Optional, List, AsyncIterator, Any
 from dotenv import load_dotenv
 from strands_agent_client import StrandsAgentClient
 from mcp_client_strands import StrandsMCPClient
-from utils import maybe_filter_to_n_most_recent_images, remove_cache_checkpoint,get_stream_id
+from utils import maybe_filter_to_n_most_recent_images, remove_cache_checkpoint
 from constant import *
-import queue
+from stream_channel import StreamChannel, CHANNEL_POLICIES, STREAM_CHANNEL_POLICY
+from agent_executor import get_agent_executor, AgentExecutorSaturated
+from stream_watcher import get_stream_watcher
+from tool_call_ledger import ToolCallLedger
+from stream_metrics import StreamTimeline
+from session_memory import rehydrate_messages, get_content_store
 
 load_dotenv()  # load environment variables from .env
 
@@ -28,6 +34,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+AGENT_STOP_GRACE_SECONDS = float(os.environ.get("AGENT_STOP_GRACE_SECONDS", 2.0))
+# Stop the stream as soon as a tool's streamed input is detected to be malformed JSON
+TOOL_INPUT_FAIL_FAST = os.environ.get("TOOL_INPUT_FAIL_FAST", "false").lower() == "true"
+
 class StrandsAgentClientStream(StrandsAgentClient):
     """Extended Strands Agent Client with streaming support"""
     
@@ -37,11 +47,9 @@ class StrandsAgentClientStream(StrandsAgentClient):
                         model_provider, api_key, api_base)
         # Stream-specific properties
         self.stop_flags = {}  # Dict to track stop flags for streams
-        self.monitor_threads = {}  # Dict to track monitor threads for streams
-        self.thread_stop_events = {}  # Dict to track stop events for threads
-        self.agent_threads = {}  # Dict to track agent processing threads
-        self.agent_stop_events = {}  # Dict to track stop events for agent threads
-        self.stream_queues = {}  # Dict to store stream results from agent threads
+        self.agent_jobs = {}  # Dict to track agent jobs submitted to the agent executor
+        self.agent_stop_events = {}  # Dict to track stop events for agent jobs
+        self.stream_queues = {}  # Dict to store stream results from agent jobs
         
     def register_stream(self, stream_id):
         """Register a new stream with a stop flag"""
@@ -52,138 +60,83 @@ class StrandsAgentClientStream(StrandsAgentClient):
         """Set the stop flag for a stream to terminate it"""
         if stream_id in self.stop_flags:
             self.stop_flags[stream_id] = True
+            self._wake_stream(stream_id)
             logger.info(f"Stopping stream: {stream_id}")
             return True
         return False
 
+    def _wake_stream(self, stream_id):
+        """Wake the SSE side of a stream so it notices its stop flag immediately"""
+        stream_queue = self.stream_queues.get(stream_id)
+        if stream_queue is not None:
+            stream_queue.wake()
+
     def unregister_stream(self, stream_id):
         """Clean up the stop flag after a stream completes"""
         if stream_id in self.stop_flags:
             del self.stop_flags[stream_id]
             logger.info(f"Unregistered stream: {stream_id}")
         
-        # Stop and clean up monitor thread
-        self._stop_monitor_thread(stream_id)
+        # Stop watching the stream and clean up its agent job
+        get_stream_watcher().unwatch(stream_id)
+        self._stop_agent_worker(stream_id)
+
+    def _on_stream_cancelled(self, stream_id: str):
+        """Called by the stream watcher when the stream was stopped remotely"""
+        if hasattr(self, 'agent') and self.agent and stream_id in self.stop_flags:
+            # Set stop flag to terminate the stream
+            self.stop_flags[stream_id] = True
+            self._wake_stream(stream_id)
             
-    def _start_monitor_thread(self, stream_id: str):
-        """Start a monitor thread for the given stream"""
-        if stream_id in self.monitor_threads:
-            logger.warning(f"Monitor thread for stream {stream_id} already exists")
+    def _start_agent_worker(self, stream_id: str, prompt: str, **kwargs:dict):
+        """Submit the agent processing job for the given stream to the agent executor"""
+        if stream_id in self.agent_jobs:
+            logger.warning(f"Agent job for stream {stream_id} already exists")
             return
-            
-        # Create stop event for this thread
+        logger.info(f"Starting agent job for stream: {stream_id}")
+        logger.info(f"Starting agent job prompt: {prompt}")
+        
+        # Create stop event for this job
         stop_event = threading.Event()
-        self.thread_stop_events[stream_id] = stop_event
         
-        # Create and start monitor thread
-        monitor_thread = threading.Thread(
-            target=self._monitor_stream_status,
-            args=(stream_id, stop_event),
-            daemon=True,
-            name=f"StreamMonitor-{stream_id}"
+        # Create bounded channel for stream results, bound to the loop serving the SSE response
+        policy = kwargs.get("backpressure_policy") or STREAM_CHANNEL_POLICY
+        if policy not in CHANNEL_POLICIES:
+            logger.warning(f"Unknown backpressure policy {policy}, using {STREAM_CHANNEL_POLICY}")
+            policy = STREAM_CHANNEL_POLICY
+        stream_queue = StreamChannel(asyncio.get_running_loop(), policy=policy)
+        use_swarm = kwargs.get("use_swarm")
+        # Raises AgentExecutorSaturated when the executor cannot take more work
+        job = get_agent_executor().submit(
+            stream_id,
+            lambda: self._agent_stream_worker(stream_id, prompt, stop_event, stream_queue, use_swarm)
         )
-        self.monitor_threads[stream_id] = monitor_thread
-        monitor_thread.start()
-        logger.info(f"Started monitor thread for stream: {stream_id}")
-    
-    def _stop_monitor_thread(self, stream_id: str):
-        """Stop the monitor thread for the given stream"""
-        if stream_id in self.thread_stop_events:
-            self.thread_stop_events[stream_id].set()
-            del self.thread_stop_events[stream_id]
-            
-        if stream_id in self.monitor_threads:
-            monitor_thread = self.monitor_threads[stream_id]
-            # Give thread a moment to stop gracefully
-            monitor_thread.join(timeout=1.0)
-            del self.monitor_threads[stream_id]
-            logger.info(f"Stopped monitor thread for stream: {stream_id}")
-            self._stop_agent_thread(stream_id)
-    
-    def _start_agent_thread(self, stream_id: str, prompt: str, **kwargs:dict):
-        """Start an agent processing thread for the given stream"""
-        if stream_id in self.agent_threads:
-            logger.warning(f"Agent thread for stream {stream_id} already exists")
-            return
-        logger.info(f"Starting agent thread for stream: {stream_id}")
-        logger.info(f"Starting agent thread prompt: {prompt}")
-        
-        # Create stop event for this thread
-        stop_event = threading.Event()
         self.agent_stop_events[stream_id] = stop_event
-        
-        # Create queue for stream results
-        import queue
-        stream_queue = queue.Queue()
         self.stream_queues[stream_id] = stream_queue
-        use_swarm = kwargs.get("kwargs")
-        # Create and start agent thread
-        agent_thread = threading.Thread(
-            target=self._run_agent_stream,
-            args=(stream_id, prompt, stop_event, stream_queue,use_swarm),
-            daemon=True,
-            name=f"AgentStream-{stream_id}"
-        )
-        self.agent_threads[stream_id] = agent_thread
-        agent_thread.start()
-        logger.info(f"Started agent thread for stream: {stream_id}")
+        self.agent_jobs[stream_id] = job
+        logger.info(f"Submitted agent job for stream: {stream_id}")
     
-    def _stop_agent_thread(self, stream_id: str):
-        """Stop the agent thread for the given stream"""
+    def _stop_agent_worker(self, stream_id: str):
+        """Stop the agent job for the given stream"""
         if stream_id in self.agent_stop_events:
             self.agent_stop_events[stream_id].set()
             del self.agent_stop_events[stream_id]
             
-        if stream_id in self.agent_threads:
-            agent_thread = self.agent_threads[stream_id]
-            
-            # First, try graceful shutdown
-            agent_thread.join(timeout=2.0)
-            
-            # If thread is still alive, it means there might be daemon threads or blocking operations
-            if agent_thread.is_alive():
-                logger.warning(f"Agent thread for stream {stream_id} did not stop gracefully, forcing cleanup")
-                
-                # Try to get thread ID for more aggressive cleanup if needed
-                thread_id = agent_thread.ident
-                if thread_id:
-                    logger.info(f"Agent thread {thread_id} for stream {stream_id} is still running")
-
-                # The daemon threads will be terminated when the main process exits
-                # But we should clean up our references
-                logger.warning(f"Agent thread for stream {stream_id} may have daemon threads still running")
-            
-            del self.agent_threads[stream_id]
-            logger.info(f"Stopped agent thread for stream: {stream_id}")
+        if stream_id in self.agent_jobs:
+            job = self.agent_jobs.pop(stream_id)
+            if not job.done():
+                # Let the worker notice its stop event and save history first,
+                # then cancel it if it is stuck in a long model or tool call
+                job.cancel(delay=AGENT_STOP_GRACE_SECONDS)
+            logger.info(f"Stopped agent job for stream: {stream_id}")
             
         if stream_id in self.stream_queues:
-            # Clear the queue to free memory
-            stream_queue = self.stream_queues[stream_id]
-            try:
-                while not stream_queue.empty():
-                    stream_queue.get_nowait()
-            except:
-                pass  # Queue might be empty or have other issues
-            del self.stream_queues[stream_id]
-    
-    def _run_agent_stream(self, stream_id: str, prompt: str, stop_event: threading.Event, stream_queue, use_swarm):
-        """Run agent stream processing in a separate thread"""
-        logger.info(f"Agent thread started for stream: {stream_id}")
-        
-        try:
-            # Create new event loop for this thread
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            # Run the agent stream processing
-            loop.run_until_complete(self._agent_stream_worker(stream_id, prompt, stop_event, stream_queue,use_swarm))
-            
-        except Exception as e:
-            logger.error(f"Error in agent thread for stream {stream_id}: {e}")
-            # Put error in queue
-            stream_queue.put({"type": "error", "data": {"message": str(e)}})
-        finally:
-            logger.info(f"Agent thread for stream {stream_id} terminated")
+            # Drop buffered events to free memory
+            self.stream_queues.pop(stream_id).close()
+
+    def stream_stats(self) -> Dict[str, dict]:
+        """Buffer statistics of the channels of this client's live streams"""
+        return {stream_id: channel.stats() for stream_id, channel in list(self.stream_queues.items())}
     
     async def _agent_stream_worker(self, stream_id: str, prompt: str, stop_event: threading.Event, stream_queue,use_swarm):
         """Async worker for agent stream processing"""
@@ -192,14 +145,20 @@ class StrandsAgentClientStream(StrandsAgentClient):
                 logger.error(f"No agent available for stream {stream_id}")
                 return
                 
-            response = self.agent.stream_async(prompt,stream_queue=stream_queue)
-            async for event in self._process_stream_response(stream_id, response):
-                if stop_event.is_set():
-                    logger.info(f"Agent stream worker for {stream_id} stopped by event")
-                    break
-                # logger.info(event)
-                # Put event in queue for main thread to consume
-                stream_queue.put(event)
+            # Closing the generators on break cancels the agent (or the running swarm nodes) right away
+            async with aclosing(self.agent.stream_async(prompt)) as response, \
+                    aclosing(self._process_stream_response(stream_id, response)) as events:
+                async for event in events:
+                    if stop_event.is_set():
+                        logger.info(f"Agent stream worker for {stream_id} stopped by event")
+                        break
+                    if stream_queue.closed:
+                        # the channel shed the stream because its consumer fell too far behind
+                        logger.info(f"Agent stream worker for {stream_id} stopped, channel closed")
+                        break
+                    # logger.info(event)
+                    # Put event in channel for the SSE side to consume, waiting for space when it is full
+                    await stream_queue.aput(event)
                 
             #save history message as stream end
             await self.save_history()
@@ -210,44 +169,6 @@ class StrandsAgentClientStream(StrandsAgentClient):
             logger.error(f"Error in agent stream worker for {stream_id}: {e}")
             stream_queue.put({"type": "error", "data": {"message": str(e)}})
     
-    def _monitor_stream_status(self, stream_id: str, stop_event: threading.Event):
-        """Monitor stream status in a separate thread"""
-        logger.info(f"Monitor thread started for stream: {stream_id}")
-        
-        # Create event loop once for this thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            while not stop_event.is_set():
-                try:
-                    # Check if stream still exists in remote DDB
-                    stream_exists = loop.run_until_complete(get_stream_id(stream_id=stream_id))
-                    
-                    # If stream doesn't exist and agent exists, clean up
-                    if not stream_exists and hasattr(self, 'agent') and self.agent:
-                        logger.info(f"Stream {stream_id} not found in remote, cleaning up agent")
-                        # Set stop flag to terminate the stream
-                        if stream_id in self.stop_flags:
-                            self.stop_flags[stream_id] = True
-                        # Clean up agent
-                        # del self.agent
-                        # self.agent = None
-                        break
-                        
-                except Exception as e:
-                    logger.error(f"Error in monitor thread for stream {stream_id}: {e}")
-                
-                # Wait for 3 seconds before next check
-                if stop_event.wait(timeout=3.0):
-                    break  # Stop event was set, exit immediately
-                
-        except Exception as e:
-            logger.error(f"Monitor thread for stream {stream_id} encountered error: {e}")
-        finally:
-            loop.close()
-            logger.info(f"Monitor thread for stream {stream_id} terminated")
-    
     async def   _process_stream_response(self, stream_id: Optional[str], response) -> AsyncIterator[Dict]:
         """Process the raw response from converse_stream"""
         last_yield_time = time.time()
@@ -257,7 +178,10 @@ class StrandsAgentClientStream(StrandsAgentClient):
                 await asyncio.sleep(0.001)
                 last_yield_time = current_time
 
-            if 'message' in chunk:
+            if 'type' in chunk:
+                # already a typed event, e.g. from DeepResearchSwarm
+                yield chunk
+            elif 'message' in chunk:
                 message = chunk['message']
                 if message.get('role') == 'user' and message.get('content'):
                     content = message['content']
@@ -304,7 +228,8 @@ class StrandsAgentClientStream(StrandsAgentClient):
     async def process_query_stream(self,
             model_id="", max_tokens=1024, max_turns=30, temperature=0.1,
             messages=[], system=[], mcp_clients=None, mcp_server_ids=[], extra_params={}, keep_session=None,
-            stream_id: Optional[str] = None, use_mem: bool = False, use_swarm : bool = False) -> AsyncGenerator[Dict, None]:
+            stream_id: Optional[str] = None, use_mem: bool = False, use_swarm : bool = False,
+            timeline: Optional[StreamTimeline] = None) -> AsyncGenerator[Dict, None]:
         """Submit user query or history messages, and get streaming response using Strands Agents SDK."""
         
         logger.info(f'client input message list length:{len(messages)}')
@@ -316,6 +241,8 @@ class StrandsAgentClientStream(StrandsAgentClient):
         if keep_session:
             history = await self.load_history()
             if history:
+                # 读回已转存到本地内容存储的图片和文档，agent使用副本，不影响会话中保存的历史
+                history = await asyncio.to_thread(rehydrate_messages, history, get_content_store())
                 messages = history + messages 
             system = self.system if self.system else system #system 消息每次都会传入
         else:
@@ -326,8 +253,8 @@ class StrandsAgentClientStream(StrandsAgentClient):
         # Register this stream if an ID is provided
         if stream_id:
             self.register_stream(stream_id)
-            # Start monitor thread for this stream
-            self._start_monitor_thread(stream_id)
+            # Let the shared watcher detect stops issued on other instances
+            get_stream_watcher().watch(stream_id, self._on_stream_cancelled)
         
         # Convert system messages to system prompt
         system_prompt = ""
@@ -370,43 +297,53 @@ class StrandsAgentClientStream(StrandsAgentClient):
             use_mem=use_mem,
             use_swarm=use_swarm
         )
+        if timeline:
+            timeline.mark("agent_created")
         
         current_content = ""
         turn_i = 1
         stop_reason = ''
-        tool_calls = []
-        current_tool_use = None
-        current_tooluse_input = ''
         thinking_text = ''
         text = ''
         only_n_most_recent_images = extra_params.get('only_n_most_recent_images', 3)
         image_truncation_threshold = only_n_most_recent_images or 0
         
-        tool_calls = []
-        tool_results_dict = {}
-        # 记录已经发送过的tool result
-        sent_results_history = {}
+        # 工具输入的增量解析：按需把部分参数附加到delta，或在输入格式错误时提前终止
+        tool_input_partial = extra_params.get("tool_input_partial", False)
+        tool_input_fail_fast = extra_params.get("tool_input_fail_fast", TOOL_INPUT_FAIL_FAST)
+        # 按toolUseId记录工具调用和结果
+        tool_ledger = ToolCallLedger(incremental=bool(tool_input_partial or tool_input_fail_fast))
         # Check if stream_id is provided
         if not stream_id:
             yield {"type": "error", "data": {"message": "无stream id"}}
             return
         
-        kwargs = dict(use_swarm=use_swarm)
-        # Start agent thread to handle stream processing
-        self._start_agent_thread(stream_id, prompt,**kwargs)
+        kwargs = dict(use_swarm=use_swarm, backpressure_policy=extra_params.get("backpressure_policy"))
+        # Submit agent job to handle stream processing
+        try:
+            self._start_agent_worker(stream_id, prompt,**kwargs)
+        except AgentExecutorSaturated as e:
+            logger.warning(f"Stream {stream_id} rejected: {e}")
+            yield {"type": "error", "data": {"message": "Server is busy, please retry later"}}
+            return
         
-        # Get events from agent thread via queue
+        # Get events from agent job via channel
         stream_queue = self.stream_queues[stream_id]
         
         while True:
             try:
-                event = stream_queue.get(timeout=1)
+                event = await stream_queue.get(timeout=1)
                 # Check if stream should stop
                 if stream_id in self.stop_flags and self.stop_flags[stream_id]:
                     logger.info(f"Stream {stream_id} was requested to stop")
                     # self.agent.tool.stop(reason="User requested to stop")
                     yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
                     break
+                # Timed out or woken without an event
+                if event is None:
+                    continue
+                if timeline:
+                    timeline.first_event()
                 
                 # Handle special control events
                 if event.get("type") == "stream_end":
@@ -416,20 +353,24 @@ class StrandsAgentClientStream(StrandsAgentClient):
                     logger.error(f"Stream {stream_id} encountered error: {event.get('data', {}).get('message', 'Unknown error')}")
                     yield event
                     break
+
+                # Parse streamed tool input before the event is sent, so partial arguments can go with it
+                if event.get("type") == "block_delta" and "toolUse" in event["data"].get("delta", {}):
+                    #Claude 是stream输出input，而Nova是一次性输出
+                    partial = tool_ledger.add_input(event["data"]["delta"]["toolUse"]["input"])
+                    if tool_ledger.input_error is not None and tool_input_fail_fast:
+                        message = f"Malformed input for tool {tool_ledger.current_name}: {tool_ledger.input_error}"
+                        logger.error(f"Stream {stream_id}: {message}")
+                        yield {"type": "error", "data": {"message": message}}
+                        break
+                    if partial and tool_input_partial:
+                        event = {"type": "block_delta", "data": {**event["data"], "toolinput_partial": partial}}
+                elif timeline and event.get("type") == "block_delta" and "text" in event["data"].get("delta", {}):
+                    timeline.token()
                 
                 # Yield normal events
                 yield event
                 
-            except queue.Empty:
-                # Yield control to event loop more frequently
-                await asyncio.sleep(0.01)
-                # Check if we should continue waiting
-                if stream_id in self.stop_flags and self.stop_flags[stream_id]:
-                    # self.agent.tool.stop(reason="User requested to stop")
-                    logger.info(f"Stream {stream_id} timed out and stop flag is set")
-                    yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
-                    break
-                continue
             except Exception as e:
                 logger.error(f"Error getting event from queue for stream {stream_id}: {e}")
                 break
@@ -437,47 +378,30 @@ class StrandsAgentClientStream(StrandsAgentClient):
             if event["type"] == "block_start":
                 block_start = event["data"]
                 if "toolUse" in block_start.get("start", {}):
-                    current_tool_use = block_start["start"]["toolUse"]
-                    tool_calls.append(current_tool_use)
-                    logger.info("Tool use detected: %s", current_tool_use)
+                    tool_ledger.start(block_start["start"]["toolUse"])
+                    logger.info("Tool use detected: %s", block_start["start"]["toolUse"])
 
-            if event["type"] == "block_delta":
-                delta = event["data"]
-                if "toolUse" in delta.get("delta", {}):
-                    #Claude 是stream输出input，而Nova是一次性输出
-                    #取出最近添加的tool,追加input参数
-                    current_tool_use = tool_calls[-1]
-                    if current_tool_use:
-                        current_tooluse_input += delta["delta"]["toolUse"]["input"]
-                        current_tool_use["input"] = current_tooluse_input 
-                    
             # Handle tool use input in content block stop
             if event["type"] == "block_stop":
-                if current_tooluse_input:
-                    #取出最近添加的tool,把input str转成json
-                    current_tool_use = tool_calls[-1]
-                    if current_tool_use:
-                        current_tool_use["input"] = json.loads(current_tooluse_input)
-                        current_tooluse_input = ''
-                        
+                if timeline and tool_ledger.current_id:
+                    # 工具输入完成，开始计时工具执行
+                    tool_name = tool_ledger.current_name
+                    timeline.tool_start(tool_ledger.current_id, tool_name, self.tool_servers.get(tool_name, "builtin"))
+                #把input str转成json
+                tool_ledger.stop()
                         
             # Handle message stop and tool use
             if event["type"] == "toolResult":
-                new_event = {}
-                toolUseId = event['toolUseId']
-                if toolUseId not in tool_results_dict:
-                    tool_results_dict[toolUseId] = event['data']
-                    # output tool results for UI
-                    tool_results_serializable = [[tool,{"tool_name":tool['name'],"tool_result":tool_results_dict.get(tool['toolUseId'])}] for tool in tool_calls 
-                                                    if tool_results_dict.get(tool['toolUseId']) and tool['toolUseId'] not in sent_results_history ]
-                    # tool_results = [item for pair in zip(tool_calls, tool_results_serializable) for item in pair]
-                    tool_results = [item for pair in tool_results_serializable for item in pair]
-                    new_event = {'type':'result_pairs','data':{'stopReason':'tool_use','tool_results':tool_results}}
-                    yield new_event
-                    sent_results_history[toolUseId] = toolUseId
-                    # logger.info(new_event)
+                if timeline:
+                    timeline.tool_end(event['toolUseId'])
+                # output tool results for UI
+                tool_results = tool_ledger.record_result(event['toolUseId'], event['data'])
+                if tool_results:
+                    yield {'type':'result_pairs','data':{'stopReason':'tool_use','tool_results':tool_results}}
                 
             if event["type"] == "message_stop":
+                if timeline:
+                    timeline.mark("message_stop", overwrite=True)
                 # Save the system to session
                 self.system = system
                 yield event
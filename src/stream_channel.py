@@ -0,0 +1,359 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Cross-thread async channel used to hand agent events to the SSE generator
+"""
+import os
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHANNEL_MAX_EVENTS = int(os.environ.get("STREAM_CHANNEL_MAX_EVENTS", 1024))
+STREAM_CHANNEL_MAX_BYTES = int(os.environ.get("STREAM_CHANNEL_MAX_BYTES", 1024 * 1024))
+STREAM_CHANNEL_POLICY = os.environ.get("STREAM_CHANNEL_POLICY", "block")
+
+# Overflow policies
+POLICY_BLOCK = "block"        # producers awaiting `aput` wait for space
+POLICY_COALESCE = "coalesce"  # merge consecutive text deltas once the event limit is hit
+POLICY_SHED = "shed"          # drop the buffer and end the stream with an error
+CHANNEL_POLICIES = (POLICY_BLOCK, POLICY_COALESCE, POLICY_SHED)
+
+# Rough per-event cost of the event dicts on top of their text
+EVENT_OVERHEAD_BYTES = 200
+
+
+def event_size(event: Any) -> int:
+    """Estimated memory held by one agent event"""
+    if not isinstance(event, dict):
+        return EVENT_OVERHEAD_BYTES
+    if event.get("type") == "block_delta":
+        delta = event["data"].get("delta", {})
+        text = (delta.get("text") or delta.get("toolUse", {}).get("input")
+                or delta.get("reasoningContent", {}).get("text") or "")
+        return EVENT_OVERHEAD_BYTES + len(text)
+    if event.get("type") == "toolResult":
+        content = event.get("data", {}).get("content") or []
+        return EVENT_OVERHEAD_BYTES + sum(len(block.get("text", "")) for block in content if isinstance(block, dict))
+    return EVENT_OVERHEAD_BYTES
+
+
+def _delta_kind(event: Any) -> Optional[str]:
+    """Delta key of a text or reasoning block_delta, the only events that are merged"""
+    if not isinstance(event, dict) or event.get("type") != "block_delta":
+        return None
+    delta = event["data"].get("delta", {})
+    if "text" in delta:
+        return "text"
+    if "reasoningContent" in delta and "text" in delta["reasoningContent"] and len(delta["reasoningContent"]) == 1:
+        return "reasoningContent"
+    return None
+
+
+class _MergedDelta:
+    """Consecutive deltas of one content block, joined when the consumer takes them"""
+    __slots__ = ("kind", "data", "parts")
+
+    def __init__(self, kind: str, event: dict):
+        self.kind = kind
+        self.data = event["data"]
+        self.parts = [self._text(event)]
+
+    def _text(self, event: dict) -> str:
+        delta = event["data"]["delta"]
+        return delta["text"] if self.kind == "text" else delta["reasoningContent"]["text"]
+
+    def accepts(self, event: dict) -> bool:
+        return (_delta_kind(event) == self.kind
+                and event["data"].get("contentBlockIndex") == self.data.get("contentBlockIndex"))
+
+    def add(self, event: dict):
+        self.parts.append(self._text(event))
+
+    def event(self) -> dict:
+        text = "".join(self.parts)
+        delta = {"text": text} if self.kind == "text" else {"reasoningContent": {"text": text}}
+        return {"type": "block_delta", "data": {**self.data, "delta": delta}}
+
+
+class StreamChannel:
+    """
+    Single-consumer event channel bound to the consumer's event loop.
+
+    Producers may live on any thread (agent worker threads, the swarm callback,
+    the monitor thread) and call `put`; the consumer awaits `get` on the loop
+    the channel was created on. Producers only touch the loop through
+    `call_soon_threadsafe`, and only when the consumer is actually parked, so a
+    busy stream costs one lock round trip per event instead of a loop wakeup.
+
+    The buffer is bounded by `max_events` and an estimate of the bytes it
+    holds. When a limit is reached the policy applies: `block` makes `aput`
+    wait for space (plain `put` never blocks a thread that runs an event loop
+    and only counts the overflow), `coalesce` merges text deltas and sheds the
+    stream if the byte limit is still exceeded, and `shed` replaces the buffer
+    with a terminal error event and closes the channel to producers.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 max_events: int = STREAM_CHANNEL_MAX_EVENTS, max_bytes: int = STREAM_CHANNEL_MAX_BYTES,
+                 policy: str = STREAM_CHANNEL_POLICY, sizeof: Callable[[Any], int] = event_size):
+        if policy not in CHANNEL_POLICIES:
+            raise ValueError(f"Unknown stream channel policy: {policy}")
+        self._loop = loop or asyncio.get_running_loop()
+        self._lock = threading.Lock()
+        self._buffer = deque()
+        self._waiter: Optional[asyncio.Future] = None
+        self._space_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._woken = False
+        self._closed = False
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._sizeof = sizeof
+        self.buffered_bytes = 0
+        self.peak_bytes = 0
+        self.coalesced = 0
+        self.overflowed = 0
+        self.blocked = 0
+        self.shed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _full(self) -> bool:
+        return len(self._buffer) >= self.max_events or self.buffered_bytes >= self.max_bytes
+
+    def _offer(self, item: Any) -> bool:
+        """Buffer an item under the lock applying the overflow policy; False if it was not buffered"""
+        if self._closed:
+            return False
+        size = self._sizeof(item)
+        if not self._full():
+            self._append(item, size)
+            return True
+        if self.policy == POLICY_COALESCE:
+            merged = self._merge(item, size)
+            if self.buffered_bytes < self.max_bytes:
+                if not merged:
+                    # structural events are never merged or dropped
+                    self.overflowed += 1
+                    self._append(item, size)
+                return True
+            self._shed_locked()
+            return False
+        if self.policy == POLICY_SHED:
+            self._shed_locked()
+            return False
+        # block policy: only `aput` waits, a plain put goes over the limit
+        self.overflowed += 1
+        self._append(item, size)
+        return True
+
+    def _merge(self, item: Any, size: int) -> bool:
+        """Merge a text delta into the last buffered delta of the same content block"""
+        kind = _delta_kind(item)
+        if kind is None or not self._buffer:
+            return False
+        last = self._buffer[-1]
+        if not isinstance(last, _MergedDelta):
+            if _delta_kind(last) != kind:
+                return False
+            last = _MergedDelta(kind, last)
+        if not last.accepts(item):
+            return False
+        last.add(item)
+        self._buffer[-1] = last
+        self.coalesced += 1
+        # the merged delta keeps a single event overhead
+        self._account(size - EVENT_OVERHEAD_BYTES)
+        return True
+
+    def _append(self, item: Any, size: int):
+        self._buffer.append(item)
+        self._account(size)
+
+    def _account(self, size: int):
+        self.buffered_bytes += size
+        if self.buffered_bytes > self.peak_bytes:
+            self.peak_bytes = self.buffered_bytes
+
+    def _shed_locked(self):
+        logger.warning(f"Stream channel over its limit ({len(self._buffer)} events, "
+                       f"{self.buffered_bytes} bytes), shedding the stream")
+        self._buffer.clear()
+        self._buffer.append({"type": "error", "data": {"message": "Stream shed: client is too slow"}})
+        self.buffered_bytes = EVENT_OVERHEAD_BYTES
+        self.shed = True
+        self._closed = True
+
+    def put(self, item: Any):
+        """Append an event, waking the consumer if it is waiting. Safe from any thread, never blocks."""
+        with self._lock:
+            self._offer(item)
+            waiter = self._waiter
+            self._waiter = None
+            space_waiters = self._take_space_waiters() if self._closed else None
+        if waiter is not None:
+            self._resolve(waiter)
+        if space_waiters:
+            self._release(space_waiters)
+
+    # Keep queue.Queue naming so producers written against it keep working
+    put_nowait = put
+
+    async def aput(self, item: Any):
+        """Append an event from a coroutine, waiting for space under the block policy"""
+        while self.policy == POLICY_BLOCK:
+            with self._lock:
+                if self._closed or not self._full():
+                    break
+                space = asyncio.get_running_loop().create_future()
+                self._space_waiters.append((asyncio.get_running_loop(), space))
+                self.blocked += 1
+            await space
+        self.put(item)
+
+    def _take_space_waiters(self) -> List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]:
+        space_waiters, self._space_waiters = self._space_waiters, []
+        return space_waiters
+
+    def _release(self, space_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]):
+        for loop, space in space_waiters:
+            def _set(space=space):
+                if not space.done():
+                    space.set_result(None)
+            try:
+                loop.call_soon_threadsafe(_set)
+            except RuntimeError:
+                pass
+
+    def wake(self):
+        """Wake the consumer without an event so it re-checks its stop flags."""
+        with self._lock:
+            self._woken = True
+            waiter = self._waiter
+            self._waiter = None
+        if waiter is not None:
+            self._resolve(waiter)
+
+    def _resolve(self, waiter: asyncio.Future):
+        def _set():
+            if not waiter.done():
+                waiter.set_result(None)
+        try:
+            if self._on_loop_thread():
+                _set()
+            else:
+                self._loop.call_soon_threadsafe(_set)
+        except RuntimeError:
+            # Loop already closed, nobody is listening any more
+            pass
+
+    def _on_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _pop_locked(self) -> Any:
+        item = self._buffer.popleft()
+        if isinstance(item, _MergedDelta):
+            item = item.event()
+        self.buffered_bytes = max(0, self.buffered_bytes - self._sizeof(item)) if self._buffer else 0
+        return item
+
+    def _get_locked(self) -> Tuple[Any, Optional[list]]:
+        item = self._pop_locked()
+        space_waiters = self._take_space_waiters() if self._space_waiters and not self._full() else None
+        return item, space_waiters
+
+    async def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        Wait for the next event.
+
+        Returns None when the timeout expires or when `wake` was called with
+        nothing buffered, so callers can re-check stop conditions.
+        """
+        with self._lock:
+            if self._buffer:
+                item, space_waiters = self._get_locked()
+                waiter = None
+            elif self._woken:
+                self._woken = False
+                return None
+            else:
+                waiter = self._loop.create_future()
+                self._waiter = waiter
+        if waiter is None:
+            if space_waiters:
+                self._release(space_waiters)
+            return item
+
+        timer = self._loop.call_later(timeout, self.wake) if timeout is not None else None
+        try:
+            await waiter
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self._lock:
+                if self._waiter is waiter:
+                    self._waiter = None
+
+        with self._lock:
+            self._woken = False
+            if not self._buffer:
+                return None
+            item, space_waiters = self._get_locked()
+        if space_waiters:
+            self._release(space_waiters)
+        return item
+
+    def get_nowait(self) -> Any:
+        with self._lock:
+            if not self._buffer:
+                raise IndexError("channel is empty")
+            item, space_waiters = self._get_locked()
+        if space_waiters:
+            self._release(space_waiters)
+        return item
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not self._buffer
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
+    def close(self):
+        """Drop buffered events and ignore further puts."""
+        with self._lock:
+            self._closed = True
+            self._buffer.clear()
+            self.buffered_bytes = 0
+            waiter = self._waiter
+            self._waiter = None
+            space_waiters = self._take_space_waiters()
+        if waiter is not None:
+            self._resolve(waiter)
+        self._release(space_waiters)
+
+    def stats(self) -> dict:
+        with self._lock:
+            events = len(self._buffer)
+        return {
+            "policy": self.policy,
+            "buffered_events": events,
+            "buffered_bytes": self.buffered_bytes,
+            "peak_bytes": self.peak_bytes,
+            "coalesced": self.coalesced,
+            "overflowed": self.overflowed,
+            "blocked": self.blocked,
+            "shed": self.shed,
+        }
@@ -0,0 +1,166 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Fan-in of several async sources into one stream, with timer-driven heartbeats
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bound on items buffered between the sources and the consumer
+FANIN_MAX_BUFFERED = 256
+
+
+class _SourceDone:
+    __slots__ = ()
+
+
+class _SourceError:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_SOURCE_DONE = _SourceDone()
+# wakes a consumer waiting on an empty queue when a timed item is pending
+_CONTROL_READY = object()
+
+
+def is_final_event(item: Any) -> bool:
+    """True for agent events after which the response is complete"""
+    if not isinstance(item, dict):
+        return False
+    item_type = item.get("type")
+    if item_type in ("stopped", "error"):
+        return True
+    if item_type == "message_stop":
+        return item.get("data", {}).get("stopReason") in ("end_turn", "max_tokens")
+    return False
+
+
+class StreamFanIn:
+    """
+    Merges async sources through a single asyncio.Queue.
+
+    Each source is drained by one long-lived pump task, so yielding an item
+    costs a queue put/get instead of a new task. Heartbeats and other timed
+    items are injected with loop.call_later: the heartbeat timer only emits
+    when no item has been delivered for `heartbeat_interval` seconds.
+
+    Iteration ends after an item for which `is_final` returns True, or once
+    every source is exhausted. A source exception is re-raised to the consumer.
+    """
+
+    def __init__(self, heartbeat_interval: Optional[float] = None, heartbeat_item: Any = None,
+                 is_final: Callable[[Any], bool] = is_final_event, max_buffered: int = FANIN_MAX_BUFFERED):
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_item = heartbeat_item
+        self.is_final = is_final
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffered)
+        # timed items, kept apart from the bounded queue so they are never dropped
+        self._control: deque = deque()
+        self._loop = asyncio.get_running_loop()
+        self._pumps: List[asyncio.Task] = []
+        self._timers: List[asyncio.TimerHandle] = []
+        self._heartbeat_handle: Optional[asyncio.TimerHandle] = None
+        self._last_item = time.monotonic()
+        self._closed = False
+        self.heartbeats = 0
+
+    def add_source(self, source: AsyncIterator):
+        self._pumps.append(self._loop.create_task(self._pump(source)))
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for item in source:
+                await self._queue.put(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in merged stream source: {e}")
+            await self._queue.put(_SourceError(e))
+            return
+        await self._queue.put(_SOURCE_DONE)
+
+    def call_later(self, delay: float, item: Any) -> asyncio.TimerHandle:
+        """Deliver `item` once after `delay` seconds"""
+        handle = self._loop.call_later(delay, self._offer, item)
+        self._timers.append(handle)
+        if len(self._timers) > 32:
+            # a fired handle is not cancelled either, so drop by due time as well
+            now = self._loop.time()
+            self._timers = [timer for timer in self._timers if not timer.cancelled() and timer.when() > now]
+        return handle
+
+    def _offer(self, item: Any):
+        # timed items are control items (e.g. coalescing flushes) the consumer waits for,
+        # so they are never dropped, even when the consumer is behind
+        if self._closed:
+            return
+        self._control.append(item)
+        # a full queue means the consumer is not waiting and checks _control before its next get
+        if not self._queue.full():
+            self._queue.put_nowait(_CONTROL_READY)
+
+    def _schedule_heartbeat(self, delay: float):
+        self._heartbeat_handle = self._loop.call_later(delay, self._on_heartbeat_timer)
+
+    def _on_heartbeat_timer(self):
+        if self._closed:
+            return
+        idle = time.monotonic() - self._last_item
+        if idle >= self.heartbeat_interval:
+            # the queue is only full when real items are flowing, so no heartbeat is needed then
+            if not self._queue.full():
+                self.heartbeats += 1
+                self._queue.put_nowait(self.heartbeat_item)
+            self._last_item = time.monotonic()
+            idle = 0.0
+        self._schedule_heartbeat(self.heartbeat_interval - idle)
+
+    async def __aiter__(self):
+        if self.heartbeat_interval:
+            self._schedule_heartbeat(self.heartbeat_interval)
+        live = len(self._pumps)
+        try:
+            while live:
+                item = self._control.popleft() if self._control else await self._queue.get()
+                if item is _CONTROL_READY:
+                    continue
+                if item is _SOURCE_DONE:
+                    live -= 1
+                    continue
+                if isinstance(item, _SourceError):
+                    raise item.error
+                # any delivered item pushes the next heartbeat back
+                self._last_item = time.monotonic()
+                yield item
+                if self.is_final(item):
+                    logger.info("Main stream ended, stopping all streams")
+                    break
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._heartbeat_handle is not None:
+            self._heartbeat_handle.cancel()
+        for handle in self._timers:
+            handle.cancel()
+        for task in self._pumps:
+            if not task.done():
+                task.cancel()
+        for task in self._pumps:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
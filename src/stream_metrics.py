@@ -0,0 +1,193 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-stream latency timelines aggregated into in-process histograms
+"""
+import time
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+# Stages recorded for every stream, in the order they normally happen
+STAGES = ("request_received", "session_ready", "agent_created", "first_model_byte",
+          "first_text_token", "message_stop", "last_byte")
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of millisecond durations"""
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile, capped at the observed max"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(float(LATENCY_BUCKETS_MS[index]), self.max) if index < len(LATENCY_BUCKETS_MS) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max, 2),
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+        }
+
+
+class StreamMetricsRegistry:
+    """Histograms keyed by metric name and label (model id or MCP server id)"""
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+        self.streams = 0
+
+    def observe(self, metric: str, label: str, ms: float):
+        with self._lock:
+            histogram = self._histograms.get((metric, label))
+            if histogram is None:
+                histogram = self._histograms[(metric, label)] = LatencyHistogram()
+            histogram.observe(ms)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            result: Dict[str, Dict] = {}
+            for (metric, label), histogram in sorted(self._histograms.items()):
+                result.setdefault(metric, {})[label] = histogram.snapshot()
+            return {"streams": self.streams, "histograms": result, "buckets_ms": list(LATENCY_BUCKETS_MS)}
+
+
+class StreamTimeline:
+    """
+    Stage timestamps, token gaps and tool durations of one stream.
+
+    Durations are taken from a monotonic clock relative to request_received.
+    Tool time runs from the end of the tool's input block to its result, so it
+    includes the agent's scheduling of the call. `finish` feeds the stream
+    into the registry histograms once.
+    """
+
+    def __init__(self, model_id: str = "", registry: Optional[StreamMetricsRegistry] = None):
+        self.model_id = model_id
+        self.registry = registry or get_stream_metrics()
+        self.stages: Dict[str, float] = {"request_received": time.monotonic()}
+        self.tools: List[Dict] = []
+        self._running_tools: Dict[str, Tuple[str, str, float]] = {}
+        self._last_token: Optional[float] = None
+        self.tokens = 0
+        self._gap_total = 0.0
+        self._gap_max = 0.0
+        self._finished = False
+
+    def mark(self, stage: str, overwrite: bool = False):
+        if overwrite or stage not in self.stages:
+            self.stages[stage] = time.monotonic()
+
+    def first_event(self):
+        if "first_model_byte" not in self.stages:
+            self.stages["first_model_byte"] = time.monotonic()
+
+    def token(self):
+        """Record a text delta from the model"""
+        now = time.monotonic()
+        if self._last_token is None:
+            self.stages.setdefault("first_text_token", now)
+        else:
+            gap = (now - self._last_token) * 1000
+            self._gap_total += gap
+            if gap > self._gap_max:
+                self._gap_max = gap
+            self.registry.observe("inter_token_ms", self.model_id, gap)
+        self._last_token = now
+        self.tokens += 1
+
+    def tool_start(self, tool_use_id: str, name: str, server_id: str):
+        self._running_tools[tool_use_id] = (name, server_id, time.monotonic())
+
+    def tool_end(self, tool_use_id: str):
+        running = self._running_tools.pop(tool_use_id, None)
+        if running is None:
+            return
+        name, server_id, started = running
+        duration = (time.monotonic() - started) * 1000
+        self.tools.append({"name": name, "server": server_id, "duration_ms": round(duration, 2)})
+        self.registry.observe("tool_ms", server_id, duration)
+
+    def _offset(self, stage: str) -> Optional[float]:
+        if stage not in self.stages:
+            return None
+        return round((self.stages[stage] - self.stages["request_received"]) * 1000, 2)
+
+    def summary(self) -> Dict:
+        gaps = self.tokens - 1
+        return {
+            "model_id": self.model_id,
+            "stages_ms": {stage: self._offset(stage) for stage in STAGES if stage in self.stages},
+            "ttft_ms": self._offset("first_text_token"),
+            "total_ms": self._offset("last_byte"),
+            "text_deltas": self.tokens,
+            "inter_token_ms": {
+                "mean": round(self._gap_total / gaps, 2) if gaps > 0 else None,
+                "max": round(self._gap_max, 2),
+            },
+            "tools": self.tools,
+        }
+
+    def final_summary(self) -> Dict:
+        """Summary sent in the last chunk of a response; the final frames follow it immediately"""
+        self.mark("last_byte")
+        return self.summary()
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self.mark("last_byte")
+        registry = self.registry
+        with registry._lock:
+            registry.streams += 1
+        for metric, stage in (("ttft_ms", "first_text_token"), ("first_byte_ms", "first_model_byte"),
+                              ("total_ms", "last_byte")):
+            offset = self._offset(stage)
+            if offset is not None:
+                registry.observe(metric, self.model_id, offset)
+        if "agent_created" in self.stages and "session_ready" in self.stages:
+            registry.observe("agent_setup_ms", self.model_id,
+                             (self.stages["agent_created"] - self.stages["session_ready"]) * 1000)
+
+
+_registry: Optional[StreamMetricsRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_stream_metrics() -> StreamMetricsRegistry:
+    """Return the process-wide stream metrics registry"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = StreamMetricsRegistry()
+        return _registry
@@ -0,0 +1,297 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-stream replay buffers that make SSE chat streams resumable
+
+The agent response is produced by a background task into a bounded ring
+buffer of numbered frames; SSE responses are subscribers that read from the
+buffer and then follow it live. A client that reconnects with Last-Event-ID
+resumes without re-running the model or tools, and any number of subscribers
+(other tabs, monitoring views) can attach to one stream with independent
+cursors, each frame being serialized only once.
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, Deque, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+STREAM_REPLAY_MAX_FRAMES = int(os.environ.get("STREAM_REPLAY_MAX_FRAMES", 4096))
+STREAM_REPLAY_MAX_BYTES = int(os.environ.get("STREAM_REPLAY_MAX_BYTES", 4 * 1024 * 1024))
+# How long a stream is kept (running, or finished but buffered) with no subscriber attached
+STREAM_RESUME_GRACE_SECONDS = float(os.environ.get("STREAM_RESUME_GRACE_SECONDS", 60))
+# Default slow-consumer policy and how many frames a subscriber may lag before it applies (0 = buffer size)
+STREAM_SUBSCRIBER_POLICY = os.environ.get("STREAM_SUBSCRIBER_POLICY", "disconnect")
+STREAM_SUBSCRIBER_MAX_LAG = int(os.environ.get("STREAM_SUBSCRIBER_MAX_LAG", 0))
+
+# Slow-consumer policies
+POLICY_DISCONNECT = "disconnect"  # end the response, the client resumes with Last-Event-ID
+POLICY_SKIP = "skip"              # jump to the live edge, for observers that only need recent output
+SUBSCRIBER_POLICIES = (POLICY_DISCONNECT, POLICY_SKIP)
+
+
+class ReplayGap(Exception):
+    """The requested Last-Event-ID is older than the oldest buffered frame"""
+
+
+class StreamSubscriber:
+    """Cursor and slow-consumer settings of one attached SSE response"""
+
+    def __init__(self, subscriber_id: int, cursor: int, policy: str, max_lag: int):
+        if policy not in SUBSCRIBER_POLICIES:
+            raise ValueError(f"Unknown subscriber policy: {policy}")
+        self.subscriber_id = subscriber_id
+        self.cursor = cursor
+        self.policy = policy
+        self.max_lag = max_lag
+        self.attached = time.time()
+        self.skipped = 0
+
+    def stats(self, last_seq: int) -> Dict:
+        return {
+            "subscriber_id": self.subscriber_id,
+            "cursor": self.cursor,
+            "lag": last_seq - self.cursor,
+            "policy": self.policy,
+            "skipped": self.skipped,
+            "attached": self.attached,
+        }
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of SSE frames numbered 1, 2, 3... for one stream.
+
+    Frames are stored with their `id:` line already prepended, so replaying
+    and live delivery write the same bytes.
+    """
+
+    def __init__(self, stream_id: str, user_id: str,
+                 max_frames: int = STREAM_REPLAY_MAX_FRAMES, max_bytes: int = STREAM_REPLAY_MAX_BYTES):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.created = time.time()
+        self.last_seq = 0
+        self.closed = False
+        self._subscribers: Dict[int, StreamSubscriber] = {}
+        self._next_subscriber_id = 1
+        self._frames: Deque[Tuple[int, bytes]] = deque()
+        self._bytes = 0
+        self._waiters: Set[asyncio.Future] = set()
+
+    @property
+    def first_seq(self) -> int:
+        return self._frames[0][0] if self._frames else self.last_seq + 1
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._bytes
+
+    def append(self, frame: bytes) -> int:
+        self.last_seq += 1
+        frame = b"id: %d\n" % self.last_seq + frame
+        self._frames.append((self.last_seq, frame))
+        self._bytes += len(frame)
+        while len(self._frames) > self.max_frames or (self._bytes > self.max_bytes and len(self._frames) > 1):
+            _, dropped = self._frames.popleft()
+            self._bytes -= len(dropped)
+        self._notify()
+        return self.last_seq
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    def _notify(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+        self._waiters.clear()
+
+    def frames_after(self, last_id: int) -> list:
+        """Buffered frames with id > last_id; raises ReplayGap if some were evicted"""
+        if last_id + 1 < self.first_seq:
+            raise ReplayGap(f"event {last_id + 1} of {self.stream_id} is no longer buffered "
+                            f"(oldest is {self.first_seq})")
+        count = self.last_seq - last_id
+        if count <= 0:
+            return []
+        # new frames sit at the right end of the deque, where indexing is cheap
+        size = len(self._frames)
+        return [self._frames[index][1] for index in range(size - count, size)]
+
+    async def subscribe(self, last_id: int = 0, heartbeat_interval: Optional[float] = None,
+                        heartbeat_frame: bytes = b"", policy: str = STREAM_SUBSCRIBER_POLICY,
+                        max_lag: int = STREAM_SUBSCRIBER_MAX_LAG) -> AsyncIterator[bytes]:
+        """Replay frames after last_id, then follow the stream until it closes"""
+        self.frames_after(last_id)
+        subscriber = StreamSubscriber(self._next_subscriber_id, last_id, policy, max_lag or self.max_frames)
+        self._next_subscriber_id += 1
+        self._subscribers[subscriber.subscriber_id] = subscriber
+        try:
+            while True:
+                lag = self.last_seq - subscriber.cursor
+                if lag > subscriber.max_lag or subscriber.cursor + 1 < self.first_seq:
+                    if subscriber.policy == POLICY_DISCONNECT:
+                        logger.warning(f"Subscriber {subscriber.subscriber_id} of {self.stream_id} is {lag} "
+                                       f"events behind, disconnecting")
+                        yield b": slow consumer, reconnect with Last-Event-ID %d\n\n" % subscriber.cursor
+                        break
+                    subscriber.skipped += lag
+                    subscriber.cursor = self.last_seq
+                    yield b": skipped %d events\n\n" % lag
+                frames = self.frames_after(subscriber.cursor)
+                if frames:
+                    subscriber.cursor = self.last_seq
+                    for frame in frames:
+                        yield frame
+                    continue
+                if self.closed:
+                    break
+                if not await self._wait(heartbeat_interval):
+                    yield heartbeat_frame
+        finally:
+            self._subscribers.pop(subscriber.subscriber_id, None)
+
+    async def _wait(self, timeout: Optional[float]) -> bool:
+        """Wait for the next append or close; False when `timeout` passed first"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.add(waiter)
+        handle = None
+        if timeout:
+            handle = loop.call_later(timeout, lambda: waiter.done() or waiter.set_result(False))
+        try:
+            return await waiter
+        finally:
+            self._waiters.discard(waiter)
+            if handle is not None:
+                handle.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "stream_id": self.stream_id,
+            "first_event_id": self.first_seq,
+            "last_event_id": self.last_seq,
+            "buffered_frames": len(self._frames),
+            "buffered_bytes": self._bytes,
+            "subscribers": [subscriber.stats(self.last_seq) for subscriber in self._subscribers.values()],
+            "closed": self.closed,
+            "created": self.created,
+        }
+
+
+class ReplayRegistry:
+    """
+    Owns the replay buffers and producer tasks of this process.
+
+    A producer keeps running while at least one subscriber is attached or
+    within STREAM_RESUME_GRACE_SECONDS of the last detach; a finished
+    stream's buffer is kept for the same grace period.
+    """
+
+    def __init__(self, grace_seconds: float = STREAM_RESUME_GRACE_SECONDS):
+        self.grace_seconds = grace_seconds
+        self.buffers: Dict[str, ReplayBuffer] = {}
+        self._producers: Dict[str, asyncio.Task] = {}
+        self._expiry: Dict[str, asyncio.TimerHandle] = {}
+        self.resumed = 0
+        self.abandoned = 0
+
+    def start(self, stream_id: str, user_id: str, frames: AsyncIterator[bytes]) -> ReplayBuffer:
+        """Run `frames` in a background task that appends into a new buffer"""
+        buffer = ReplayBuffer(stream_id, user_id)
+        self.buffers[stream_id] = buffer
+        self._producers[stream_id] = asyncio.create_task(self._produce(buffer, frames))
+        return buffer
+
+    async def _produce(self, buffer: ReplayBuffer, frames: AsyncIterator[bytes]):
+        try:
+            async for frame in frames:
+                buffer.append(frame)
+        except asyncio.CancelledError:
+            logger.info(f"Stream {buffer.stream_id} abandoned, no subscriber within {self.grace_seconds}s")
+        except Exception as e:
+            logger.error(f"Producer of stream {buffer.stream_id} failed: {e}")
+        finally:
+            buffer.close()
+            self._producers.pop(buffer.stream_id, None)
+            if buffer.subscribers == 0:
+                self._schedule_expiry(buffer.stream_id)
+
+    def get(self, stream_id: str) -> Optional[ReplayBuffer]:
+        return self.buffers.get(stream_id)
+
+    def list_streams(self, user_id: str) -> list:
+        """Stats of the buffered streams owned by a user"""
+        return [buffer.stats() for buffer in self.buffers.values() if buffer.user_id == user_id]
+
+    async def attach(self, buffer: ReplayBuffer, last_id: int = 0, heartbeat_interval: Optional[float] = None,
+                     heartbeat_frame: bytes = b"", **subscribe_kwargs) -> AsyncIterator[bytes]:
+        """Subscribe to a buffer, keeping its producer alive while attached"""
+        handle = self._expiry.pop(buffer.stream_id, None)
+        if handle is not None:
+            handle.cancel()
+        if last_id:
+            self.resumed += 1
+        try:
+            async with aclosing(buffer.subscribe(last_id, heartbeat_interval, heartbeat_frame,
+                                                        **subscribe_kwargs)) as frames:
+                async for frame in frames:
+                    yield frame
+        finally:
+            if buffer.subscribers == 0 and self.buffers.get(buffer.stream_id) is buffer:
+                self._schedule_expiry(buffer.stream_id)
+
+    def _schedule_expiry(self, stream_id: str):
+        handle = self._expiry.pop(stream_id, None)
+        if handle is not None:
+            handle.cancel()
+        self._expiry[stream_id] = asyncio.get_running_loop().call_later(
+            self.grace_seconds, self._expire, stream_id)
+
+    def _expire(self, stream_id: str):
+        self._expiry.pop(stream_id, None)
+        buffer = self.buffers.get(stream_id)
+        if buffer is None or buffer.subscribers:
+            return
+        producer = self._producers.get(stream_id)
+        if producer is not None:
+            # nobody came back: stop the agent, keep the buffer for one more grace period
+            self.abandoned += 1
+            producer.cancel()
+            return
+        self.buffers.pop(stream_id, None)
+
+    def stats(self) -> Dict:
+        return {
+            "streams": len(self.buffers),
+            "running": len(self._producers),
+            "subscribers": sum(buffer.subscribers for buffer in self.buffers.values()),
+            "buffered_bytes": sum(buffer.buffered_bytes for buffer in self.buffers.values()),
+            "resumed": self.resumed,
+            "abandoned": self.abandoned,
+        }
+
+
+_registry: Optional[ReplayRegistry] = None
+
+
+def get_replay_registry() -> ReplayRegistry:
+    """Return the process-wide replay registry"""
+    global _registry
+    if _registry is None:
+        _registry = ReplayRegistry()
+    return _registry
@@ -0,0 +1,129 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Process-wide watcher that detects remotely stopped streams
+"""
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Optional, Set
+from utils import get_existing_stream_ids_sync
+
+logger = logging.getLogger(__name__)
+
+STREAM_WATCH_MIN_INTERVAL = float(os.environ.get("STREAM_WATCH_MIN_INTERVAL", 1.0))
+STREAM_WATCH_MAX_INTERVAL = float(os.environ.get("STREAM_WATCH_MAX_INTERVAL", 5.0))
+# Upper bound on stream ids checked per second, which stretches the tick as streams grow
+STREAM_WATCH_KEYS_PER_SECOND = float(os.environ.get("STREAM_WATCH_KEYS_PER_SECOND", 50))
+
+
+class StreamCancellationWatcher:
+    """
+    Tracks every locally active stream and checks them in one batch per tick.
+
+    A stream whose record has disappeared from the shared store (because
+    `stop_stream` ran on another instance) gets its cancel callback invoked
+    once and is dropped from the watch list.
+    """
+
+    def __init__(self, check_fn: Callable[[list], Set[str]] = get_existing_stream_ids_sync):
+        self._check_fn = check_fn
+        self._streams: Dict[str, Callable[[str], None]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self.ticks = 0
+        self.cancelled = 0
+        self.last_interval = STREAM_WATCH_MIN_INTERVAL
+
+    def watch(self, stream_id: str, on_cancel: Callable[[str], None]):
+        with self._cond:
+            self._streams[stream_id] = on_cancel
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, daemon=True, name="StreamWatcher")
+                self._thread.start()
+            elif len(self._streams) == 1:
+                # the watcher was idle with nothing to watch
+                self._cond.notify()
+
+    def unwatch(self, stream_id: str):
+        with self._cond:
+            self._streams.pop(stream_id, None)
+
+    def cancel(self, stream_ids: Iterable[str]) -> int:
+        """Fire the cancel callbacks of the given streams if they are watched here"""
+        fired = 0
+        for stream_id in stream_ids:
+            with self._cond:
+                callback = self._streams.pop(stream_id, None)
+            if callback is None:
+                continue
+            fired += 1
+            self.cancelled += 1
+            logger.info(f"Stream {stream_id} was stopped remotely, cancelling")
+            try:
+                callback(stream_id)
+            except Exception as e:
+                logger.error(f"Error cancelling stream {stream_id}: {e}")
+        return fired
+
+    def interval(self, live: int) -> float:
+        """Tick interval for the given number of live streams"""
+        return min(STREAM_WATCH_MAX_INTERVAL, max(STREAM_WATCH_MIN_INTERVAL, live / STREAM_WATCH_KEYS_PER_SECOND))
+
+    def _run(self):
+        logger.info("Stream watcher started")
+        while True:
+            with self._cond:
+                while not self._streams and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                stream_ids = list(self._streams)
+                self.last_interval = self.interval(len(stream_ids))
+
+            started = time.monotonic()
+            try:
+                existing = self._check_fn(stream_ids)
+                self.cancel([stream_id for stream_id in stream_ids if stream_id not in existing])
+            except Exception as e:
+                logger.error(f"Stream watcher tick failed: {e}")
+            self.ticks += 1
+
+            with self._cond:
+                remaining = self.last_interval - (time.monotonic() - started)
+                if remaining > 0 and not self._stopped:
+                    self._cond.wait(timeout=remaining)
+        logger.info("Stream watcher terminated")
+
+    def stats(self) -> Dict:
+        with self._cond:
+            live = len(self._streams)
+        return {
+            "live_streams": live,
+            "interval_seconds": self.last_interval,
+            "ticks": self.ticks,
+            "cancelled": self.cancelled,
+        }
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+_watcher: Optional[StreamCancellationWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def get_stream_watcher() -> StreamCancellationWatcher:
+    """Return the process-wide stream watcher"""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = StreamCancellationWatcher()
+        return _watcher
@@ -0,0 +1,107 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Tracks tool calls of one agent stream and pairs them with their results
+"""
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from incremental_json import IncrementalJSONParser, JSONStreamError
+
+logger = logging.getLogger(__name__)
+
+
+class ToolCallLedger:
+    """
+    Tool calls keyed by toolUseId.
+
+    Streamed input chunks are collected in a list and joined once at block
+    stop, and each tool result is paired with its call by id, so the work
+    per event does not grow with the number of calls in the run. With
+    `incremental`, chunks are also fed to an incremental JSON tokenizer,
+    which yields partial arguments and reports malformed input as soon as
+    it appears.
+    """
+
+    def __init__(self, incremental: bool = False):
+        self.incremental = incremental
+        self.calls: Dict[str, dict] = {}
+        self.results: Dict[str, Any] = {}
+        self._current: Optional[dict] = None
+        self._input_parts: List[str] = []
+        self._parser: Optional[IncrementalJSONParser] = None
+        self.input_error: Optional[JSONStreamError] = None
+        # results that arrived before their call was registered
+        self._orphans: List[str] = []
+
+    def start(self, tool_use: dict):
+        """Register the toolUse of a block_start event as the current call"""
+        self._finish_input()
+        self.calls[tool_use["toolUseId"]] = tool_use
+        self._current = tool_use
+        self._input_parts = []
+        self._parser = IncrementalJSONParser() if self.incremental else None
+        self.input_error = None
+
+    def add_input(self, chunk: str) -> List[dict]:
+        """Buffer an input chunk and return the partial argument updates it completes"""
+        if self._current is None:
+            return []
+        self._input_parts.append(chunk)
+        if self._parser is None or self.input_error is not None:
+            return []
+        try:
+            return self._parser.feed(chunk)
+        except JSONStreamError as e:
+            logger.warning(f"Tool {self._current.get('name')} input is malformed: {e}")
+            self.input_error = e
+            return []
+
+    @property
+    def current_name(self) -> Optional[str]:
+        return self._current.get("name") if self._current is not None else None
+
+    @property
+    def current_id(self) -> Optional[str]:
+        return self._current.get("toolUseId") if self._current is not None else None
+
+    def stop(self):
+        """Finish the current block, parsing the accumulated tool input"""
+        self._finish_input()
+        self._current = None
+        self._parser = None
+
+    def _finish_input(self):
+        if self._current is None or not self._input_parts:
+            return
+        raw = "".join(self._input_parts)
+        self._input_parts = []
+        try:
+            self._current["input"] = json.loads(raw)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Tool {self._current.get('name')} input is not valid JSON: {e}")
+            self._current["input"] = raw
+
+    def record_result(self, tool_use_id: str, result: Any) -> Optional[list]:
+        """
+        Store a tool result and return the flat [call, result, ...] list to send,
+        or None if this result was already seen or its call is not known yet
+        """
+        if tool_use_id in self.results:
+            return None
+        self.results[tool_use_id] = result
+        ready = [tool_use_id]
+        if self._orphans:
+            ready = self._orphans + ready
+            self._orphans = []
+        tool_results = []
+        for ready_id in ready:
+            tool = self.calls.get(ready_id)
+            if tool is None:
+                self._orphans.append(ready_id)
+                continue
+            tool_results.append(tool)
+            tool_results.append({"tool_name": tool["name"], "tool_result": self.results[ready_id]})
+        return tool_results or None
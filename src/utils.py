@@ -18,6 +18,12 @@ from dotenv import load_dotenv
 from urllib.parse import urlparse
 from botocore.exceptions import ClientError
 import asyncio
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from config_store import get_config_store, WriteBehindBuffer, DELETED, CONFIG_INVALIDATE_CHANNEL
+from cluster_bus import get_cluster_bus
 # Initialize logger
 
 logging.basicConfig(
@@ -34,6 +40,8 @@ user_mcp_server_configs = {}  # 用户特有的MCP服务器配置 user_id -> {se
 global_mcp_server_configs = {}  # 全局MCP服务器配置 server_id -> config
 # 活跃流式请求的字典，用于跟踪可以停止的请求
 active_streams = {}
+# 多进程模式下各worker共享的流归属目录：每个活跃流一个文件，内容为user_id（未配置DynamoDB时使用）
+STREAM_STATE_DIR = os.environ.get("STREAM_STATE_DIR", "")
 # 使用独立的锁来保护active_streams字典
 active_streams_lock = threading.RLock()
 session_lock = threading.RLock()
@@ -83,13 +91,35 @@ async def delete_user_message(user_id: str) ->dict:
     return await delete_from_ddb(f"{user_id}_messages")
 
 async def save_user_session(user_id: str, data: dict) -> bool:
-    return await save_to_ddb(f"{user_id}_session",data)
+    saved = await save_to_ddb(f"{user_id}_session",data)
+    if saved:
+        get_config_store().sessions.put(user_id, data)
+    return saved
 
 async def get_user_session(user_id: str) ->dict:
-    return await get_from_ddb(f"{user_id}_session")
+    # 命中本地缓存时不访问DynamoDB，只缓存存在的会话
+    store = get_config_store()
+    cached = store.get_session(user_id)
+    if not store.is_miss(cached):
+        return cached
+    version = store.sessions.version(user_id)
+    session_obj = await get_from_ddb(f"{user_id}_session")
+    if session_obj:
+        store.sessions.put(user_id, session_obj, version)
+    return session_obj
 
 async def delete_user_session(user_id: str) ->dict:
+    get_config_store().sessions.invalidate(user_id)
     return await delete_from_ddb(f"{user_id}_session")
+
+async def publish_config_change(user_id: str):
+    """通知其他实例丢弃该用户的配置缓存"""
+    store = get_config_store()
+    try:
+        await asyncio.to_thread(get_cluster_bus().publish, CONFIG_INVALIDATE_CHANNEL,
+                                store.invalidation_message(user_id))
+    except Exception as e:
+        logger.warning(f"发布用户 {user_id} 配置变更失败: {e}")
     
 async def save_to_ddb(user_id: str, data: dict):
     """将用户配置保存到DynamoDB"""
@@ -218,6 +248,17 @@ async def scan_all_from_ddb() -> dict:
         logger.error(f"从DynamoDB扫描用户配置失败: {e}")
         return {}
     
+def _stream_file(stream_id: str) -> str:
+    # stream id可能来自请求头，用哈希作为文件名
+    return os.path.join(STREAM_STATE_DIR, hashlib.sha1(stream_id.encode("utf-8")).hexdigest())
+
+def _read_stream_file(stream_id: str):
+    try:
+        with open(_stream_file(stream_id), "r", encoding="utf-8") as f:
+            return f.read() or None
+    except FileNotFoundError:
+        return None
+
 # Save stream id
 async def save_stream_id(stream_id:str,user_id:str):
     global active_streams
@@ -228,6 +269,11 @@ async def save_stream_id(stream_id:str,user_id:str):
             active_streams[stream_id]=user_id
         else:
             active_streams[stream_id]=user_id
+            if STREAM_STATE_DIR:
+                path = _stream_file(stream_id)
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(user_id)
+                os.replace(path + ".tmp", path)
 
 # Get stream id
 async def get_stream_id(stream_id:str):
@@ -239,6 +285,8 @@ async def get_stream_id(stream_id:str):
                 return ddb_config.get('user_id')
             else:
                 return None
+        elif STREAM_STATE_DIR:
+            return _read_stream_file(stream_id)
         else:
             return active_streams.get(stream_id)
     
@@ -251,9 +299,47 @@ def get_stream_id_sync(stream_id:str):
                 return ddb_config.get('user_id')
             else:
                 return None
+        elif STREAM_STATE_DIR:
+            return _read_stream_file(stream_id)
         else:
             return active_streams.get(stream_id)    
 
+def get_existing_stream_ids_sync(stream_ids:list) -> set:
+    """批量检查stream id是否仍然存在，返回仍存在的stream id集合"""
+    if not stream_ids:
+        return set()
+    if not (DDB_TABLE and dynamodb_client):
+        if STREAM_STATE_DIR:
+            # 其他worker停止的流会删除共享目录中的文件
+            return {stream_id for stream_id in stream_ids if os.path.exists(_stream_file(stream_id))}
+        with active_streams_lock:
+            return {stream_id for stream_id in stream_ids if stream_id in active_streams}
+
+    existing = set()
+    # BatchGetItem最多一次100个key
+    for i in range(0, len(stream_ids), 100):
+        chunk = stream_ids[i:i + 100]
+        try:
+            response = dynamodb_client.batch_get_item(
+                RequestItems={
+                    DDB_TABLE: {
+                        'Keys': [{'userId': stream_id} for stream_id in chunk],
+                        'ProjectionExpression': 'userId',
+                        'ConsistentRead': True
+                    }
+                }
+            )
+            for item in response.get('Responses', {}).get(DDB_TABLE, []):
+                existing.add(item['userId'])
+            # 未处理的key视为仍然存在，下次再检查
+            for key in response.get('UnprocessedKeys', {}).get(DDB_TABLE, {}).get('Keys', []):
+                existing.add(key['userId'])
+        except Exception as e:
+            logger.warning(f"batch_get_item stream ids failed: {e}")
+            # 检查失败时不能误停流
+            existing.update(chunk)
+    return existing
+
 
 # delete stream id
 async def delete_stream_id(stream_id:str):
@@ -265,6 +351,11 @@ async def delete_stream_id(stream_id:str):
         else:
             if stream_id in active_streams:
                 active_streams.pop(stream_id, None)
+            if STREAM_STATE_DIR:
+                try:
+                    os.remove(_stream_file(stream_id))
+                except FileNotFoundError:
+                    pass
 
         
 
@@ -278,58 +369,111 @@ def save_global_server_config( server_id: str, config: dict):
 
 # 删除用户MCP服务器配置 
 async def delete_user_server_config(user_id: str, server_id: str):
-    """删除用户的MCP服务器配置"""
+    """删除用户的MCP服务器配置，实际写入由config_writer合并后延迟执行"""
     with session_lock: 
-        if user_id in user_mcp_server_configs and server_id in user_mcp_server_configs[user_id]:
-            del user_mcp_server_configs[user_id][server_id]
-            # 如果配置了DynamoDB，也从DDB中更新用户配置
-            if DDB_TABLE and dynamodb_client:
-                # 获取当前用户的所有配置
-                user_configs = await get_user_server_configs(user_id)
-                if server_id in user_configs:
-                    del user_configs[server_id]
-                    # 保存更新后的配置到DynamoDB
-                    await save_to_ddb(user_id, user_configs)
-                    logger.info(f"已更新用户 {user_id} 在DynamoDB中的配置")
-            else:
-                try:
-                    save_configs_to_json(user_mcp_server_configs)
-                    logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
-                except Exception as e:
-                    logger.error(f"保存用户MCP配置到文件失败: {e}")
+        if user_id not in user_mcp_server_configs or server_id not in user_mcp_server_configs[user_id]:
+            return
+        del user_mcp_server_configs[user_id][server_id]
+        user_configs = dict(user_mcp_server_configs[user_id])
+    _refresh_cached_configs(user_id, user_configs)
+    await config_writer.stage(user_id, server_id, DELETED)
+    logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
 
 
 # 保存用户MCP服务器配置
 async def save_user_server_config(user_id: str, server_id: str, config: dict):
-    """保存用户的MCP服务器配置"""
+    """保存用户的MCP服务器配置，配置未变化时不写入，变化由config_writer合并后延迟写入"""
     global user_mcp_server_configs
     
     with session_lock:
         if user_id not in user_mcp_server_configs:
             user_mcp_server_configs[user_id] = {}
-        
+        if user_mcp_server_configs[user_id].get(server_id) == config:
+            config_writer.unchanged()
+            return
         user_mcp_server_configs[user_id][server_id] = config
-        # 如果配置了DynamoDB，也保存到DDB中
-        if DDB_TABLE and dynamodb_client:
-            #获取原有的记录
-            ddb_config = await get_from_ddb(user_id)
-            ddb_config[server_id] = config
-            await save_to_ddb(user_id, ddb_config)
-            logger.info(f"已保存用户 {user_id} 配置到DynamoDB")
-        else:
-            try:
-                save_configs_to_json(user_mcp_server_configs)
-                logger.info(f"已保存用户 {user_id} 配置到config_file")
-            except Exception as e:
-                logger.error(f"保存用户MCP配置到文件失败: {e}")
+        user_configs = dict(user_mcp_server_configs[user_id])
+    _refresh_cached_configs(user_id, user_configs)
+    await config_writer.stage(user_id, server_id, config)
+
+
+def _refresh_cached_configs(user_id: str, user_configs: dict):
+    # 让进行中的DynamoDB读取失效，本实例立即读到新配置
+    store = get_config_store()
+    store.configs.invalidate(user_id)
+    store.configs.put(user_id, user_configs)
+
+
+async def _persist_user_server_configs(user_id: str, changes: dict):
+    """把一个用户累积的配置变更一次性写入DynamoDB或配置文件"""
+    if DDB_TABLE and dynamodb_client:
+        # 在最新的记录上应用变更，保留其他实例写入的server
+        ddb_config = await get_from_ddb(user_id)
+        for server_id, config in changes.items():
+            if config is DELETED:
+                ddb_config.pop(server_id, None)
+            else:
+                ddb_config[server_id] = config
+        if not await save_to_ddb(user_id, ddb_config):
+            raise RuntimeError("save_to_ddb failed")
+        logger.info(f"已保存用户 {user_id} 的 {len(changes)} 个配置变更到DynamoDB")
+        # 变更期间可能又有新的修改，缓存以合并后的结果为准
+        user_configs = config_writer.overlay(user_id, ddb_config)
+        with session_lock:
+            user_mcp_server_configs[user_id] = dict(user_configs)
+        _refresh_cached_configs(user_id, user_configs)
+        await publish_config_change(user_id)
+    else:
+        await asyncio.to_thread(_merge_user_configs_to_json, user_id, changes)
+        logger.info(f"已保存用户 {user_id} 配置到config_file")
+
+
+def _merge_user_configs_to_json(user_id: str, changes: dict):
+    """在文件锁内把一个用户的配置变更合并进配置文件，多个worker进程共用同一文件时不会互相覆盖"""
+    config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
+    with open(config_file + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(config_file, 'r') as f:
+                configs = json.load(f)
+        except (FileNotFoundError, ValueError):
+            configs = {}
+        user_configs = configs.get(user_id, {})
+        for server_id, config in changes.items():
+            if config is DELETED:
+                user_configs.pop(server_id, None)
+            else:
+                user_configs[server_id] = config
+        configs[user_id] = user_configs
+        with open(config_file + ".tmp", 'w') as f:
+            json.dump(configs, f, indent=2)
+        os.replace(config_file + ".tmp", config_file)
+
+
+# 用户MCP配置的写回缓冲：同一用户短时间内的多次修改合并为一次写入
+config_writer = WriteBehindBuffer(_persist_user_server_configs)
+
+
+async def flush_user_server_configs():
+    """立即写入所有未保存的用户MCP配置，服务关闭时调用"""
+    await config_writer.flush()
 
 # 获取用户MCP服务器配置
 async def get_user_server_configs(user_id: str) -> dict:
     """获取指定用户的所有MCP服务器配置"""
     # 如果设置了DynamoDB表名，优先从DynamoDB读取
     if DDB_TABLE and dynamodb_client:
+        # 优先使用带TTL和版本号的本地缓存
+        store = get_config_store()
+        cached = store.get_configs(user_id)
+        if not store.is_miss(cached):
+            return cached
+        version = store.configs.version(user_id)
         # 尝试从DynamoDB获取
-        ddb_config = await get_from_ddb(user_id)
+        # 叠加尚未写入的本地修改，避免读到旧记录
+        ddb_config = config_writer.overlay(user_id, await get_from_ddb(user_id))
+        store.configs.put(user_id, ddb_config, version)
         if ddb_config:
             # 如果DynamoDB中有数据，更新内存缓存并返回
             with session_lock:
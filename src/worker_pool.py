@@ -0,0 +1,195 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Multi-process worker mode: N worker processes behind one listening socket
+
+The supervisor binds the public socket and hands it to every worker, so the
+kernel spreads connections across them. Each worker also gets a private
+loopback socket, listed in members.json of the state directory. Workers run
+with SESSION_ROUTING=proxy on that membership file, so a request accepted by
+a worker that does not own its user_id is forwarded to the owner over
+loopback and every user's session lives in exactly one process. Active
+streams are recorded as files under streams/ of the state directory, so
+stopping and listing streams works whichever worker gets the request.
+"""
+import os
+import json
+import time
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Shared by the workers of one supervisor; a fresh temporary directory if unset
+WORKER_STATE_DIR = os.environ.get("WORKER_STATE_DIR", "")
+# Grace period for workers to finish in-flight requests on shutdown
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get("WORKER_SHUTDOWN_TIMEOUT", 35))
+# Minimum delay between restarts of a crashing worker
+WORKER_RESTART_DELAY = 1.0
+
+# target(index, sockets, *args) serves on sockets until it returns
+Target = Callable[..., None]
+
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    # connections queue up while workers start or restart
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerPool:
+    """
+    Supervises `workers` spawned processes running `target`, restarting any
+    that exit until the supervisor is asked to stop.
+    """
+
+    def __init__(self, target: Target, workers: int, host: str, port: int, scheme: str = "http",
+                 state_dir: str = WORKER_STATE_DIR, args: Tuple = ()):
+        self.target = target
+        self.workers = max(1, workers)
+        self.host = host
+        self.port = port
+        self.scheme = scheme
+        self.state_dir = state_dir
+        self.args = args
+        self._context = multiprocessing.get_context("spawn")
+        self._public: Optional[socket.socket] = None
+        self._private: List[socket.socket] = []
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._last_start: Dict[int, float] = {}
+        self._stopping = False
+        self.restarts = 0
+
+    def worker_id(self, index: int) -> str:
+        return f"worker-{index}"
+
+    def _prepare(self):
+        self._public = bind_socket(self.host, self.port)
+        self._private = [bind_socket("127.0.0.1", 0) for _ in range(self.workers)]
+        if not self.state_dir:
+            self.state_dir = tempfile.mkdtemp(prefix="mcp_workers_")
+        os.makedirs(self.state_dir, exist_ok=True)
+        # streams of a previous run are gone with its processes
+        shutil.rmtree(self.streams_dir, ignore_errors=True)
+        os.makedirs(self.streams_dir)
+        members = {self.worker_id(index): self._url(index) for index in range(self.workers)}
+        path = self.members_file
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(members, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    @property
+    def members_file(self) -> str:
+        return os.path.join(self.state_dir, "members.json")
+
+    @property
+    def streams_dir(self) -> str:
+        return os.path.join(self.state_dir, "streams")
+
+    def _url(self, index: int) -> str:
+        return f"{self.scheme}://127.0.0.1:{self._private[index].getsockname()[1]}"
+
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        env = {
+            "SESSION_ROUTING": "proxy",
+            "CLUSTER_MEMBERS_FILE": self.members_file,
+            "CLUSTER_MEMBERS_TABLE": "",
+            "CLUSTER_INSTANCE_ID": self.worker_id(index),
+            "CLUSTER_INSTANCE_URL": self._url(index),
+            "STREAM_STATE_DIR": self.streams_dir,
+        }
+        if self.scheme == "https":
+            # the private sockets serve the same, possibly self-signed, certificate
+            env["SESSION_PROXY_VERIFY_SSL"] = "false"
+        return env
+
+    def _spawn(self, index: int):
+        # spawned children inherit os.environ as it is at start()
+        env = self._worker_env(index)
+        saved = {key: os.environ.get(key) for key in env}
+        os.environ.update(env)
+        try:
+            process = self._context.Process(target=self.target, name=self.worker_id(index),
+                                            args=(index, [self._public, self._private[index]]) + tuple(self.args))
+            process.start()
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        self._processes[index] = process
+        self._last_start[index] = time.monotonic()
+        logger.info(f"Started {process.name} (pid {process.pid}) on {self._url(index)}")
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"Received signal {signum}, stopping workers")
+        self._stopping = True
+
+    def start(self):
+        """Bind the sockets, write the membership file and spawn the workers"""
+        self._prepare()
+        logger.info(f"Serving on {self.scheme}://{self.host}:{self.port} with {self.workers} workers, "
+                    f"state in {self.state_dir}")
+        for index in range(self.workers):
+            self._spawn(index)
+
+    @property
+    def bound_port(self) -> int:
+        return self._public.getsockname()[1]
+
+    def run(self):
+        """Start the workers and supervise them until SIGINT or SIGTERM"""
+        previous = {sig: signal.signal(sig, self._handle_signal) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self.start()
+            while not self._stopping:
+                sentinels = {process.sentinel: index for index, process in self._processes.items()}
+                for sentinel in wait(list(sentinels), timeout=0.5):
+                    index = sentinels[sentinel]
+                    process = self._processes[index]
+                    process.join()
+                    if self._stopping:
+                        break
+                    logger.warning(f"{process.name} exited with code {process.exitcode}, restarting")
+                    delay = WORKER_RESTART_DELAY - (time.monotonic() - self._last_start[index])
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.restarts += 1
+                    self._spawn(index)
+        finally:
+            self.stop()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+    def stop(self):
+        """Ask the workers to shut down gracefully, killing those that outlast the grace period"""
+        self._stopping = True
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for process in self._processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in {WORKER_SHUTDOWN_TIMEOUT}s, killing it")
+                process.kill()
+                process.join()
+        self._processes.clear()
+        for sock in [self._public] + self._private:
+            if sock is not None:
+                sock.close()
+        self._public, self._private = None, []
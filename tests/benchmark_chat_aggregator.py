@@ -0,0 +1,133 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Benchmark: non-streaming chat completion vs streaming + client-side reassembly
+
+Replays a synthetic multi-turn agent run (reasoning, text, tool calls and
+metadata events) through
+  - the streaming path: SSE frames built with ChunkEncoder as in
+    stream_chat_response, then parsed back and reassembled like a client;
+  - the non-streaming path: ChatAggregator plus one JSON response body.
+
+Usage:
+    python tests/benchmark_chat_aggregator.py [--turns 3] [--deltas 600] [--runs 20]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sse_encoder import ChunkEncoder, DONE_FRAME
+from chat_aggregator import ChatAggregator
+
+MODEL = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+
+
+def make_events(turns, deltas):
+    events = [{"type": "message_start", "data": {"role": "assistant"}}]
+    for turn in range(turns):
+        for i in range(deltas // 3):
+            events.append({"type": "block_delta", "data": {"delta": {"reasoningContent": {"text": "hmm "}}, "contentBlockIndex": 0}})
+        events.append({"type": "block_stop", "data": {"contentBlockIndex": 0}})
+        for i in range(deltas):
+            events.append({"type": "block_delta", "data": {"delta": {"text": f"tok{i} "}, "contentBlockIndex": 1}})
+        events.append({"type": "block_stop", "data": {"contentBlockIndex": 1}})
+        last = turn == turns - 1
+        if not last:
+            tool_use = {"toolUseId": f"tooluse_{turn}", "name": "search"}
+            events.append({"type": "block_start", "data": {"start": {"toolUse": tool_use}, "contentBlockIndex": 2}})
+            for i in range(50):
+                events.append({"type": "block_delta", "data": {"delta": {"toolUse": {"input": '{"q": "x"}'[i % 10]}}, "contentBlockIndex": 2}})
+            events.append({"type": "block_stop", "data": {"contentBlockIndex": 2}})
+        events.append({"type": "message_stop", "data": {"stopReason": "end_turn" if last else "tool_use"}})
+        events.append({"type": "metadata", "data": {"usage": {"inputTokens": 1200, "outputTokens": deltas, "totalTokens": 1200 + deltas}}})
+        if not last:
+            events.append({"type": "result_pairs", "data": {"stopReason": "tool_use", "tool_results": [
+                dict(tool_use, input={"q": "x"}), {"tool_name": "search", "tool_result": {"content": [{"text": "r" * 500}]}}]}})
+    return events
+
+
+def streaming(events):
+    """Server: frames as built by stream_chat_response; client: parse and reassemble"""
+    encoder = ChunkEncoder(MODEL)
+    frames = []
+    tooluse_start = False
+    for response in events:
+        delta = finish_reason = message_extras = None
+        if response["type"] == "message_start":
+            delta = {"role": "assistant"}
+        elif response["type"] == "block_start":
+            message_extras = {"tool_name": response["data"]["start"]["toolUse"]["name"]}
+        elif response["type"] == "block_delta":
+            block_delta = response["data"]["delta"]
+            if "text" in block_delta:
+                frames.append(encoder.delta("content", block_delta["text"]))
+                continue
+            if "toolUse" in block_delta:
+                tooluse_start = True
+                delta = {"toolinput_content": block_delta["toolUse"]["input"]}
+            if "reasoningContent" in block_delta:
+                delta = {"reasoning_content": block_delta["reasoningContent"]["text"]}
+        elif response["type"] == "block_stop":
+            if tooluse_start:
+                tooluse_start = False
+                delta = {"toolinput_content": "<END>"}
+        elif response["type"] in ("message_stop", "result_pairs"):
+            finish_reason = response["data"]["stopReason"]
+            if response["data"].get("tool_results"):
+                message_extras = {"tool_use": json.dumps(response["data"]["tool_results"], ensure_ascii=False)}
+        frames.append(encoder.chunk(delta, finish_reason, message_extras))
+    frames.append(DONE_FRAME)
+    body = b"".join(frames).decode()
+
+    content, reasoning, tools = [], [], []
+    for line in body.split("\n"):
+        if not line.startswith("data: ") or line == "data: [DONE]":
+            continue
+        choice = json.loads(line[6:])["choices"][0]
+        delta = choice.get("delta") or {}
+        if "content" in delta:
+            content.append(delta["content"])
+        if "reasoning_content" in delta:
+            reasoning.append(delta["reasoning_content"])
+        extras = choice.get("message_extras") or {}
+        if "tool_use" in extras:
+            tools.extend(json.loads(extras["tool_use"]))
+    return "".join(content), len(body)
+
+
+def non_streaming(events):
+    aggregator = ChatAggregator()
+    for event in events:
+        aggregator.add(event)
+    body = json.dumps(aggregator.response(MODEL), ensure_ascii=False)
+    return aggregator.text, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=3)
+    parser.add_argument('--deltas', type=int, default=600)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    events = make_events(args.turns, args.deltas)
+    print(f"{len(events)} events per run, {args.runs} runs")
+    results = {}
+    for name, fn in (("streaming + reassembly", streaming), ("non-streaming", non_streaming)):
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            text, size = fn(events)
+        elapsed = (time.perf_counter() - start) / args.runs
+        results[name] = (text, elapsed)
+        print(f"{name:>24}: {elapsed * 1000:8.2f} ms per response, {size / 1024:8.1f} KiB on the wire")
+    assert results["streaming + reassembly"][0] == results["non-streaming"][0]
+    speedup = results["streaming + reassembly"][1] / results["non-streaming"][1]
+    print(f"non-streaming is x{speedup:.1f} cheaper end to end")
+
+
+if __name__ == '__main__':
+    main()
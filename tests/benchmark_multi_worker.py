@@ -0,0 +1,144 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Benchmark: request throughput of 1, 2, 4... worker processes on one listening socket
+
+Starts a WorkerPool as `main.py --workers N` does and serves each request in
+the workers with a minimal asyncio HTTP handler that spends its CPU where
+stream_chat_response does: framing `--deltas` SSE chunks with ChunkEncoder.
+A load client keeps `--concurrency` requests in flight for `--seconds`, each
+for one of `--users` user ids, and reports requests/s per worker count and
+how requests spread across the workers. Scaling is bounded by the cores of
+the machine; the client runs on the same machine and uses some of them.
+
+With --url the load client targets a running server instead, e.g.
+    python src/main.py --workers 4 &
+    python tests/benchmark_multi_worker.py --url http://127.0.0.1:7002/v1/list/models
+
+Usage:
+    python tests/benchmark_multi_worker.py [--workers 1,2,4] [--deltas 2000] [--concurrency 32] [--seconds 5]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from collections import Counter
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sse_encoder import ChunkEncoder, DONE_FRAME
+from worker_pool import WorkerPool
+
+MODEL = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+
+
+def serve_worker(index, sockets, deltas):
+    """Worker target: answers every request with `deltas` SSE frames"""
+
+    async def handle(reader, writer):
+        try:
+            while not reader.at_eof():
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+                encoder = ChunkEncoder(MODEL)
+                body = b"".join(encoder.delta("content", f"tok{i} ") for i in range(deltas)) + DONE_FRAME
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                             b"X-Worker: %d\r\nContent-Length: %d\r\n\r\n" % (index, len(body)) + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def run():
+        # the public socket only; the private one is for proxying between workers
+        server = await asyncio.start_server(handle, sock=sockets[0], backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+async def request(reader, writer, host, path, user_id):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nX-User-ID: {user_id}\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    length, worker = 0, None
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name in (b"x-worker", b"x-session-owner"):
+            worker = value.strip().decode()
+    await reader.readexactly(length)
+    return worker
+
+
+async def load(url, concurrency, seconds, users):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    path = parts.path or "/"
+    served = Counter()
+    count = 0
+    deadline = time.monotonic() + seconds
+
+    async def client(n):
+        nonlocal count
+        # one connection per client, as a browser keeps its SSE connection to one worker
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            i = 0
+            while time.monotonic() < deadline:
+                served[await request(reader, writer, host, path, f"user{(n + i * concurrency) % users}")] += 1
+                count += 1
+                i += 1
+        finally:
+            writer.close()
+
+    start = time.monotonic()
+    await asyncio.gather(*(client(n) for n in range(concurrency)))
+    return count / (time.monotonic() - start), served
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4', help="comma separated worker counts")
+    parser.add_argument('--deltas', type=int, default=2000, help="SSE frames per response")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--url', default='', help="load a running server instead of spawning workers")
+    args = parser.parse_args()
+
+    if args.url:
+        rate, served = asyncio.run(load(args.url, args.concurrency, args.seconds, args.users))
+        print(f"{args.url}: {rate:,.1f} req/s, by owner {dict(served)}")
+        return
+
+    print(f"cpus: {os.cpu_count()}, {args.deltas} frames per response, {args.concurrency} connections")
+    baseline = None
+    for workers in [int(n) for n in args.workers.split(',')]:
+        pool = WorkerPool(serve_worker, workers, "127.0.0.1", 0, args=(args.deltas,))
+        pool.start()
+        try:
+            url = f"http://127.0.0.1:{pool.bound_port}/"
+            # let the spawned workers import and start listening
+            asyncio.run(load(url, args.concurrency, 1.0, args.users))
+            rate, served = asyncio.run(load(url, args.concurrency, args.seconds, args.users))
+        finally:
+            pool.stop()
+        baseline = baseline or rate
+        spread = ", ".join(f"w{worker}={served[worker]}" for worker in sorted(served))
+        print(f"{workers:>2} workers: {rate:>9,.1f} req/s  x{rate / baseline:.2f}  ({spread})")
+
+
+if __name__ == '__main__':
+    main()
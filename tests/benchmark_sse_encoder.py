@@ -0,0 +1,102 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Microbenchmark: per-token SSE frame encoding, previous dict + json.dumps path vs ChunkEncoder
+
+Reports frames per second and memory allocated per frame (tracemalloc) for a
+typical text token and for a tool-result frame.
+
+Usage:
+    python tests/benchmark_sse_encoder.py [--frames 200000]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import sse_encoder
+from sse_encoder import ChunkEncoder
+
+MODEL = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+TOKEN = "hello"
+TOOL_RESULTS = [{"toolUseId": "tooluse_abc", "name": "search", "input": {"q": "weather"}},
+                {"tool_name": "search", "tool_result": {"content": [{"text": "sunny " * 40}]}}]
+
+
+def legacy_token(text):
+    """The envelope built by stream_chat_response before ChunkEncoder"""
+    event_data = {
+        "id": f"chat{time.time_ns()}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": MODEL,
+        "choices": [{
+            "index": 0,
+            "delta": {},
+            "finish_reason": None
+        }]
+    }
+    event_data["choices"][0]["delta"] = {"content": text}
+    return f"data: {json.dumps(event_data)}\n\n".encode()
+
+
+def legacy_tool(results):
+    event_data = {
+        "id": f"chat{time.time_ns()}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": MODEL,
+        "choices": [{
+            "index": 0,
+            "delta": {},
+            "finish_reason": None
+        }]
+    }
+    event_data["choices"][0]["finish_reason"] = "tool_use"
+    event_data["choices"][0]["message_extras"] = {"tool_use": json.dumps(results, ensure_ascii=False)}
+    return f"data: {json.dumps(event_data)}\n\n".encode()
+
+
+def rate(fn, arg, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn(arg)
+    return frames / (time.perf_counter() - start)
+
+
+def allocated_per_frame(fn, arg, frames=2000):
+    """Bytes allocated and retained per frame while keeping the frames alive"""
+    tracemalloc.start()
+    kept = [fn(arg) for _ in range(frames)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current / frames, peak / frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=200000)
+    args = parser.parse_args()
+    encoder = ChunkEncoder(MODEL)
+    token_fast = lambda text: encoder.delta("content", text)
+    tool_fast = lambda results: encoder.chunk(None, "tool_use", {"tool_use": json.dumps(results, ensure_ascii=False)})
+
+    print(f"orjson available: {sse_encoder.orjson is not None}")
+    for label, legacy, fast, arg, frames in (
+            ("text token", legacy_token, token_fast, TOKEN, args.frames),
+            ("tool result", legacy_tool, tool_fast, TOOL_RESULTS, args.frames // 10)):
+        legacy_rate, fast_rate = rate(legacy, arg, frames), rate(fast, arg, frames)
+        legacy_mem, fast_mem = allocated_per_frame(legacy, arg), allocated_per_frame(fast, arg)
+        print(f"{label:>12}: legacy {legacy_rate:>10,.0f} frames/s  {legacy_mem[1]:7.1f} B/frame peak | "
+              f"encoder {fast_rate:>10,.0f} frames/s  {fast_mem[1]:7.1f} B/frame peak | "
+              f"speedup x{fast_rate / legacy_rate:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Benchmark: agent-thread -> SSE handoff, blocking queue.Queue vs StreamChannel
+
+Simulates N concurrent streams. Each stream has a producer thread that emits
+token bursts separated by quiet periods (like a model waiting on a tool), and
+a consumer coroutine on the main event loop. Reports event-loop lag and
+per-token delivery latency for the legacy `queue.Get(timeout=1)` loop and the
+`StreamChannel` handoff.
+
+Usage:
+    python tests/benchmark_stream_channel.py [--streams 64] [--seconds 5]
+"""
+import os
+import sys
+import time
+import queue
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from stream_channel import StreamChannel
+
+
+def producer(put, stop_at, seed):
+    rnd = random.Random(seed)
+    while time.perf_counter() < stop_at:
+        # a burst of tokens, then a quiet period
+        for _ in range(rnd.randint(5, 40)):
+            put(("token", time.perf_counter()))
+            time.sleep(0.01)
+        time.sleep(rnd.uniform(0.2, 1.5))
+    put(("end", time.perf_counter()))
+
+
+def start_producer(put, stop_at, seed):
+    threading.Thread(target=producer, args=(put, stop_at, seed), daemon=True).start()
+
+
+async def legacy_consumer(latencies, stop_at, seed):
+    """Replica of the previous process_query_stream loop"""
+    q = queue.Queue()
+    start_producer(q.put, stop_at, seed)
+    return _legacy_drain(q, latencies)
+
+
+async def _legacy_drain(q, latencies):
+    while True:
+        try:
+            kind, ts = q.get(timeout=1)
+            if kind == "end":
+                break
+            latencies.append(time.perf_counter() - ts)
+        except queue.Empty:
+            await asyncio.sleep(0.01)
+
+
+async def channel_consumer(latencies, stop_at, seed):
+    channel = StreamChannel(asyncio.get_running_loop())
+    start_producer(channel.put, stop_at, seed)
+    return _channel_drain(channel, latencies)
+
+
+async def _channel_drain(channel, latencies):
+    while True:
+        item = await channel.get(timeout=1)
+        if item is None:
+            continue
+        kind, ts = item
+        if kind == "end":
+            break
+        latencies.append(time.perf_counter() - ts)
+
+
+async def lag_probe(lags, done, interval=0.01):
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(consumer, streams, seconds):
+    latencies, lags = [], []
+    done = asyncio.Event()
+    stop_at = time.perf_counter() + seconds
+    probe = asyncio.create_task(lag_probe(lags, done))
+    # start every producer first so a blocked loop cannot delay stream admission
+    drains = [await consumer(latencies, stop_at, i) for i in range(streams)]
+    await asyncio.gather(*drains)
+    done.set()
+    await probe
+    return latencies, lags
+
+
+def pct(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def report(name, latencies, lags):
+    print(f"{name:>8}: tokens={len(latencies):6d}  "
+          f"token p50={pct(latencies, .5):8.2f}ms p99={pct(latencies, .99):8.2f}ms max={pct(latencies, 1):8.2f}ms  |  "
+          f"loop lag p50={pct(lags, .5):8.2f}ms p99={pct(lags, .99):8.2f}ms max={pct(lags, 1):8.2f}ms "
+          f"(mean {statistics.fmean(lags) * 1000 if lags else float('nan'):.2f}ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+    print(f"{args.streams} concurrent streams, {args.seconds}s each run")
+    for name, consumer in (("queue", legacy_consumer), ("channel", channel_consumer)):
+        latencies, lags = asyncio.run(run(consumer, args.streams, args.seconds))
+        report(name, latencies, lags)
+
+
+if __name__ == '__main__':
+    main()
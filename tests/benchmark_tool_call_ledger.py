@@ -0,0 +1,101 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Synthetic benchmark: tool-call/result pairing in process_query_stream
+
+Replays an agent run with many tool calls, each streaming its input in
+chunks, through the previous list-scan pairing and through ToolCallLedger,
+with and without incremental parsing of the tool input.
+
+Usage:
+    python tests/benchmark_tool_call_ledger.py [--calls 500] [--chunks 40]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from tool_call_ledger import ToolCallLedger
+
+
+def make_events(calls, chunks):
+    events = []
+    for i in range(calls):
+        tool_id = f"tooluse_{i:05d}"
+        payload = json.dumps({"query": f"q{i}", "body": "x" * (chunks * 20)})
+        step = max(1, len(payload) // chunks)
+        events.append({"type": "block_start", "data": {"start": {"toolUse": {"toolUseId": tool_id, "name": "search"}}}})
+        for start in range(0, len(payload), step):
+            events.append({"type": "block_delta", "data": {"delta": {"toolUse": {"input": payload[start:start + step]}}}})
+        events.append({"type": "block_stop", "data": {}})
+        events.append({"type": "toolResult", "toolUseId": tool_id, "data": {"content": [{"text": f"result {i}"}]}})
+    return events
+
+
+def legacy(events):
+    """The pairing logic process_query_stream used before ToolCallLedger"""
+    tool_calls = []
+    current_tooluse_input = ''
+    tool_results_dict = {}
+    sent_results_history = {}
+    out = 0
+    for event in events:
+        if event["type"] == "block_start":
+            tool_calls.append(dict(event["data"]["start"]["toolUse"]))
+        if event["type"] == "block_delta":
+            current_tool_use = tool_calls[-1]
+            current_tooluse_input += event["data"]["delta"]["toolUse"]["input"]
+            current_tool_use["input"] = current_tooluse_input
+        if event["type"] == "block_stop" and current_tooluse_input:
+            tool_calls[-1]["input"] = json.loads(current_tooluse_input)
+            current_tooluse_input = ''
+        if event["type"] == "toolResult":
+            tool_use_id = event['toolUseId']
+            if tool_use_id not in tool_results_dict:
+                tool_results_dict[tool_use_id] = event['data']
+                pairs = [[tool, {"tool_name": tool['name'], "tool_result": tool_results_dict.get(tool['toolUseId'])}]
+                         for tool in tool_calls
+                         if tool_results_dict.get(tool['toolUseId']) and tool['toolUseId'] not in sent_results_history]
+                out += len([item for pair in pairs for item in pair])
+                sent_results_history[tool_use_id] = tool_use_id
+    return out
+
+
+def ledger(events, incremental=False):
+    tool_ledger = ToolCallLedger(incremental=incremental)
+    out = 0
+    for event in events:
+        if event["type"] == "block_start":
+            tool_ledger.start(dict(event["data"]["start"]["toolUse"]))
+        elif event["type"] == "block_delta":
+            tool_ledger.add_input(event["data"]["delta"]["toolUse"]["input"])
+        elif event["type"] == "block_stop":
+            tool_ledger.stop()
+        elif event["type"] == "toolResult":
+            out += len(tool_ledger.record_result(event['toolUseId'], event['data']) or ())
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--chunks', type=int, default=40)
+    args = parser.parse_args()
+    events = make_events(args.calls, args.chunks)
+    print(f"{args.calls} tool calls, {len(events)} events")
+    results = {}
+    for name, fn in (("legacy", legacy), ("ledger", ledger),
+                     ("ledger+incremental", lambda events: ledger(events, incremental=True))):
+        start = time.perf_counter()
+        results[name] = fn(events)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>18}: {elapsed * 1000:9.1f} ms  ({elapsed / args.calls * 1e6:8.1f} us per tool call)")
+    assert results["legacy"] == results["ledger"] == results["ledger+incremental"], results
+
+
+if __name__ == '__main__':
+    main()